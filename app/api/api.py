@@ -16,28 +16,138 @@ from __future__ import absolute_import
 from __future__ import unicode_literals
 from builtins import object
 from flask import abort, jsonify, Response, request
-import uuid
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from . import document
+from . import persistence
+from . import registry
+from . import router
+from . import lockprofile
+from . import metrics
+from .globalSettings import GlobalSettings
 
 
 class API(object):
     def __init__(self):
-        self.documents = {}
+        self.documents = registry.DocumentRegistry(document.Document)
+        self.loader = None
+        self.loaderLock = threading.Lock()
+        self.store = None
+        self.persister = None
+        self._registerMetrics()
+
+    def start(self):
+        """Start the background work of the service"""
+        self.startPersistence()
+        self.documents.start()
+
+    def startPersistence(self, directory=None):
+        """Restore documents from the persistent store, and start persisting documents"""
+        if directory is None:
+            directory = GlobalSettings.persistenceDirectory
+        if not directory or self.store:
+            return
+        self.store = persistence.FilesystemDocumentStore(directory)
+        self.documents.setStore(self.store)
+        for doc in persistence.restoreDocuments(self.store, document.Document, accept=self.ownsDocument):
+            self.documents[doc.documentId] = doc
+        self.persister = persistence.DocumentPersister(self.documents)
+        self.persister.start()
+
+    def ownsDocument(self, documentId):
+        """Return True if this worker process is responsible for documentId"""
+        return router.getWorkerIndex(documentId, GlobalSettings.workerCount) == GlobalSettings.workerIndex
+
+    def deleteDocument(self, documentId):
+        try:
+            del self.documents[documentId]
+        except KeyError:
+            abort(404)
+        if self.store:
+            self.store.deleteDocument(documentId)
+
+    def getDocument(self, documentId):
+        """Return the document, aborting with 404 if it does not exist or 409 if it has not been loaded (yet)"""
+        try:
+            doc = self.documents[documentId]
+        except KeyError:
+            abort(404)
+        if doc.loadState == 'loading':
+            abort(409, "Document %s is still loading" % documentId)
+        if doc.loadState == 'failed':
+            abort(409, "Document %s failed to load: %s" % (documentId, doc.loadError))
+        return doc
+
+    def _getLoader(self):
+        with self.loaderLock:
+            if self.loader is None:
+                self.loader = ThreadPoolExecutor(max_workers=GlobalSettings.loadWorkers)
+            return self.loader
 
     def dump(self):
-        rv = '%d documents\n\n' % len(self.documents)
+        rv = '%d documents (%d in memory)\n\n' % (len(self.documents), len(self.documents.values()))
 
-        for k in self.documents:
-            rv += '%s:\n%s\n' % (k, self.documents[k].dump())
+        for k, d in self.documents.items():
+            rv += '%s:\n%s\n' % (k, d.dump())
 
         return rv
 
+    def _registerMetrics(self):
+        """Compute the document gauges only when the metrics are rendered"""
+        metrics.DOCUMENTS.setFunction(self._documentCounts)
+        metrics.ELEMENTS.setFunction(self._elementCount)
+        metrics.HISTORY_ENTRIES.setFunction(self._historyEntryCount)
+        metrics.REGISTRY.addCollector(self._lockMetrics)
+
+    def _documentCounts(self):
+        resident = len(self.documents.values())
+        return [(('memory',), resident), (('spilled',), len(self.documents) - resident)]
+
+    def _elementCount(self):
+        return sum(doc.elementCount() for doc in self.documents.values() if doc.loadState == 'loaded')
+
+    def _historyEntryCount(self):
+        return sum(len(doc.serveHandler.operationHistory.entries) for doc in self.documents.values() if doc.serveHandler)
+
+    def _lockMetrics(self):
+        """Export the lock profiling histograms, if lock profiling is enabled"""
+        if not lockprofile.isEnabled():
+            return []
+        rv = []
+        locks = lockprofile.getStats()['locks']
+        for which in ('wait', 'hold'):
+            name = 'authoring_lock_%s_seconds' % which
+            rv += ['# HELP %s Time spent %s locks, per kind of lock' % (name, 'waiting for' if which == 'wait' else 'holding'), '# TYPE %s histogram' % name]
+            for lockName in sorted(locks):
+                histogram = locks[lockName][which]
+                rv += metrics.renderHistogram(name, ('lock',), (lockName,), histogram['buckets'], histogram['counts'], histogram['sum'])
+        return rv
+
+    def metrics(self):
+        """Return operational metrics in the Prometheus text exposition format"""
+        return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
+    def lockstats(self):
+        """Return lock wait and hold time statistics"""
+        return jsonify(lockprofile.getStats())
+
     def document(self):
         if request.method == 'POST':
-            documentId = uuid.uuid4()
+            # In multi-process mode the router sends requests to the worker that owns the documentId
+            documentId = router.newDocumentId(GlobalSettings.workerIndex, GlobalSettings.workerCount)
             doc = document.Document(documentId)
+            if self.store:
+                doc.setStore(self.store)
 
-            if 'url' in request.args:
+            if 'url' in request.args and request.args.get('async') in ('1', 'true', 'yes'):
+                # Load in the background. Clients poll (or wait on) /document/<id>/state.
+                doc.setLoading()
+                self.documents[documentId] = doc
+                self._getLoader().submit(doc.loadInBackground, request.args['url'])
+                rv = jsonify(documentId=documentId, state=doc.loadState)
+                rv.status_code = 202
+                return rv
+            elif 'url' in request.args:
                 doc.load(request.args['url'])
             elif request.files and request.files["document"]:
                 docstream = request.files["document"].stream
@@ -52,9 +162,8 @@ class API(object):
             return jsonify(documentId=documentId)
 
         rv = []
-        for k, d in list(self.documents.items()):
-            descr = d.getDescription()
-            rv.append(dict(id=k, description=descr))
+        for k, descr, state in self.documents.getDescriptions():
+            rv.append(dict(id=k, description=descr, state=state))
         return jsonify(rv)
 
 api = API()
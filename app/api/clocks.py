@@ -18,9 +18,13 @@ from future import standard_library
 standard_library.install_aliases()
 from builtins import object
 import time
-import queue
+import heapq
+import asyncio
 import threading
 import functools
+import logging
+from . import lockprofile
+from . import metrics
 
 @functools.total_ordering
 class NeverSmaller(object):
@@ -42,6 +46,8 @@ assert 0 < never
 assert never > time.time()
 assert time.time() < never
 
+logger = logging.getLogger(__name__)
+
 DEBUG_LOCKING = False
 # threading._VERBOSE=True
 
@@ -72,7 +78,10 @@ if DEBUG_LOCKING:
         def __exit__(self, *args):
             self.release()
 else:
-    ClockLock = threading.RLock
+    def ClockLock():
+        if lockprofile.isEnabled():
+            return lockprofile.ProfiledRLock('clock')
+        return threading.RLock()
 
 def synchronized(method):
     """Annotate a mthod to use the object lock"""
@@ -82,7 +91,10 @@ def synchronized(method):
     return wrapper
 
 class PausableClock(object):
-    """A clock (based on another clock) that can be pasued and resumed"""
+    """A clock (based on another clock) that can be pasued and resumed.
+
+    Modifications are done with the lock held. They end by publishing (running, epoch, underlyingClock)
+    as a single tuple in self.state, so now() and getRate() can read a consistent state without locking."""
     def __init__(self, underlyingClock, startRunning = False):
         self.epoch = 0
         self.running = startRunning
@@ -90,11 +102,17 @@ class PausableClock(object):
         self.originalUnderlyingClock = underlyingClock
         self.replacementTime = None
         self.lock = ClockLock()
+        self._publish()
+
+    def _publish(self):
+        self.state = (self.running, self.epoch, self.underlyingClock)
 
-    @synchronized
     def now(self):
         """Return current time of the clock"""
-        return self._now()
+        running, epoch, underlyingClock = self.state
+        if not running:
+            return epoch
+        return underlyingClock.now() - epoch
 
     def _now(self):
         if not self.running:
@@ -118,6 +136,8 @@ class PausableClock(object):
         if not self.running:
             self.epoch = self.underlyingClock.now() - self.epoch
             self.running = True
+            self._publish()
+            self._timingChanged()
 
     @synchronized
     def stop(self):
@@ -125,10 +145,13 @@ class PausableClock(object):
         if self.running:
             self.epoch = self.underlyingClock.now() - self.epoch
             self.running = False
+            self._publish()
+            self._timingChanged()
 
     def getRate(self):
-        if self.running:
-            return self.underlyingClock.getRate()
+        running, _, underlyingClock = self.state
+        if running:
+            return underlyingClock.getRate()
         return 0.0
 
     @synchronized
@@ -136,51 +159,302 @@ class PausableClock(object):
         """Set the underlying clock aside and temporarily use newClock as our underlying clock"""
         assert newClock
         assert self.underlyingClock == self.originalUnderlyingClock
-        wasRunning = self.running
-        self.stop()  # This also stores current time in self.epoch
-        self.underlyingClock = newClock
         self.replacementTime = self._now()
-        if wasRunning:
-            self.start()    # This starts the clock running at the place it was
+        # Continue at the current time, on the new clock
+        self._rebase(newClock, self.replacementTime)
+        self._publish()
+        self._timingChanged()
 
     @synchronized
     def restoreUnderlyingClock(self, restoreTime):
         """Restore the underlying clock from the previous call to replaceUnderlying Clock. Reset clock is restoreTime is true.
         Always return the clock adjustment (even when not restoring the time)."""
         assert self.underlyingClock != self.originalUnderlyingClock
-        adjustment = 0
-        wasRunning = self.running
-        self.stop()
+        now = self._now()
         # Compute how far we have moved time forward while running on the replacement
         # clock, and then possibly adjust accordingly
-        adjustment = self.replacementTime - self._now()
+        adjustment = self.replacementTime - now
         if restoreTime:
-            self._adjust(adjustment)
-        self.underlyingClock = self.originalUnderlyingClock
-
-        if wasRunning:
-            self.start()    # This starts the clock running at the place it was
+            self._moveCallbacks(adjustment)
+            now += adjustment
+        self._rebase(self.originalUnderlyingClock, now)
+        self._publish()
+        self._timingChanged()
         return adjustment
 
     @synchronized
     def set(self, now):
-        wasRunning = self.running
-        self.stop()
-        self.epoch = now
-        if wasRunning:
-            self.start()
+        self._rebase(self.underlyingClock, now)
+        self._publish()
+        self._timingChanged()
+
+    def _rebase(self, underlyingClock, now):
+        """Make the clock continue from time now, running on underlyingClock. Call with the lock held,
+        and publish afterwards: readers only ever see the state before or after the whole change."""
+        self.underlyingClock = underlyingClock
+        if self.running:
+            self.epoch = underlyingClock.now() - now
+        else:
+            self.epoch = now
 
     def _adjust(self, adjustment):
+        self._moveCallbacks(adjustment)
         self.epoch += adjustment
+        self._publish()
+        self._timingChanged()
+
+    def _moveCallbacks(self, adjustment):
+        """Called (with the lock held) when the clock time is adjusted, subclasses move their scheduled callbacks"""
+        pass
+
+    def _timingChanged(self):
+        """Called (with the lock held) when the clock is started, stopped, set or adjusted"""
+        pass
+
+class SlewingClock(PausableClock):
+    """A pausable clock with a playback rate, that can also be moved gradually (slewed) in stead of jumping.
+    While a slew is in progress the clock runs slewRate (a fraction of the underlying clock rate) faster
+    or slower than normal, until the whole adjustment has been applied. A stopped clock is adjusted immediately.
+
+    While running, time is computed from an anchor: the clock time and underlying time of the last change.
+    While stopped, epoch is the clock time (as in PausableClock)."""
+
+    def __init__(self, underlyingClock, startRunning = False, rate=1.0, slewRate=0.1):
+        self.rate = rate
+        self.slewRate = slewRate
+        self.slewRemaining = 0
+        self.anchorUnderlying = underlyingClock.now()
+        self.anchorTime = 0
+        PausableClock.__init__(self, underlyingClock, startRunning)
+
+    def _getState(self):
+        return (self.running, self.epoch, self.underlyingClock, self.anchorUnderlying, self.anchorTime, self.rate, self.slewRemaining, self.slewRate)
+
+    def _publish(self):
+        self.state = self._getState()
+
+    @staticmethod
+    def _timeFromState(state, underlyingNow):
+        """Return (clock time, slew adjustment already applied) for the given state at underlying time underlyingNow"""
+        running, epoch, _, anchorUnderlying, anchorTime, rate, slewRemaining, slewRate = state
+        if not running:
+            return epoch, 0
+        elapsed = underlyingNow - anchorUnderlying
+        slewed = 0
+        if slewRemaining:
+            slewed = min(abs(slewRemaining), slewRate * elapsed)
+            if slewRemaining < 0:
+                slewed = -slewed
+        return anchorTime + rate * elapsed + slewed, slewed
+
+    def now(self):
+        """Return current time of the clock"""
+        state = self.state
+        if not state[0]:
+            return state[1]
+        return self._timeFromState(state, state[2].now())[0]
+
+    def _now(self):
+        return self.now()
+
+    def getRate(self):
+        running, _, underlyingClock, anchorUnderlying, _, rate, slewRemaining, slewRate = self.state
+        if not running:
+            return 0.0
+        if slewRemaining and abs(slewRemaining) > slewRate * (underlyingClock.now() - anchorUnderlying):
+            rate += slewRate if slewRemaining > 0 else -slewRate
+        return underlyingClock.getRate() * rate
+
+    def _reanchor(self):
+        """Make the current time the anchor, taking out the part of the slew that has been applied. Readers
+        can keep using the published state, it gives the same times, so this does not publish."""
+        if not self.running:
+            return
+        underlyingNow = self.underlyingClock.now()
+        self.anchorTime, slewed = self._timeFromState(self._getState(), underlyingNow)
+        self.anchorUnderlying = underlyingNow
+        self.slewRemaining -= slewed
+
+    def _rebase(self, underlyingClock, now):
+        if self.running:
+            # Keep the part of the slew that has not been applied yet
+            _, slewed = self._timeFromState(self._getState(), self.underlyingClock.now())
+            self.slewRemaining -= slewed
+            self.anchorUnderlying = underlyingClock.now()
+            self.anchorTime = now
+        else:
+            self.epoch = now
+        self.underlyingClock = underlyingClock
+
+    @synchronized
+    def offsetFromUnderlyingClock(self):
+        """Return offset by which the current time of the clock is greater than the current time of the underlying clock"""
+        return self._now() - self.underlyingClock.now()
+
+    @synchronized
+    def start(self):
+        """Start the clock running"""
+        if not self.running:
+            self.anchorUnderlying = self.underlyingClock.now()
+            self.anchorTime = self.epoch
+            self.running = True
+            self._publish()
+            self._timingChanged()
+
+    @synchronized
+    def stop(self):
+        """Stop the clock. A slew in progress is continued when the clock is started again."""
+        if self.running:
+            self.epoch = self._now()
+            self._reanchor()
+            self.running = False
+            self._publish()
+            self._timingChanged()
+
+    @synchronized
+    def set(self, now):
+        """Set the clock time (jumping), cancelling any slew in progress"""
+        self._reanchor()
+        self.slewRemaining = 0
+        if self.running:
+            self.anchorTime = now
+        else:
+            self.epoch = now
+        self._publish()
+        self._timingChanged()
+
+    @synchronized
+    def setRate(self, rate):
+        """Set the playback rate, relative to the underlying clock"""
+        self._reanchor()
+        self.rate = rate
+        self._publish()
+        self._timingChanged()
+
+    @synchronized
+    def slew(self, adjustment):
+        """Move the clock adjustment seconds forward (or backward, if negative) gradually"""
+        if not self.running:
+            self._adjust(adjustment)
+            return
+        self._reanchor()
+        self.slewRemaining += adjustment
+        self._publish()
+        self._timingChanged()
+
+    @synchronized
+    def slewTo(self, now, maxSlew=None):
+        """Move the clock gradually so it converges to a clock that reads now at this moment, replacing any
+        slew in progress. If that takes a jump of more than maxSlew seconds the clock is set in stead."""
+        self._reanchor()
+        self.slewRemaining = 0
+        adjustment = now - self._now()
+        if maxSlew is not None and abs(adjustment) > maxSlew:
+            self.set(now)
+        else:
+            self.slew(adjustment)
+
+    @synchronized
+    def isSlewing(self):
+        self._reanchor()
+        return self.running and self.slewRemaining != 0
+
+    def _adjust(self, adjustment):
+        if self.running:
+            self._reanchor()
+            self.anchorTime += adjustment
+        else:
+            self.epoch += adjustment
+        self._publish()
+        self._timingChanged()
+
+class ScheduledCallback(object):
+    """Handle for a callback scheduled on a CallbackPausableClock, pass to cancel() to cancel it"""
+    __slots__ = ('callback', 'args', 'kwargs', 'pending')
+
+    def __init__(self, callback, args, kwargs):
+        self.callback = callback
+        self.args = args
+        self.kwargs = kwargs
+        self.pending = True
+
+    def __repr__(self):
+        return '<ScheduledCallback %r%s>' % (self.callback, '' if self.pending else ' (done)')
+
+class CallbackScheduler(object):
+    """Binary heap of scheduled callbacks. Times in the heap are relative to offset, so adjusting the
+    time of all callbacks is O(1). Cancelled callbacks stay in the heap until they reach the top, or
+    until they make up more than half of it. Not thread-safe: the clock protects it with its lock."""
+
+    COMPACT_MINIMUM = 64
+
+    def __init__(self):
+        self.heap = []  # (time - offset, generation, ScheduledCallback)
+        self.offset = 0
+        self.generation = 0  # Insertion order, for callbacks with the same time (and so tuples never compare handles)
+        self.cancelled = 0
+
+    def __len__(self):
+        return len(self.heap) - self.cancelled
+
+    def add(self, timestamp, callback, args, kwargs):
+        handle = ScheduledCallback(callback, args, kwargs)
+        heapq.heappush(self.heap, (timestamp - self.offset, self.generation, handle))
+        self.generation += 1
+        return handle
+
+    def cancel(self, handle):
+        """Cancel a callback, return False if it has already run or been cancelled"""
+        if not handle.pending:
+            return False
+        handle.pending = False
+        self.cancelled += 1
+        if self.cancelled > self.COMPACT_MINIMUM and 2*self.cancelled > len(self.heap):
+            self.heap = [entry for entry in self.heap if entry[2].pending]
+            heapq.heapify(self.heap)
+            self.cancelled = 0
+        return True
+
+    def _prune(self):
+        heap = self.heap
+        while heap and not heap[0][2].pending:
+            heapq.heappop(heap)
+            self.cancelled -= 1
+
+    def peekTime(self):
+        """Return time of the earliest callback, or None"""
+        self._prune()
+        if not self.heap:
+            return None
+        return self.heap[0][0] + self.offset
+
+    def pop(self):
+        """Remove the earliest callback and return (time, handle)"""
+        self._prune()
+        t, _, handle = heapq.heappop(self.heap)
+        handle.pending = False
+        return t + self.offset, handle
+
+    def adjust(self, adjustment):
+        self.offset += adjustment
+
+    def clear(self):
+        """Remove all callbacks, return how many there were"""
+        count = len(self)
+        for _, _, handle in self.heap:
+            handle.pending = False
+        self.heap = []
+        self.cancelled = 0
+        return count
 
 class CallbackPausableClock(PausableClock):
     """A pausable clock that also stores callbacks with certain times"""
 
     def __init__(self, underlyingClock, startRunning = False):
         PausableClock.__init__(self, underlyingClock, startRunning)
-        self.queue = queue.PriorityQueue()
-        self.generation = 0 # Total ordered number of insertion into queue. Used to forestall py3 comparing methods.
+        self.scheduler = CallbackScheduler()
         self.queueChanged = None
+        self.driver = None
 
     def setQueueChangedCallback(self, callback):
         self.queueChanged = callback
@@ -188,23 +462,16 @@ class CallbackPausableClock(PausableClock):
     @synchronized
     def nextEventTime(self, default=never):
         """Return delta-T until earliest callback, or never"""
-        try:
-            peek = self.queue.get(False)
-        except queue.Empty:
+        t = self.scheduler.peekTime()
+        if t is None:
             return default
-        self.queue.put(peek)
-        t, _, callback, args, kwargs = peek
         return t-self._now()
 
     def sleepUntilNextEvent(self):
-        """Sleep until next callback, return True if we actually slept. Do not use with multithreading."""
-        try:
-            peek = self.queue.get(False)
-        except queue.Empty:
-            assert 0, "No events are forthcoming"
-        assert peek, "No events are forthcoming"
-        self.queue.put(peek)
-        t, _, callback, args, kwargs = peek
+        """Sleep until next callback, return True if we actually slept. Do not use with multithreading, use ClockDriver in stead."""
+        with self.lock:
+            t = self.scheduler.peekTime()
+        assert t is not None, "No events are forthcoming"
         delta = t-self.now()
         if delta > 0:
             self.underlyingClock.sleep(delta)
@@ -212,75 +479,126 @@ class CallbackPausableClock(PausableClock):
         return False
 
     def schedule(self, delay, callback, *args, **kwargs):
-        """Schedule a callback"""
-        self.scheduleAt(self.now()+delay, callback, *args, **kwargs)
+        """Schedule a callback, return a handle that can be passed to cancel()"""
+        with self.lock:
+            timestamp = self._now()+delay
+        return self.scheduleAt(timestamp, callback, *args, **kwargs)
 
     def scheduleAt(self, timestamp, callback, *args, **kwargs):
-        """Schedule a callback"""
-        assert not self.queue.full()
-        self.queue.put((timestamp, self.generation, callback, args, kwargs))
-        self.generation += 1
+        """Schedule a callback, return a handle that can be passed to cancel()"""
+        with self.lock:
+            handle = self.scheduler.add(timestamp, callback, args, kwargs)
+            self._timingChanged()
         if self.queueChanged:
             self.queueChanged()
+        return handle
+
+    @synchronized
+    def cancel(self, handle):
+        """Cancel a scheduled callback. Returns False if it has already run or been cancelled."""
+        return self.scheduler.cancel(handle)
 
     @synchronized
     def flushEvents(self):
-        count = 0
-        while True:
-            try:
-                peek = self.queue.get(False)
-                count += 1
-            except queue.Empty:
-                break
-        return count
+        return self.scheduler.clear()
                 
     @synchronized
     def handleEvents(self, handler):
         """Retrieve all callbacks that are runnable"""
+        for handle in self._popRunnable():
+            handler.schedule(handle.callback, *handle.args, **handle.kwargs)
+
+    @synchronized
+    def _popRunnable(self):
+        """Remove and return the handles of all callbacks that are runnable, recording how late they are"""
+        rv = []
+        scheduler = self.scheduler
+        now = self._now()
         while True:
-            try:
-                peek = self.queue.get(False)
-            except queue.Empty:
-                return
-            if not peek:
-                return
-            t, _, callback, args, kwargs = peek
-            if self._now() >= t:
-                if self._now() > t + 0.1:
-                    print('xxxjack scheduling', self.now() - t, 'seconds too late...')
-                handler.schedule(callback, *args, **kwargs)
-            else:
-                assert not self.queue.full()
-                self.queue.put(peek)
-                return
+            t = scheduler.peekTime()
+            if t is None or t > now:
+                return rv
+            _, handle = scheduler.pop()
+            lateness = now - t
+            metrics.CALLBACK_LATENESS.observe(lateness)
+            if lateness > 0.1:
+                metrics.LATE_CALLBACKS.inc()
+            rv.append(handle)
 
     @synchronized
     def dumps(self):
-        rv = "%d events" % self.queue.qsize()
-        try:
-            peek = self.queue.get(False)
-        except queue.Empty:
-            peek = None
-        if peek:
-            t, _, callback, args, kwargs = peek
+        rv = "%d events" % len(self.scheduler)
+        t = self.scheduler.peekTime()
+        if t is not None:
             rv += ", next in %f seconds" % (t-self._now())
-            self.queue.put(peek)
         return rv
 
-    def _adjust(self, adjustment):
-        # First get all the queued events
-        qContents = []
+    def _moveCallbacks(self, adjustment):
+        # All events move with the clock
+        self.scheduler.adjust(adjustment)
+
+    def _timingChanged(self):
+        # Also called when a callback is scheduled: the driver has to recompute its deadline
+        if self.driver:
+            self.driver.wakeup()
+
+class ClockDriver(threading.Thread):
+    """Thread that runs the callbacks of a CallbackPausableClock when they are due, so nobody has to
+    poll handleEvents(). It sleeps until the earliest deadline, and is woken early when an earlier
+    callback is scheduled or the clock is started, stopped or adjusted. While the clock is stopped it
+    sleeps until the clock is started. Callbacks are run on this thread, or passed to
+    handler.schedule(callback, *args, **kwargs) if a handler is given.
+
+    Deadlines are converted to real time with the rate of the clock, so the underlying clock should
+    run in real time (SystemClock)."""
+
+    def __init__(self, clock, handler=None):
+        threading.Thread.__init__(self, name='clock-driver')
+        self.daemon = True
+        self.clock = clock
+        self.handler = handler
+        self.condition = threading.Condition(threading.Lock())
+        self.woken = False
+        self.running = True
+        assert clock.driver is None
+        clock.driver = self
+
+    def wakeup(self):
+        with self.condition:
+            self.woken = True
+            self.condition.notify()
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        if self.clock.driver is self:
+            self.clock.driver = None
+
+    def run(self):
         while True:
-            try:
-                qContents.append(self.queue.get(False))
-            except queue.Empty:
-                break
-        # Now adjust the clock itself
-        PausableClock._adjust(self, adjustment)
-        # Now re-insert all events with adjusted times
-        for t, generation, callback, args, kwargs in qContents:
-            t += adjustment
-            self.queue.put((t, generation, callback, args, kwargs))
+            for handle in self.clock._popRunnable():
+                self._run(handle)
+            delta = self.clock.nextEventTime()
+            rate = self.clock.getRate()
+            with self.condition:
+                if not self.running:
+                    return
+                if not self.woken:
+                    if delta is never or rate <= 0:
+                        self.condition.wait()
+                    elif delta > 0:
+                        self.condition.wait(delta / rate)
+                self.woken = False
+
+    def _run(self, handle):
+        try:
+            if self.handler:
+                self.handler.schedule(handle.callback, *handle.args, **handle.kwargs)
+            else:
+                handle.callback(*handle.args, **handle.kwargs)
+        except:
+            logger.exception('clock callback %r raised exception' % handle.callback)
 
 class FastClock(object):
     def __init__(self):
@@ -313,3 +631,126 @@ class SystemClock(object):
 
     def getRate(self):
         return 1.0
+
+#
+# asyncio variants. The synchronous API (now, start, stop, schedule, ...) is the same, but all methods must be
+# called from the event loop thread, so these clocks do not lock. Waiting is done with awaitable methods.
+#
+
+class _NoLock(object):
+    """Stands in for the clock lock in clocks that are only used from the event loop"""
+    def acquire(self, blocking=True, timeout=-1):
+        return True
+
+    def release(self):
+        pass
+
+    def __enter__(self):
+        return True
+
+    def __exit__(self, *args):
+        pass
+
+class AsyncFastClock(FastClock):
+    """FastClock with an awaitable sleep"""
+
+    async def sleep(self, duration):
+        self._now += duration
+        await asyncio.sleep(0)
+
+class AsyncSystemClock(object):
+    """Clock that runs on the time of the asyncio event loop"""
+    def __init__(self, loop=None):
+        self.loop = loop
+
+    def now(self):
+        return (self.loop or asyncio.get_event_loop()).time()
+
+    async def sleep(self, duration):
+        await asyncio.sleep(duration)
+
+    def dumps(self):
+        return ""
+
+    def getRate(self):
+        return 1.0
+
+class AsyncPausableClock(PausableClock):
+    """PausableClock for use with asyncio, based on AsyncSystemClock or AsyncFastClock"""
+
+    def __init__(self, underlyingClock, startRunning = False):
+        PausableClock.__init__(self, underlyingClock, startRunning)
+        self._initAsync()
+
+    def _initAsync(self):
+        self.lock = _NoLock()
+        self.timingChangedEvent = None
+
+    def _timingChanged(self):
+        # Wake up everyone waiting in _waitForChange
+        if self.timingChangedEvent:
+            self.timingChangedEvent.set()
+            self.timingChangedEvent = None
+
+    async def _waitForChange(self, delay=None):
+        """Sleep for delay seconds of underlying clock time (or forever), or until the clock is started, stopped or adjusted"""
+        if self.timingChangedEvent is None:
+            self.timingChangedEvent = asyncio.Event()
+        waiters = [asyncio.ensure_future(self.timingChangedEvent.wait())]
+        if delay is not None:
+            waiters.append(asyncio.ensure_future(self.underlyingClock.sleep(delay)))
+        try:
+            await asyncio.wait(waiters, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            for waiter in waiters:
+                waiter.cancel()
+
+    async def sleep_until(self, timestamp):
+        """Return when the clock time is timestamp or later"""
+        while True:
+            delta = timestamp - self._now()
+            if delta <= 0 and self.running:
+                return
+            rate = self.getRate()
+            await self._waitForChange(delta / rate if rate > 0 else None)
+
+class AsyncCallbackPausableClock(AsyncPausableClock, CallbackPausableClock):
+    """CallbackPausableClock for use with asyncio. Callbacks can be coroutine functions.
+    Run the run() coroutine as a task to have the callbacks run when they are due."""
+
+    def __init__(self, underlyingClock, startRunning = False):
+        CallbackPausableClock.__init__(self, underlyingClock, startRunning)
+        self._initAsync()
+
+    async def sleepUntilNextEvent(self):
+        """Sleep until next callback, return True if we actually slept"""
+        t = self.scheduler.peekTime()
+        assert t is not None, "No events are forthcoming"
+        if t <= self._now():
+            return False
+        await self.sleep_until(t)
+        return True
+
+    async def run(self, handler=None):
+        """Run callbacks when they are due, until cancelled. Callbacks are run in this task (coroutine
+        callbacks in a new task), or passed to handler.schedule(callback, *args, **kwargs) if a handler is given."""
+        while True:
+            for handle in self._popRunnable():
+                self._run(handle, handler)
+            delta = self.nextEventTime()
+            rate = self.getRate()
+            if delta is never or rate <= 0:
+                await self._waitForChange()
+            elif delta > 0:
+                await self._waitForChange(delta / rate)
+
+    def _run(self, handle, handler):
+        try:
+            if handler:
+                handler.schedule(handle.callback, *handle.args, **handle.kwargs)
+                return
+            rv = handle.callback(*handle.args, **handle.kwargs)
+            if asyncio.iscoroutine(rv):
+                asyncio.ensure_future(rv)
+        except:
+            logger.exception('clock callback %r raised exception' % handle.callback)
@@ -19,19 +19,27 @@ standard_library.install_aliases()
 from builtins import str
 from builtins import object
 from flask import Response, request, abort
+from werkzeug.exceptions import HTTPException
 from socketIO_client import SocketIO, SocketIONamespace
 import urllib.request, urllib.error, urllib.parse
 import json
 import copy
+import collections
 import xml.etree.ElementTree as ET
 import re
 import threading
 import os
 import sys
 import time
+import uuid
 import requests
 from .globalSettings import GlobalSettings
 from . import clocks
+from . import locking
+from . import lockprofile
+from . import forwarder
+from . import httpcache
+from . import metrics
 
 import logging
 logger = logging.getLogger(__name__)
@@ -90,10 +98,58 @@ NAMESPACES.update(NS_AUTH.ns())
 for k, v in list(NAMESPACES.items()):
     ET.register_namespace(k, v)
 
+# Attributes for which a Document keeps value-to-element indexes (see Document._getElementsByAttribute)
+INDEXED_ATTRIBUTES = (
+    NS_TRIGGER('name'),
+    NS_TRIGGER('productionId'),
+    NS_AUTH('type'),
+)
+
 # regular expression to decompose xml:id fields that end in a -number
 FIND_ID_INDEX = re.compile(r'(.+)-([0-9]+)')
 FIND_NAME_INDEX = re.compile(r'(.+) \(([0-9]+)\)')
 FIND_PATH_ATTRIBUTE = re.compile(r'(.+)/@([a-zA-Z0-9_\-.:]+)')
+# regular expression for a single step of the absolute, indexed XPaths we generate ourselves
+# (/tag[n], with tag either in {namespace}local form or in prefix:local form)
+FIND_PATH_STEP = re.compile(r'/(\{[^}]*\}[^/\[\]{}]+|[a-zA-Z_][a-zA-Z0-9_\-.]*(?::[a-zA-Z_][a-zA-Z0-9_\-.]*)?)(?:\[([1-9][0-9]*)\])?')
+
+# Cache of compiled paths (see _compilePath)
+COMPILED_PATHS = {}
+COMPILED_PATHS_MAX = 10000
+
+
+def _compilePath(path):
+    """Compile an absolute path of simple steps into a tuple of (tag, index) tuples.
+    Index is None for steps without a position predicate.
+    Returns None if the path is a more complex XPath expression."""
+    try:
+        return COMPILED_PATHS[path]
+    except KeyError:
+        pass
+    steps = []
+    pos = 0
+    while pos < len(path):
+        match = FIND_PATH_STEP.match(path, pos)
+        if not match:
+            steps = None
+            break
+        tag, index = match.group(1), match.group(2)
+        if tag[:1] != '{' and ':' in tag:
+            prefix, local = tag.split(':')
+            if prefix not in NAMESPACES:
+                steps = None
+                break
+            tag = '{%s}%s' % (NAMESPACES[prefix], local)
+        steps.append((tag, int(index) if index else None))
+        pos = match.end()
+    if not steps:
+        steps = None
+    else:
+        steps = tuple(steps)
+    if len(COMPILED_PATHS) >= COMPILED_PATHS_MAX:
+        COMPILED_PATHS.clear()
+    COMPILED_PATHS[path] = steps
+    return steps
 
 
 # Decorator: obtain self.lock during the operation
@@ -105,6 +161,16 @@ def synchronized(method):
     return wrapper
 
 
+# Decorator: obtain self.lock in shared mode during the operation. For methods that do not modify the document:
+# they can run at the same time as other such methods, but not at the same time as modifications.
+def synchronizedRead(method):
+    """Annotate a read-only method to use the object lock in shared mode"""
+    def wrapper(self, *args, **kwargs):
+        with self.lock.reading():
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
 # Decorator: obtain self.lock during the operation, and record all edits
 def edit(method):
     """Annotate a mthod to use the object lock and record the results."""
@@ -126,12 +192,233 @@ def edit(method):
     return wrapper
 
 
+ID_ATTRIBUTE = NS_XML('id')
+NAME_ATTRIBUTE = NS_TRIGGER('name')
+EVENTS_TAG = NS_TRIGGER('events')
+
+# Approximate memory use (in bytes) of an element (including its entries in the document
+# indexes), an attribute, and an entry in the operation history. Used by approximateSize().
+ELEMENT_OVERHEAD = 600
+ATTRIBUTE_OVERHEAD = 150
+OPERATION_OVERHEAD = 250
+
+class DocumentParser(object):
+    """Single-pass document loader. Parses XML incrementally and builds the parent map, id map,
+    name set, attribute indexes and list of tt:events parents while parsing, in stead of in
+    separate passes over the tree afterwards."""
+
+    CHUNK_SIZE = 64*1024
+
+    def __init__(self, indexedAttributes, maxSize=None, progressCallback=None, tooLargeCallback=None):
+        self.parser = ET.XMLPullParser(events=('start', 'end'))
+        self.indexedAttributes = indexedAttributes
+        self.maxSize = maxSize
+        self.progressCallback = progressCallback
+        self.tooLargeCallback = tooLargeCallback
+        self.bytesRead = 0
+        self.elementCount = 0
+        self.root = None
+        self.stack = []
+        self.parentMap = {}
+        self.idMap = {}
+        self.nameSet = set()
+        self.attributeIndex = {attr: {} for attr in indexedAttributes}
+        self.attributeElements = {attr: {} for attr in indexedAttributes}
+        self.eventParents = []
+
+    def parseFile(self, fp):
+        """Parse everything from file object fp, returns root element"""
+        while True:
+            data = fp.read(self.CHUNK_SIZE)
+            if not data:
+                break
+            self.feed(data)
+        return self.close()
+
+    def feed(self, data):
+        self.bytesRead += len(data)
+        if self.maxSize and self.bytesRead > self.maxSize:
+            # Reject oversized input before parsing (and storing) all of it
+            if self.tooLargeCallback:
+                self.tooLargeCallback(self.bytesRead)
+            raise ET.ParseError("document larger than %d bytes" % self.maxSize)
+        self.parser.feed(data)
+        self._processEvents()
+        if self.progressCallback:
+            self.progressCallback(self.bytesRead, self.elementCount)
+
+    def close(self):
+        """Finish parsing, returns root element"""
+        self.parser.close()
+        self._processEvents()
+        if self.root is None:
+            raise ET.ParseError("no element found")
+        return self.root
+
+    def _processEvents(self):
+        stack = self.stack
+        parentMap = self.parentMap
+        for event, elt in self.parser.read_events():
+            if event == 'end':
+                stack.pop()
+                continue
+            if stack:
+                parent = stack[-1]
+                parentMap[elt] = parent
+                if elt.tag == EVENTS_TAG and parent not in self.eventParents:
+                    self.eventParents.append(parent)
+            else:
+                self.root = elt
+            stack.append(elt)
+            self.elementCount += 1
+            attrib = elt.attrib
+            if not attrib:
+                continue
+            id = attrib.get(ID_ATTRIBUTE)
+            if id:
+                self.idMap[id] = elt
+            name = attrib.get(NAME_ATTRIBUTE)
+            if name:
+                self.nameSet.add(name)
+            for attr in self.indexedAttributes:
+                value = attrib.get(attr)
+                if value is not None:
+                    self.attributeElements[attr][elt] = value
+                    self.attributeIndex[attr].setdefault(value, {})[elt] = True
+
+class SaveView(object):
+    """Read-only view of an element and its descendants as they should be saved: tls: attributes and
+    tt:_realDur are left out, tl:dur is taken from tt:_realDur if that is present and dropAttributes
+    are left out of this element. Behaves enough like an Element for the ElementTree serializer,
+    so the live tree can be written without making a copy of it first."""
+
+    __slots__ = ('element', 'dropAttributes')
+
+    INTERNAL_PREFIX = '{%s}' % NS_TIMELINE_INTERNAL.url
+    REAL_DUR = NS_TRIGGER("_realDur")
+    DUR = NS_TIMELINE("dur")
+
+    def __init__(self, element, dropAttributes=()):
+        self.element = element
+        self.dropAttributes = dropAttributes
+
+    @property
+    def tag(self):
+        return self.element.tag
+
+    @property
+    def text(self):
+        return self.element.text
+
+    @property
+    def tail(self):
+        return self.element.tail
+
+    def __len__(self):
+        return len(self.element)
+
+    def __iter__(self):
+        for ch in self.element:
+            yield SaveView(ch)
+
+    def iter(self, tag=None):
+        for e in self.element.iter(tag):
+            if e is self.element:
+                yield self
+            else:
+                yield SaveView(e)
+
+    def items(self):
+        realDur = self.element.get(self.REAL_DUR)
+        rv = []
+        for k, v in self.element.items():
+            if k.startswith(self.INTERNAL_PREFIX) or k == self.REAL_DUR or k in self.dropAttributes:
+                continue
+            if realDur and k == self.DUR:
+                v = realDur
+                realDur = None
+            rv.append((k, v))
+        if realDur:
+            rv.append((self.DUR, realDur))
+        return rv
+
+    def keys(self):
+        return [k for k, v in self.items()]
+
+    def get(self, key, default=None):
+        for k, v in self.items():
+            if k == key:
+                return v
+        return default
+
+class OperationHistory(object):
+    """Operations forwarded per generation, for clients that missed some broadcasts. Only the
+    last window generations are kept: older ones are compacted into the timeline.xml document
+    itself, so clients that need those must refetch the timeline document."""
+
+    def __init__(self, window=None):
+        self.window = window if window is not None else GlobalSettings.historyWindow
+        self.entries = collections.deque()  # (generation, operations) for generations that have operations
+        self.baseGeneration = -1  # Generations up to and including this one have been compacted
+        self.lastGeneration = -1
+
+    def __iter__(self):
+        return iter(self.entries)
+
+    def __len__(self):
+        return self.lastGeneration + 1
+
+    def add(self, generation, operations):
+        assert generation > self.lastGeneration
+        self.lastGeneration = generation
+        if operations:
+            self.entries.append((generation, operations))
+        self._compact()
+
+    def _compact(self):
+        newBase = self.lastGeneration - self.window
+        if newBase <= self.baseGeneration:
+            return
+        while self.entries and self.entries[0][0] <= newBase:
+            self.entries.popleft()
+        self.baseGeneration = newBase
+
+    def get(self, oldest):
+        """Return list of (generation, operations) from generation oldest onwards (including generations
+        without operations), or None if generation oldest has been compacted away."""
+        if oldest <= self.baseGeneration:
+            return None
+        rv = []
+        nextGeneration = oldest
+        for generation, operations in self.entries:
+            if generation < oldest:
+                continue
+            while nextGeneration < generation:
+                rv.append((nextGeneration, []))
+                nextGeneration += 1
+            rv.append((generation, operations))
+            nextGeneration = generation + 1
+        while nextGeneration <= self.lastGeneration:
+            rv.append((nextGeneration, []))
+            nextGeneration += 1
+        return rv
+
+    def getState(self):
+        return dict(base=self.baseGeneration, last=self.lastGeneration, entries=list(self.entries))
+
+    def setState(self, state):
+        self.baseGeneration = state['base']
+        self.lastGeneration = state['last']
+        self.entries = collections.deque(tuple(item) for item in state['entries'])
+        self._compact()
+
 class EditManager(object):
     """Helper class to collect sets of operations, sort of a simplified transaction mechanism"""
     def __init__(self, document, reason=None):
         self.document = document
         self.reason = reason
         self.commandList = []
+        self.journalList = []  # commandList plus local (not forwarded) changes, in order, for the persistent journal
         self.document.lock.acquire()
 
     def add(self, element, parent):
@@ -141,18 +428,26 @@ class EditManager(object):
         parentPos = list(parent).index(element)
         if parentPos > 0:
             prevSibling = parent[parentPos-1]
-            self.commandList.append(dict(verb='add', path=self.document._getXPath(prevSibling), where='after', data=content))
+            self._append(dict(verb='add', path=self.document._getXPath(prevSibling), where='after', data=content))
         else:
-            self.commandList.append(dict(verb='add', path=self.document._getXPath(parent), where='begin', data=content))
+            self._append(dict(verb='add', path=self.document._getXPath(parent), where='begin', data=content))
 
     def delete(self, element, parent):
         """Called just before an element is about to be deleted.
         At time of call, the element is still present in the tree."""
-        self.commandList.append(dict(verb='delete', path=self.document._getXPath(element)))
+        self._append(dict(verb='delete', path=self.document._getXPath(element)))
 
     def change(self, elt):
         """Called when the attributes of an element have been changed."""
-        self.commandList.append(dict(verb='change', path=self.document._getXPath(elt), attrs=json.dumps(elt.attrib)))
+        self._append(dict(verb='change', path=self.document._getXPath(elt), attrs=json.dumps(elt.attrib)))
+
+    def update(self, command):
+        """Called for a local change that is journaled but not forwarded"""
+        self.journalList.append(command)
+
+    def _append(self, command):
+        self.commandList.append(command)
+        self.journalList.append(command)
 
     def commit(self):
         """Close the edit manager and return its list of commands."""
@@ -176,6 +471,26 @@ class Document(object):
         self.parentMap = None
         self.idMap = None
         self.nameSet = None
+        self.xpathIndex = {}  # Maps elements to their (cached) XPath
+        self.xpathIndexLock = threading.Lock()  # Guards additions to xpathIndex, which readers make under the shared lock
+        self.indexedAttributes = INDEXED_ATTRIBUTES
+        self.attributeIndex = None  # attribute -> value -> elements with that attribute value
+        self.attributeElements = None  # attribute -> element -> value, for all elements with that attribute
+        # Modification bookkeeping, for caches of data derived from the tree
+        self.modificationGeneration = 0  # Incremented on every modification of the tree
+        self.modificationStamps = {}  # element -> generation of the last modification of its subtree
+        self.loadProgress = None  # While loading: dict(bytesRead, totalBytes, elements)
+        self.loadState = 'empty'  # One of 'empty', 'loading', 'loaded' or 'failed'
+        self.loadError = None
+        self.loadStateChanged = threading.Condition(threading.Lock())
+        # Persistence (see persistence.py): journal sequence number, and generation of the last snapshot
+        self.store = None
+        self.journalSeq = 0
+        self.snapshotGeneration = None
+        # Memory management (see registry.py): time of last use, and approximate size as (generation, bytes)
+        self.lastAccess = time.time()
+        self.sizeEstimate = None
+        self.instanceTag = uuid.uuid4().hex[:12]  # Distinguishes modificationGeneration values of different incarnations
         # handlers for the different views on the document
         self.eventsHandler = None
         self.authoringHandler = None
@@ -186,7 +501,8 @@ class Document(object):
         self.settingsHandler = None
         self.asyncHandler = None
         self.editingHandler = None
-        self.lock = threading.RLock()
+        self.lock = lockprofile.ProfiledReadWriteLock('document') if lockprofile.isEnabled() else locking.ReadWriteLock()
+        self.handlerLock = threading.RLock()  # Only for creating handlers, so readers can do that too
         self.editManager = None
         self.companionTimelineIsActive = False  # Mainly for warning triggertool operator if it is not
         self.lastErrorMessage = None
@@ -194,7 +510,7 @@ class Document(object):
         self.timeOpened = time.time()
         self.description = ''
         self._setDescription()
-        self.clock = clocks.PausableClock(clocks.SystemClock())
+        self.clock = clocks.SlewingClock(clocks.SystemClock(), slewRate=GlobalSettings.clockSlewRate)
         self._loggerExtra = dict(subSource='document', documentID=documentId)
         self.logger.info('created document %s' % documentId)
 
@@ -220,6 +536,50 @@ class Document(object):
     def getDescription(self):
         return "%s (%s)" % (self.description, str(self.documentId))
 
+    def touch(self):
+        """Record that the document is in use"""
+        self.lastAccess = time.time()
+
+    def isLive(self):
+        """Return True if live clients are connected to the document: timeline service callbacks, or the
+        websocket service. These connections do not survive a spill and restore."""
+        if self.serveHandler and self.serveHandler.callbacks:
+            return True
+        asyncHandler = self.asyncHandler
+        return asyncHandler is not None and asyncHandler.isConnected()
+
+    def approximateSize(self):
+        """Return an estimate of the memory used by the document in bytes. Recomputed only after modifications."""
+        cached = self.sizeEstimate
+        if cached is not None and cached[0] == self.modificationGeneration:
+            return cached[1]
+        with self.lock.reading():
+            generation = self.modificationGeneration
+            size = 0
+            if self.tree is not None:
+                for elt in self.tree.getroot().iter():
+                    size += ELEMENT_OVERHEAD + len(elt.text or '') + len(elt.tail or '')
+                    for k, v in elt.items():
+                        size += ATTRIBUTE_OVERHEAD + len(k) + len(v)
+            if self.serveHandler:
+                for gen, operations in self.serveHandler.operationHistory:
+                    size += OPERATION_OVERHEAD * (1 + len(operations))
+                    for operation in operations:
+                        size += len(operation.get('data', '')) + len(operation.get('attrs', ''))
+            self.sizeEstimate = (generation, size)
+        return size
+
+    def close(self):
+        """Stop the threads and connections of this document, it is no longer used"""
+        with self.lock:
+            asyncHandler = self.asyncHandler
+            self.asyncHandler = None
+            senders = list(self.serveHandler.callbackSenders.values()) if self.serveHandler else []
+        if asyncHandler:
+            asyncHandler.close()
+        for sender in senders:
+            sender.close()
+
     @synchronized
     def index(self):
         if request.method == 'PUT':
@@ -230,36 +590,38 @@ class Document(object):
                 self.load(request.args['url'])
                 return ''
         else:
-            return Response(ET.tostring(self._prepareForSave(), encoding=XML_ENCODING), mimetype="application/xml")
+            return Response(ET.tostring(self._saveView(), encoding=XML_ENCODING), mimetype="application/xml")
 
     @synchronized
-    def _documentLoaded(self):
-        """Creates paremtMap and idMap and various other data structures after loading a document."""
-        self.parentMap = {c: p for p in self.tree.iter() for c in p}
+    def _documentLoaded(self, parser):
+        """Installs the tree parsed by parser, with the parentMap, idMap and other data structures it has built."""
+        self.tree = ET.ElementTree(parser.root)
+        self.parentMap = parser.parentMap
+        self.xpathIndex = {}
+        self.modificationStamps = {}
+        self.modificationGeneration += 1
         # Workaround for XPath nastiness in ET: it does not handle / correctly so we help it a bit.
         self.documentElement = ET.Element('')
         self.documentElement.append(self.tree.getroot())
-        self.idMap = {}
-        self.nameSet = set()
-        for e in self.tree.iter():
-            id = e.get(NS_XML('id'))
-            if id:
-                self.idMap[id] = e
-            name = e.get(NS_TRIGGER('name'))
-            if name:
-                self.nameSet.add(name)
+        self.idMap = parser.idMap
+        self.nameSet = parser.nameSet
+        self.attributeIndex = parser.attributeIndex
+        self.attributeElements = parser.attributeElements
+        eventParents = parser.eventParents
         # Add attributes and elements that we need (mainly to communicate with the preview player timeline service)
         firstRootChild = list(self.tree.getroot())[0]
         firstRootChild.set(NS_TRIGGER("wantstatus"), "true")
         self._ensureId(firstRootChild)
         self._ensureId(self.tree.getroot())
-        for elt in self.tree.getroot().findall('.//tt:events/..', NAMESPACES):
+        for elt in eventParents:
             elt.set(NS_TRIGGER("wantstatus"), "true")
             self._ensureId(elt)
 
     @synchronized
-    def _ensureId(self, elt):
-        """Add an xml:id to an element if it doesn't have one already"""
+    def _ensureId(self, elt, register=True):
+        """Add an xml:id to an element if it doesn't have one already. For a new element pass register=False
+        and call this before _elementAdded(), which registers the id, so the id is part of the add operation
+        that is forwarded and journaled."""
         id = elt.get(NS_XML("id"))
         if id:
             return
@@ -272,7 +634,9 @@ class Document(object):
             else:
                 id = id + '-1'
         elt.set(NS_XML("id"), id)
-        self.idMap[id] = elt
+        if register:
+            self.idMap[id] = elt
+            self._elementModified(elt)
 
     @synchronized
     def _elementAdded(self, elt, parent, recursive=False):
@@ -287,10 +651,15 @@ class Document(object):
         name = elt.get(NS_TRIGGER('name'))
         if name:
             self.nameSet.add(name)
+        self._reindexElement(elt)
         for ch in elt:
             self._elementAdded(ch, elt, True)
-        if not recursive and self.editManager:
-            self.editManager.add(elt, parent)
+        if not recursive:
+            # Same-tag siblings after the new element have moved one position up
+            self._siblingsShifted(parent, elt.tag, after=elt)
+            self._elementModified(elt)
+            if self.editManager:
+                self.editManager.add(elt, parent)
 
     @synchronized
     def _elementDeleted(self, elt, recursive=False):
@@ -301,11 +670,23 @@ class Document(object):
             self.editManager.delete(elt, parent)
         del self.parentMap[elt]
         assert elt not in parent
+        if not recursive:
+            # Same-tag siblings after the deleted element have moved one position down
+            oldPath = self.xpathIndex.get(elt)
+            if oldPath is None:
+                self._siblingsShifted(parent, elt.tag)
+            else:
+                oldIndex = int(oldPath[oldPath.rindex('[')+1:-1])
+                self._siblingsShifted(parent, elt.tag, fromIndex=oldIndex)
+            self._elementModified(parent)
+        self._forgetXPaths(elt)
+        self.modificationStamps.pop(elt, None)
         id = elt.get(NS_XML('id'))
         if id and id in self.idMap:
             del self.idMap[id]
         # We do not remove tt:name, it may occur multiple times so we are not
         # sure it has really disappeared
+        self._unindexElement(elt)
         toDelete = [ch for ch in elt]
 
         for ch in toDelete:
@@ -316,9 +697,121 @@ class Document(object):
     def _elementChanged(self, elt):
         """Called when element attributes have changed.
         Returns edit operation which can be forwarded to slaved documents."""
+        self._reindexElement(elt)
+        self._elementModified(elt)
         if self.editManager:
             self.editManager.change(elt)
 
+    @synchronized
+    def _elementUpdated(self, elt):
+        """Called when element attributes have changed in a way that should not be forwarded to slaved
+        documents (for example state updates from the timeline service)"""
+        self._reindexElement(elt)
+        self._elementModified(elt)
+        if self.store:
+            command = dict(verb='change', path=self._getXPath(elt), attrs=json.dumps(elt.attrib), local=True)
+            if self.editManager:
+                self.editManager.update(command)
+            else:
+                self._journal([command], False)
+
+    @synchronized
+    def _elementDataChanged(self, elt):
+        """Called when the text of an element has changed. Text changes are not forwarded to slaved
+        documents, but they are journaled."""
+        self._elementModified(elt)
+        if self.store:
+            command = dict(verb='data', path=self._getXPath(elt), data=elt.text, local=True)
+            if self.editManager:
+                self.editManager.update(command)
+            else:
+                self._journal([command], False)
+
+    def _elementModified(self, elt):
+        """Record that elt (and therefore the subtrees of all its ancestors) has been modified"""
+        self.modificationGeneration += 1
+        generation = self.modificationGeneration
+        while elt is not None:
+            self.modificationStamps[elt] = generation
+            elt = self.parentMap.get(elt)
+
+    def _modifiedSince(self, elt, generation):
+        """Return True if the subtree of elt has been modified after the given generation"""
+        return self.modificationStamps.get(elt, 0) > generation
+
+    def _reindexElement(self, elt):
+        """Update the attribute indexes for elt, after it has been added or its attributes have changed.
+        Does not forward anything to slaved documents."""
+        for attr in self.indexedAttributes:
+            elements = self.attributeElements[attr]
+            oldValue = elements.get(elt)
+            newValue = elt.get(attr)
+            if oldValue == newValue:
+                continue
+            if oldValue is not None:
+                self._removeFromIndex(attr, oldValue, elt)
+            if newValue is None:
+                del elements[elt]
+            else:
+                elements[elt] = newValue
+                self.attributeIndex[attr].setdefault(newValue, {})[elt] = True
+
+    def _unindexElement(self, elt):
+        """Remove elt from the attribute indexes, after it has been deleted"""
+        for attr in self.indexedAttributes:
+            oldValue = self.attributeElements[attr].pop(elt, None)
+            if oldValue is not None:
+                self._removeFromIndex(attr, oldValue, elt)
+
+    def _removeFromIndex(self, attr, value, elt):
+        valueElements = self.attributeIndex[attr][value]
+        del valueElements[elt]
+        if not valueElements:
+            del self.attributeIndex[attr][value]
+
+    def _getElementsByAttribute(self, attr, value=None):
+        """Return all elements that have attribute attr (with the given value, if not None).
+        attr must be one of the indexed attributes. Elements are returned in the order in which
+        they were indexed, which is document order for elements that were there when the document was loaded."""
+        if value is None:
+            return list(self.attributeElements[attr])
+        return list(self.attributeIndex[attr].get(value, ()))
+
+    def _checkIndexes(self):
+        """Consistency check: compare parentMap, idMap, the XPath index and the attribute indexes to the tree.
+        Returns a list of problems found (empty if all is well)."""
+        rv = []
+        root = self.tree.getroot()
+        parentMap = {c: p for p in root.iter() for c in p}
+        if parentMap != self.parentMap:
+            rv.append('parentMap: %d entries, expected %d' % (len(self.parentMap), len(parentMap)))
+        for e in root.iter():
+            id = e.get(NS_XML('id'))
+            if id and self.idMap.get(id) is not e:
+                rv.append('idMap: wrong entry for %s' % id)
+        with self.xpathIndexLock:
+            xpaths = list(self.xpathIndex.items())
+        for e, path in xpaths:
+            if e not in parentMap:
+                rv.append('xpathIndex: %s: element not in tree' % path)
+            elif self.documentElement.findall('.' + path, NAMESPACES) != [e]:
+                rv.append('xpathIndex: %s: wrong element' % path)
+        for attr in self.indexedAttributes:
+            expected = {}
+            for e in root.iter():
+                value = e.get(attr)
+                if value is not None:
+                    expected.setdefault(value, set()).add(e)
+            actual = {value: set(elements) for value, elements in list(self.attributeIndex[attr].items())}
+            if actual != expected:
+                rv.append('attributeIndex: wrong entries for %s' % attr)
+            allElements = set()
+            for elements in list(expected.values()):
+                allElements |= elements
+            if set(self.attributeElements[attr]) != allElements:
+                rv.append('attributeElements: wrong entries for %s' % attr)
+        return rv
+
     def _afterCopy(self, elt, triggerAttributes=False):
         """Adjust element attributes (xml:id and tt:name) after a copy.
         Makes them unique. Does not insert them into the datastructures yet: the element is expected
@@ -357,59 +850,68 @@ class Document(object):
             # Flag the new element as being newly copied (so it'll show up in the active list)
             elt.set(NS_TIMELINE_INTERNAL("state"), "new")
 
-    @synchronized
     def events(self):
         """Returns the events handler (after creating it if needed)"""
         if not self.eventsHandler:
-            self.eventsHandler = DocumentEvents(self)
+            with self.handlerLock:
+                if not self.eventsHandler:
+                    self.eventsHandler = DocumentEvents(self)
         return self.eventsHandler
 
-    @synchronized
     def authoring(self):
         """Returns the authoring handler (after creating it if needed)"""
         if not self.authoringHandler:
-            self.authoringHandler = DocumentAuthoring(self)
+            with self.handlerLock:
+                if not self.authoringHandler:
+                    self.authoringHandler = DocumentAuthoring(self)
         return self.authoringHandler
 
-    @synchronized
     def serve(self):
         """Returns the serve handler (after creating it if needed)"""
         if not self.serveHandler:
-            self.serveHandler = DocumentServe(self)
+            with self.handlerLock:
+                if not self.serveHandler:
+                    self.serveHandler = DocumentServe(self)
         return self.serveHandler
 
-    @synchronized
     def xml(self):
         """Returns the xml handler (after creating it if needed)"""
         if not self.xmlHandler:
-            self.xmlHandler = DocumentXml(self)
+            with self.handlerLock:
+                if not self.xmlHandler:
+                    self.xmlHandler = DocumentXml(self)
         return self.xmlHandler
 
-    @synchronized
     def remote(self):
         """Returns the remote control handler (after creating it if needed)"""
         if not self.remoteHandler:
-            self.remoteHandler = DocumentRemote(self)
+            with self.handlerLock:
+                if not self.remoteHandler:
+                    self.remoteHandler = DocumentRemote(self)
         return self.remoteHandler
 
-    @synchronized
     def settings(self):
         """Returns the asynchronous (socketIO) update handler (after creating it if needed)"""
         if not self.settingsHandler:
-            self.settingsHandler = DocumentSettings(self)
+            with self.handlerLock:
+                if not self.settingsHandler:
+                    self.settingsHandler = DocumentSettings(self)
         return self.settingsHandler
 
-    @synchronized
     def asynch(self):
         """Returns the document settings handler (after creating it if needed)"""
         if not self.asyncHandler:
-            self.asyncHandler = DocumentAsync(self)
+            with self.handlerLock:
+                if not self.asyncHandler:
+                    self.asyncHandler = DocumentAsync(self)
         return self.asyncHandler
 
     def editing(self):
         """Returns a document editing handler (after creating it if needed)"""
         if not self.editingHandler:
-            self.editingHandler = DocumentEditing(self)
+            with self.handlerLock:
+                if not self.editingHandler:
+                    self.editingHandler = DocumentEditing(self)
         return self.editingHandler
 
     @synchronized
@@ -418,7 +920,7 @@ class Document(object):
         if self.editManager:
             self.logger.warning("EditManager for %s is still active" % self.editManager.reason, extra=self.getLoggerExtra())
             return False
-        if self.forwardHandler:
+        if self.forwardHandler or self.store:
             self.editManager = EditManager(self, reason)
         return True
 
@@ -427,13 +929,15 @@ class Document(object):
         commands = None
         with self.lock:
             if self.editManager:
+                journalCommands = self.editManager.journalList
                 commands = self.editManager.commit()
                 self.editManager = None
+                if journalCommands and self.store:
+                    self._journal(journalCommands, bool(commands and self.forwardHandler))
         return commands
 
     def _forwardToOthers(self, commands):
-        if commands:
-            assert self.forwardHandler
+        if commands and self.forwardHandler:
             self.forwardHandler.forward(commands)
 
     def forward(self, commands):
@@ -466,15 +970,24 @@ class Document(object):
         self.url = None
         self.base = None
         self.baseAdded = False
+        self._checkDocumentSize(len(data))
+        parser = self._createParser(len(data))
         try:
-            root = ET.fromstring(data)
+            for pos in range(0, len(data), DocumentParser.CHUNK_SIZE):
+                parser.feed(data[pos:pos+DocumentParser.CHUNK_SIZE])
+            parser.close()
         except ET.ParseError:
             self.setError("XML parse error in document")
             abort(400, "XML parse error in document")
-        self.tree = ET.ElementTree(root)
-        self._documentLoaded()
+        finally:
+            self.loadProgress = None
+        self._documentLoaded(parser)
         if self.tree.getroot().get(NS_2IMMERSE("base")):
             self.base = self.tree.getroot().get(NS_2IMMERSE("base"))
+        self._setLoadState('loaded')
+        if self.store:
+            # Journal entries from before do not apply to the new tree
+            self.snapshot()
         return ''
 
     @synchronized
@@ -485,11 +998,20 @@ class Document(object):
         self.baseAdded = False
         fp = urllib.request.urlopen(url)
         try:
-            self.tree = ET.parse(fp)
-        except ET.ParseError:
-            self.setError("XML parse error in document")
-            abort(400, "XML parse error in %s" % url)
-        self._documentLoaded()
+            totalSize = fp.headers.get('Content-Length')
+            totalSize = int(totalSize) if totalSize else None
+            self._checkDocumentSize(totalSize)
+            parser = self._createParser(totalSize)
+            try:
+                parser.parseFile(fp)
+            except ET.ParseError:
+                self.setError("XML parse error in document")
+                abort(400, "XML parse error in %s" % url)
+            finally:
+                self.loadProgress = None
+        finally:
+            fp.close()
+        self._documentLoaded(parser)
         if self.tree.getroot().get(NS_2IMMERSE("base")):
             self.base = self.tree.getroot().get(NS_2IMMERSE("base"))
         else:
@@ -498,8 +1020,146 @@ class Document(object):
             self.tree.getroot().set(NS_2IMMERSE("base"), self.url)
             self.logger.debug("load: added tim:base=%s" % self.url, extra=self.getLoggerExtra())
         self.clearError()
+        self._setLoadState('loaded')
+        if self.store:
+            # Journal entries from before do not apply to the new tree
+            self.snapshot()
         return ''
 
+    def setStore(self, store):
+        """Persist this document in store from now on"""
+        with self.lock:
+            self.store = store
+            if self.loadState == 'loaded':
+                self.snapshot()
+
+    def _journal(self, commands, forwarded):
+        """Append commands to the persistent journal. Call with the lock held, so journal order is edit order."""
+        self.journalSeq += 1
+        self.store.appendJournal(self.documentId, dict(seq=self.journalSeq, commands=commands, forwarded=forwarded))
+
+    def needsSnapshot(self):
+        return self.store is not None and self.loadState == 'loaded' and self.snapshotGeneration != self.modificationGeneration
+
+    def snapshot(self):
+        """Save a snapshot of the document to the store, and drop the journal entries it contains"""
+        with self.lock:
+            store = self.store
+            data, meta = self.getSnapshot()
+            store.saveSnapshot(self.documentId, data, meta)
+            self.snapshotGeneration = self.modificationGeneration
+        store.compactJournal(self.documentId, meta['seq'])
+
+    @synchronized
+    def getSnapshot(self):
+        """Return the complete live document (including internal attributes) and its metadata"""
+        data = ET.tostring(self.tree.getroot(), encoding=XML_ENCODING)
+        meta = dict(
+            seq=self.journalSeq,
+            url=self.url,
+            base=self.base,
+            baseAdded=self.baseAdded,
+            timeOpened=self.timeOpened,
+            description=self.description,
+            settings=self.settings().getState()
+            )
+        if self.serveHandler:
+            meta['operationHistory'] = self.serveHandler.operationHistory.getState()
+        return data, meta
+
+    @synchronized
+    def restore(self, data, meta):
+        """Recreate the document from a snapshot made by getSnapshot()"""
+        self.loadXml(data)
+        self.url = meta['url']
+        self.base = meta['base']
+        self.baseAdded = meta['baseAdded']
+        self.timeOpened = meta['timeOpened']
+        self.description = meta['description']
+        self.journalSeq = meta['seq']
+        self.settings().set(**meta['settings'])
+        if 'operationHistory' in meta:
+            self.serve().operationHistory.setState(meta['operationHistory'])
+
+    @synchronized
+    def replay(self, entry):
+        """Re-apply a journal entry made by _journal(), while restoring the document"""
+        assert self.store is None
+        forwarded = []
+        for command in entry['commands']:
+            if command['verb'] == 'change':
+                # The journal has the complete set of attributes, so attributes that have been removed are removed here too
+                element = self._getElementByPath(command['path'])
+                element.attrib.clear()
+                element.attrib.update(json.loads(command['attrs']))
+                self._elementChanged(element)
+            elif command['verb'] == 'data':
+                element = self._getElementByPath(command['path'])
+                element.text = command['data']
+                element.tail = None
+                self._elementModified(element)
+            else:
+                self.forward([dict(command)])
+            if not command.get('local'):
+                forwarded.append(command)
+        if entry['forwarded']:
+            gen = self.serve()._nextGeneration(False)
+            self.serve()._memorizeOperations(gen, forwarded)
+        self.journalSeq = entry['seq']
+
+    def setLoading(self):
+        """Mark the document as being loaded in the background"""
+        self._setLoadState('loading')
+
+    def loadInBackground(self, url):
+        """Load the document from url, for use in a background worker. Failures are recorded in the load state."""
+        try:
+            self.load(url)
+        except HTTPException as e:
+            self._setLoadState('failed', e.description)
+        except Exception as e:
+            self.logger.exception('loadInBackground: error loading %s' % url, extra=self.getLoggerExtra())
+            self.setError("Error loading document")
+            self._setLoadState('failed', str(e))
+
+    def getLoadState(self, wait=None):
+        """Return load state and progress. If wait is given and the document is loading, wait at most that
+        many seconds for loading to finish. Does not use the document lock, which is held while loading."""
+        with self.loadStateChanged:
+            if wait and self.loadState == 'loading':
+                deadline = time.time() + wait
+                while self.loadState == 'loading':
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self.loadStateChanged.wait(remaining)
+            return dict(state=self.loadState, error=self.loadError, progress=self.loadProgress)
+
+    def _setLoadState(self, state, error=None):
+        with self.loadStateChanged:
+            self.loadState = state
+            self.loadError = error
+            self.loadStateChanged.notify_all()
+
+    def _checkDocumentSize(self, size):
+        if size and GlobalSettings.maxDocumentSize and size > GlobalSettings.maxDocumentSize:
+            self.setError("Document too large")
+            abort(413, "Document too large (%d bytes, maximum is %d)" % (size, GlobalSettings.maxDocumentSize))
+
+    def _createParser(self, totalSize=None):
+        """Return a parser for loading a new document, which reports its progress in self.loadProgress"""
+        self.loadProgress = dict(bytesRead=0, totalBytes=totalSize, elements=0)
+        lastReported = [0]
+        def progress(bytesRead, elements):
+            self.loadProgress = dict(bytesRead=bytesRead, totalBytes=totalSize, elements=elements)
+            if bytesRead - lastReported[0] >= 1024*1024:
+                lastReported[0] = bytesRead
+                self.logger.debug('load: %d of %s bytes, %d elements' % (bytesRead, totalSize, elements), extra=self.getLoggerExtra())
+        def tooLarge(bytesRead):
+            self.setError("Document too large")
+            abort(413, "Document too large (more than %d bytes)" % GlobalSettings.maxDocumentSize)
+        return DocumentParser(self.indexedAttributes, GlobalSettings.maxDocumentSize, progress, tooLarge)
+
     @synchronized
     def save(self, url):
         self.logger.info('save: %s' % url, extra=self.getLoggerExtra())
@@ -508,8 +1168,7 @@ class Document(object):
         filename = urllib.request.url2pathname(p.path)
         fp = open(filename, 'w')
         self._zapWhitespace()
-        saveTree = self._prepareForSave()
-        fp.write(ET.tostring(saveTree, encoding=XML_ENCODING))
+        ET.ElementTree(self._saveView()).write(fp, encoding=XML_ENCODING)
         fp.close()
         self.clearError()
 
@@ -521,44 +1180,37 @@ class Document(object):
                 e.text = e.text.strip()
             if e.tail:
                 e.tail = e.tail.strip()
+        self.modificationGeneration += 1
 
-    def _prepareForSave(self):
-        """Prepare tree for saving by removing all items we added"""
-        saveTree = copy.deepcopy(self.tree.getroot())
+    def _saveView(self):
+        """Return a view of the tree as it should be saved, without the items we added"""
+        dropAttributes = ()
         # Remove tim:base, if we added it
         if self.baseAdded:
-            assert saveTree.get(NS_2IMMERSE("base"))
-            saveTree.attrib.pop(NS_2IMMERSE("base"))
-        for elt in saveTree.iter():
-            # Copy tl:dur attribute from tt:_realDur
-            realDur = elt.get(NS_TRIGGER("_realDur"))
-            if realDur:
-                elt.set(NS_TIMELINE("dur"), realDur)
-            # Remove all tt: attributes
-            toRemove = []
-            for attr in list(elt.attrib.keys()):
-                if attr == NS_TRIGGER("_realDur"):
-                    toRemove.append(attr)
-                if attr in NS_TIMELINE_INTERNAL:
-                    toRemove.append(attr)
-            for attr in toRemove:
-                elt.attrib.pop(attr)
-        # Remove any elements we inserted
-        # xxxjack tbd
-        return saveTree
+            assert self.tree.getroot().get(NS_2IMMERSE("base"))
+            dropAttributes = (NS_2IMMERSE("base"),)
+        return SaveView(self.tree.getroot(), dropAttributes)
 
     @synchronized
     def dump(self):
         return '%d elements' % self._count()
 
-    @synchronized
+    def elementCount(self):
+        """Return the number of elements in the tree without walking it: the parent map, which is kept
+        up to date on every edit, has an entry for every element except the root."""
+        parentMap = self.parentMap
+        if parentMap is None or self.tree is None:
+            return 0
+        return len(parentMap) + 1
+
+    @synchronizedRead
     def _count(self):
         totalCount = 0
         for _ in self.tree.iter():
             totalCount += 1
         return totalCount
 
-    @synchronized
+    @synchronizedRead
     def _getParent(self, element):
         return self.parentMap.get(element, None)
 
@@ -594,30 +1246,82 @@ class Document(object):
         elif mimetype == 'application/xml':
             return ET.tostring(element, encoding=XML_ENCODING)
 
-    @synchronized
+    @synchronizedRead
     def _getXPath(self, elt):
         if elt is None:
             return '$unconnectedElement'
+        rv = self.xpathIndex.get(elt)
+        if rv is not None:
+            return rv
         parent = self._getParent(elt)
         if parent is None:
             return '/' + elt.tag
+        self._indexXPaths(parent)
+        rv = self.xpathIndex.get(elt)
+        if rv is None:
+            # Element is no longer a child of its parent (it is being deleted).
+            index = 0
+            for ch in parent:
+                if ch.tag == elt.tag:
+                    index += 1
+            rv = self._getXPath(parent) + '/' + elt.tag + '[%d]' % (index+1)
+        return rv
+
+    def _indexXPaths(self, parent):
+        """Store the XPaths of all children of parent in the xpath index, in a single pass.
+        Note that an element only has an index entry if its parent has one too (or is the root)."""
+        parentPath = self._getXPath(parent)
+        counts = {}
+        paths = []
+        for ch in parent:
+            index = counts.get(ch.tag, 0) + 1
+            counts[ch.tag] = index
+            paths.append((ch, '%s/%s[%d]' % (parentPath, ch.tag, index)))
+        # Multiple readers may get here concurrently. They compute the same paths, but the
+        # index itself must only be modified by one of them at a time.
+        with self.xpathIndexLock:
+            self.xpathIndex.update(paths)
+
+    def _forgetXPaths(self, elt):
+        """Remove index entries for elt and its descendants"""
+        if self.xpathIndex.pop(elt, None) is None:
+            # Descendants cannot have an entry either
+            return
+        # Anything derived from the XPath of this element (event descriptions) is now stale
+        self.modificationStamps[elt] = self.modificationGeneration
+        for ch in elt:
+            self._forgetXPaths(ch)
+
+    def _siblingsShifted(self, parent, tag, after=None, fromIndex=1):
+        """Children of parent with the given tag have changed position (because an element was inserted
+        or removed). Forget the XPaths of those that come after element after, or that are now at the
+        fromIndex'th position or later."""
+        self.modificationGeneration += 1
         index = 0
+        seen = after is None
         for ch in parent:
-            if ch is elt:
-                break
-            if ch.tag == elt.tag:
-                index += 1
-        rv = self._getXPath(parent) + '/' + elt.tag
-        rv = rv + '[%d]' % (index+1)
-        return rv
+            if not seen:
+                seen = ch is after
+                continue
+            if ch.tag != tag:
+                continue
+            index += 1
+            if index >= fromIndex:
+                self._forgetXPaths(ch)
 
-    @synchronized
+    @synchronizedRead
     def _getElementByPath(self, path):
         if path == '/':
             # Findall implements bare / paths incorrectly
             positions = []
         elif path[:1] == '/':
-            positions = self.documentElement.findall('.'+path, NAMESPACES)
+            # Fast path for the absolute indexed paths we generate ourselves
+            steps = _compilePath(path)
+            positions = None
+            if steps is not None:
+                positions = self._resolvePath(steps)
+            if positions is None:
+                positions = self.documentElement.findall('.'+path, NAMESPACES)
         else:
             positions = self.tree.getroot().findall(path, NAMESPACES)
         if not positions:
@@ -629,6 +1333,30 @@ class Document(object):
         element = positions[0]
         return element
 
+    def _resolvePath(self, steps):
+        """Find the element matching a compiled path by descending the tree directly.
+        Returns a list of positions like findall(), or None if the path is ambiguous."""
+        element = self.documentElement
+        for tag, index in steps:
+            count = 0
+            found = None
+            for ch in element:
+                if ch.tag != tag:
+                    continue
+                count += 1
+                if index is None:
+                    if found is not None:
+                        # Multiple matches for an unindexed step, let findall() sort it out
+                        return None
+                    found = ch
+                elif count == index:
+                    found = ch
+                    break
+            if found is None:
+                return []
+            element = found
+        return [element]
+
     def _getElementByID(self, id):
         return self.idMap.get(id)
 
@@ -669,12 +1397,16 @@ class DocumentXml(object):
             element.append(newElement)
             self.document._elementAdded(newElement, element)
         elif where == 'replace':
+            oldChildren = list(element)
             element.clear()
+            for e in oldChildren:
+                self.document._elementDeleted(e, recursive=True)
             for k, v in list(newElement.items()):
                 element.set(k, v)
             # xxxjack this may be unsafe, replacing children....
             for e in list(newElement):
                 element.append(e)
+                self.document._elementAdded(e, element, recursive=True)
             newElement = element
             self.document._elementChanged(element)
         elif where == 'before':
@@ -745,6 +1477,7 @@ class DocumentXml(object):
         else:
             element.text = data
             element.tail = None
+        self.document._elementDataChanged(element)
         return self.document._getXPath(element)
 
     @edit
@@ -773,6 +1506,11 @@ class DocumentEvents(object):
         self.tree = document.tree
         self.lock = self.document.lock
         self.logger = self.document.logger.getChild('events')
+        # Cache of event descriptions: element -> ((trigger, state), generation, dependencies, description)
+        self.descriptionCache = {}
+        # Cache of the complete event list, valid as long as document.modificationGeneration does not change
+        self.eventList = None
+        self.eventListGeneration = None
 
     def getLoggerExtra(self):
         return self.document.getLoggerExtra()
@@ -783,37 +1521,81 @@ class DocumentEvents(object):
         self.logger.error(message, extra=self.getLoggerExtra())
         abort(400, message)
 
-    @synchronized
+    @synchronizedRead
     def get(self, caller='get'):
         """REST get command: returns list of triggerable and modifiable events to the front end UI"""
-        exprTriggerable = './/tt:events/*[@tt:name]'
-        exprComplete = './/tt:completeEvents/*[@tt:name]'
-        exprModifyable = './/tl:par/*[@tt:name][@tls:state]'
-        elementsTriggerable = self.tree.getroot().findall(exprTriggerable, NAMESPACES)
-        elementsComplete = self.tree.getroot().findall(exprComplete, NAMESPACES)
-        elementsModifyable = self.tree.getroot().findall(exprModifyable, NAMESPACES)
-        eventList = []
-        for elt in elementsTriggerable:
-            eventList.append(self._getDescription(elt, trigger=True, state='abstract'))
-        for elt in elementsComplete:
-            eventList.append(self._getDescription(elt, trigger=True, state='ready'))
-        for elt in elementsModifyable:
-            # Weed out events that are already finished
-            if elt.get(NS_TIMELINE_INTERNAL("state")) == "finished":
-                continue
-            eventList.append(self._getDescription(elt, trigger=False, state='active'))
-        self.logger.debug('%s: %d triggerable, %d complete-triggerable, %d modifyable' % (caller, len(elementsTriggerable), len(elementsComplete), len(elementsModifyable)), extra=self.getLoggerExtra())
-
+        eventList = self.eventList
+        if eventList is None or self.eventListGeneration != self.document.modificationGeneration:
+            eventList = self._getEventList(caller)
         rv = {
             "remote": self.document.remote().get(),
-            "events": eventList
+            "events": list(eventList)
         }
         return rv
 
-    @synchronized
+    @synchronizedRead
+    def _getEventList(self, caller):
+        """Return list of descriptions of triggerable and modifiable events. Descriptions of events that have
+        not been modified since the previous call are re-used."""
+        # Equivalent to XPaths .//tt:events/*[@tt:name], .//tt:completeEvents/*[@tt:name] and
+        # .//tl:par/*[@tt:name][@tls:state], but using the attribute index
+        elementsTriggerable = []
+        elementsComplete = []
+        elementsModifyable = []
+        for elt in self.document._getElementsByAttribute(NS_TRIGGER('name')):
+            parent = self.document._getParent(elt)
+            if parent is None:
+                continue
+            if parent.tag == NS_TRIGGER('events'):
+                elementsTriggerable.append(elt)
+            elif parent.tag == NS_TRIGGER('completeEvents'):
+                elementsComplete.append(elt)
+            elif parent.tag == NS_TIMELINE('par') and NS_TIMELINE_INTERNAL('state') in elt.attrib:
+                elementsModifyable.append(elt)
+        generation = self.document.modificationGeneration
+        # Other readers may be building the list at the same time, so the new cache is only installed at the end
+        oldCache = self.descriptionCache
+        newCache = {}
+        eventList = []
+        cacheable = True
+        rebuilt = 0
+        for elt, trigger, state in (
+                [(elt, True, 'abstract') for elt in elementsTriggerable] +
+                [(elt, True, 'ready') for elt in elementsComplete] +
+                [(elt, False, 'active') for elt in elementsModifyable]):
+            # Weed out events that are already finished
+            if not trigger and elt.get(NS_TIMELINE_INTERNAL("state")) == "finished":
+                continue
+            cached = oldCache.get(elt)
+            if cached is not None:
+                key, cachedGeneration, dependencies, description = cached
+                if key != (trigger, state) or any(self.document._modifiedSince(e, cachedGeneration) for e in dependencies):
+                    cached = None
+            if cached is None:
+                description, dependencies = self._getDescription(elt, trigger, state)
+                rebuilt += 1
+                if dependencies is None:
+                    cacheable = False
+                else:
+                    cached = ((trigger, state), generation, dependencies, description)
+            if cached is not None:
+                newCache[elt] = cached
+            eventList.append(description)
+        self.logger.debug('%s: %d triggerable, %d complete-triggerable, %d modifyable, %d rebuilt' % (caller, len(elementsTriggerable), len(elementsComplete), len(elementsModifyable), rebuilt), extra=self.getLoggerExtra())
+        self.descriptionCache = newCache
+        if cacheable:
+            self.eventList = eventList
+            self.eventListGeneration = generation
+        else:
+            self.eventList = None
+        return eventList
+
+    @synchronizedRead
     def _getDescription(self, elt, trigger, state=None):
-        """Returns description of a triggerable or modifiable event for the front end"""
+        """Returns description of a triggerable or modifiable event for the front end, and the elements
+        it depends on (None if it cannot be cached because it contains computed values)."""
         # xxxjack should move to ElementDelegate
+        dependencies = [elt]
         if state == 'abstract':
             parameterExpr = './tt:parameters/tt:parameter'
         elif state == 'ready':
@@ -850,6 +1632,8 @@ class DocumentEvents(object):
                 value = paramElt.get(NS_TRIGGER('value'))
                 if pData['type'] == 'string' and '{' in value:
                     value = self._minimalAVT(value, "", paramElt)
+                    # Value may depend on the clock or on other parts of the document
+                    dependencies = None
                 pData['value'] = value
             if NS_TRIGGER('required') in paramElt.attrib:
                 required = paramElt.get(NS_TRIGGER('required'))
@@ -865,6 +1649,8 @@ class DocumentEvents(object):
                 if optionListElt is None:
                     self._documentError('tt:parameter optionListId does not exist: %s' % optionListId)
                 optionValues = self._getOptions(optionListElt)
+                if dependencies is not None:
+                    dependencies.append(optionListElt)
                 # self.logger.debug('_getDescription: got %d selection options from element %s' % (len(optionValues), optionListId), extra=self.getLoggerExtra())
             else:
                 optionValues = self._getOptions(paramElt)
@@ -905,9 +1691,9 @@ class DocumentEvents(object):
         rv["productionId"] = elt.get(NS_TRIGGER("productionId"), idd)
         rv["productionGroup"] = elt.get(NS_TRIGGER("productionGroup"), rv["productionId"])
 
-        return rv
+        return rv, dependencies
 
-    @synchronized
+    @synchronizedRead
     def _getOptions(self, optionListElt):
         optionElements = optionListElt.findall('./au:item', NAMESPACES)
         optionValues = []
@@ -921,7 +1707,7 @@ class DocumentEvents(object):
             })
         return optionValues
 
-    @synchronized
+    @synchronizedRead
     def _getParameterDestinations(self, parameter):
         """For a parameter/value coming from the front end, returns what to set where"""
         # xxxjack should move to ElementDelegate
@@ -964,7 +1750,7 @@ class DocumentEvents(object):
 
         return path, attr
 
-    @synchronized
+    @synchronizedRead
     def _minimalAVT(self, value, userValue, contextElement, parentElement=None):
         """Handle computed values"""
         match = INTERPOLATION.search(value)
@@ -998,7 +1784,7 @@ class DocumentEvents(object):
         value = value[:match.start()] + exprValue + value[match.end():]
         return value
 
-    @synchronized
+    @synchronizedRead
     def _getClock(self, element):
         """Return current clock value for an element"""
 
@@ -1085,7 +1871,7 @@ class DocumentEvents(object):
 
         newElement = copy.deepcopy(element)
         newElement.set(NS_TRIGGER("wantstatus"), "true")
-        self.document._ensureId(newElement)
+        self.document._ensureId(newElement, register=False)
         self.document._afterCopy(newElement, triggerAttributes=True)
         # The new element should have a productionId (which is used to combine multiple instances of the event
         # in the UI). Invent one if needed, and record we should remove references after it becomes inactive
@@ -1126,6 +1912,7 @@ class DocumentEvents(object):
         oldName = element.attrib.pop(NS_TRIGGER("name"), None)
         if oldName:
             element.attrib[NS_TRIGGER("oldName")] = oldName
+        self.document._elementUpdated(element)
 
         self.document.asynch().requestBroadcastToFrontends()
         return True
@@ -1166,13 +1953,19 @@ class DocumentEvents(object):
 
     def _productionIdFinished(self, productionId):
         """Called when a transient productionId has finished running. Remove from completeEvents"""
-        events = self.tree.getroot().findall(".//tt:completeEvents/*[@tt:name][@tt:productionId='%s']" % productionId, NAMESPACES)
+        # Equivalent to XPath .//tt:completeEvents/*[@tt:name][@tt:productionId='...'], but using the attribute index
+        events = []
+        for elt in self.document._getElementsByAttribute(NS_TRIGGER('productionId'), productionId):
+            parent = self.document._getParent(elt)
+            if parent is not None and parent.tag == NS_TRIGGER('completeEvents') and NS_TRIGGER('name') in elt.attrib:
+                events.append(elt)
         self.logger.info("productionIdFinished(%s): removing %d events" % (productionId, len(events)))
         for elt in events[:1]:
             # Removing the tt:name attribute will make the event invisible to events().get()
             oldName = elt.attrib.pop(NS_TRIGGER("name"), None)
             if oldName:
                 elt.attrib[NS_TRIGGER("oldName")] = oldName
+            self.document._elementUpdated(elt)
 
 class DocumentRemote(object):
     def __init__(self, document):
@@ -1185,7 +1978,7 @@ class DocumentRemote(object):
     def getLoggerExtra(self):
         return self.document.getLoggerExtra()
 
-    @synchronized
+    @synchronizedRead
     def _getClockState(self):
         if self.statusElement is None:
             eventParents = self.tree.getroot().findall('.//tt:events/..', NAMESPACES)
@@ -1203,7 +1996,7 @@ class DocumentRemote(object):
         playing = not not (clockRunning and clockRunning != "false")
         return curClock, playing
 
-    @synchronized
+    @synchronizedRead
     def get(self):
         if self.statusElement is None:
             eventParents = self.tree.getroot().findall('.//tt:events/..', NAMESPACES)
@@ -1268,9 +2061,12 @@ class DocumentServe(object):
         self.allContextIDs = []
         self.contextID = None
         self.callbacks = set()
+        self.callbackSenders = collections.OrderedDict()
+        self.timelineCache = None  # (modificationGeneration, serialized timeline, etag)
         self.lastClientServed = None
-        self.operationHistory = []
+        self.operationHistory = OperationHistory()
         self.previewPlayerClockEpoch = None
+        self.viewerOffset = None  # Offset applied for viewers, as a clock that slews to the viewerExtraOffset setting
         self.logger = self.document.logger.getChild('serve')
 
     def getLoggerExtra(self):
@@ -1279,26 +2075,54 @@ class DocumentServe(object):
     @synchronized
     def _nextGeneration(self, sameValue):
         rootElt = self.tree.getroot()
-        gen = int(rootElt.get(NS_AUTH("generation"), 0))
+        oldValue = rootElt.get(NS_AUTH("generation"))
+        gen = int(oldValue or 0)
         if not sameValue:
             gen += 1
-        rootElt.set(NS_AUTH("generation"), str23compat(gen))
+        if oldValue != str23compat(gen):
+            rootElt.set(NS_AUTH("generation"), str23compat(gen))
+            self.document._elementModified(rootElt)
         return gen
 
-    @synchronized
     def get_timeline(self, viewer=False):
         """Get timeline document contents (xml) for this authoring document.
         At the moment, this is actually the whole authoring document itself."""
+        return self.get_timeline_with_etag(viewer)[0]
+
+    def get_timeline_with_etag(self, viewer=False):
+        """Get timeline document contents and its ETag. The serialized document is cached
+        until the next modification, and served from the cache without taking the lock."""
         self.logger.info('serving timeline.xml document', extra=self.getLoggerExtra())
-        return ET.tostring(self.tree.getroot(), encoding=XML_ENCODING)
+        cached = self.timelineCache
+        if cached is not None and cached[0] == self.document.modificationGeneration:
+            return cached[1], cached[2]
+        with self.lock.reading():
+            cached = self.timelineCache
+            generation = self.document.modificationGeneration
+            if cached is None or cached[0] != generation:
+                data = ET.tostring(self.tree.getroot(), encoding=XML_ENCODING)
+                etag = '%s-%d' % (self.document.instanceTag, generation)
+                cached = self.timelineCache = (generation, data, etag)
+            return cached[1], cached[2]
 
-    @synchronized
     def get_layout(self, viewer=False):
         """Get the layout document contents (json) for this authoring document.
         At the moment, the layout document JSON representation is stored in a toplevel
         au:rawLayout element. This will change when the authoring tool starts modifying the
-        layout document data."""
+        layout document data.
+        A referenced layout document is fetched through the httpcache module. As when it was fetched
+        directly, failure raises a requests exception (HTTPError for error responses). Fetches now time
+        out after GlobalSettings.httpTimeout, which also raises a requests exception."""
         self.logger.info('serving layout.json document', extra=self.getLoggerExtra())
+        layoutUrl, rawLayout = self._getLayoutSource()
+        if layoutUrl:
+            # Fetched without holding the lock
+            return httpcache.getText(layoutUrl)
+        return rawLayout
+
+    @synchronizedRead
+    def _getLayoutSource(self):
+        """Return (url, None) if the layout document is referenced by au:layoutRef, or (None, text) for au:rawLayout"""
         layoutRefElement = self.tree.getroot().find('.//au:layoutRef', NAMESPACES)
         if layoutRefElement != None:
             layoutUrl = layoutRefElement.get('url', None)
@@ -1306,10 +2130,7 @@ class DocumentServe(object):
                 self.logger.error('get_layout: au:layoutRef element misses required url attribute', extra=self.getLoggerExtra())
                 self.document.setError('get_layout: au:layoutRef element misses required url attribute')
                 abort(404, 'no url in au:layoutRef element')
-            layoutUrl = urllib.parse.urljoin(self.document.base, layoutUrl)
-            r = requests.get(layoutUrl)
-            r.raise_for_status()
-            return r.text
+            return urllib.parse.urljoin(self.document.base, layoutUrl), None
 
         self.logger.warn('get_layout: no au:layoutRef element, reverting to au:rawLayout', extra=self.getLoggerExtra())
         self.document.setError('get_layout: no au:layoutRef element, reverting to au:rawLayout')
@@ -1318,10 +2139,11 @@ class DocumentServe(object):
             self.logger.error('get_layout: no au:rawLayout element in document', extra=self.getLoggerExtra())
             self.document.setError('No au:rawLayout element in document')
             abort(404, 'No au:rawLayout element in document')
-        return rawLayoutElement.text
+        return None, rawLayoutElement.text
 
     def get_client(self, timeline, layout, base=None, mode=None, viewer=False):
-        """Return the client.api document that describes this dmapp"""
+        """Return the client.api document that describes this dmapp. A referenced client document is fetched
+        through the httpcache module, see get_layout() for error handling."""
         self.logger.info('serving client.json document', extra=self.getLoggerExtra())
         self.lastClientServed = time.time()
         startPaused = self.document.settings().startPaused
@@ -1330,9 +2152,7 @@ class DocumentServe(object):
         #
         if base:
             clientUrl = base
-            r = requests.get(clientUrl)
-            r.raise_for_status()
-            clientDoc = r.json()
+            clientDoc = json.loads(httpcache.getText(clientUrl))
             if not 'baseUrl' in clientDoc:
                 clientDoc['baseUrl'] = clientUrl
         else:
@@ -1344,9 +2164,7 @@ class DocumentServe(object):
                     self.document.setError('get_client: au:clientRef element misses required url attribute')
                     abort(404, 'no url in au:clientRef element')
                 clientUrl = urllib.parse.urljoin(self.document.base, clientUrl)
-                r = requests.get(clientUrl)
-                r.raise_for_status()
-                clientDoc = r.json()
+                clientDoc = json.loads(httpcache.getText(clientUrl))
                 if not 'baseUrl' in clientDoc:
                     clientDoc['baseUrl'] = clientUrl
             else:
@@ -1437,29 +2255,39 @@ class DocumentServe(object):
         if contextID and not contextID in self.allContextIDs:
             self.allContextIDs.append(contextID)
         curClock, playing = self.document.remote()._getClockState()
+        # This is a temporary hack (xxxjack)
+        # The live Dash feeds are a fairly-fixed amount behind the live feed.
+        # We adapt for that.
+        offset = self._getViewerOffset()
         if curClock:
-            # This is a temporary hack (xxxjack)
-            # The live Dash feeds are a fairly-fixed amount behind the live feed.
-            # We adapt for that.
-            offset = self.document.settings().viewerExtraOffset
             if offset and viewer:
-                curClock -= float(offset)
+                curClock -= offset
             rv['currentTime'] = curClock
         if self.previewPlayerClockEpoch:
             # If we know what t=0 means for the preview player we tell it to the other viewers
-            # This is a temporary hack (xxxjack)
-            # The live Dash feeds are a fairly-fixed amount behind the live feed.
-            # We adapt for that.
             clockEpoch = self.previewPlayerClockEpoch
-            offset = self.document.settings().viewerExtraOffset
             if offset:
-                clockEpoch -= float(offset)
+                clockEpoch -= offset
             rv['clockEpoch'] = clockEpoch
         self.logger.info('getLiveInfo(%s)' % contextID, extra=self.getLoggerExtra())
         self.document.forwardHandler = self
         self.document.asynch().requestBroadcastToFrontends()
         return rv
 
+    def _getViewerOffset(self):
+        """Return the offset for viewers. When the viewerExtraOffset setting changes by a small amount the
+        offset moves towards it at GlobalSettings.clockSlewRate, so viewers do not see their clock jump."""
+        offset = self.document.settings().viewerExtraOffset
+        target = float(offset) if offset else 0.0
+        if self.viewerOffset is None:
+            self.viewerOffset = clocks.SlewingClock(clocks.SystemClock(), slewRate=GlobalSettings.clockSlewRate)
+            self.viewerOffset.set(target)
+            self.viewerOffset.setRate(0)
+            self.viewerOffset.start()
+        else:
+            self.viewerOffset.slewTo(target, maxSlew=GlobalSettings.clockSlewLimit)
+        return self.viewerOffset.now()
+
     @synchronized
     def _setDocumentState(self, documentState):
         clockEpoch = documentState.get("clockEpoch")
@@ -1468,12 +2296,13 @@ class DocumentServe(object):
         elementStates = documentState["elementStates"]
         self.logger.info("_setDocumentState: got %d element-state items, clockEpoch %s" % (len(elementStates), clockEpoch), extra=self.getLoggerExtra())
         self.document.companionTimelineIsActive = True
+        clockDrift = self._followTimelineClock(elementStates)
         for eltId, eltState in list(elementStates.items()):
             elt = self.document._getElementByID(eltId)
             if elt is None:
                 self.logger.warning('_setDocumentState: unknown element %s' % eltId, extra=self.getLoggerExtra())
                 continue
-            changed = self._elementStateChanged(elt, eltState)
+            changed = self._elementStateChanged(elt, eltState, clockDrift)
             if changed:
                 self.logger.debug("_setDocumentState: %s: changed" % eltId, extra=self.getLoggerExtra())
                 # If this was one of our events and it has become inactive we may want to remove the trigger
@@ -1486,14 +2315,45 @@ class DocumentServe(object):
                             self.document.events()._productionIdFinished(productionId)
         self.document.asynch().requestBroadcastToFrontends()
 
-    def _elementStateChanged(self, elt, eltState):
-        """Timeline service has sent new state for this element. Return True if anything has changed."""
+    def _followTimelineClock(self, elementStates):
+        """If the elements that keep running all report that our clock has drifted from the timeline service
+        clock (the median of their drift), slew our clock to follow it. Return the drift, to be added to
+        the epochs computed for the elements."""
+        def isRunning(clockRunning):
+            return bool(clockRunning) and clockRunning != "false"
+
+        now = self.document.clock.now()
+        drifts = []
+        for eltId, eltState in elementStates.items():
+            elt = self.document._getElementByID(eltId)
+            if elt is None:
+                continue
+            newProgress = eltState.get(NS_TIMELINE_INTERNAL("progress"))
+            oldEpoch = elt.get(NS_TIMELINE_INTERNAL("epoch"))
+            if not newProgress or not oldEpoch:
+                continue
+            if not isRunning(elt.get(NS_TIMELINE_INTERNAL("clockRunning"))) or not isRunning(eltState.get(NS_TIMELINE_INTERNAL("clockRunning"))):
+                continue
+            drifts.append(float(oldEpoch) - (now - float(newProgress)))
+        if not drifts:
+            return 0
+        drifts.sort()
+        drift = drifts[len(drifts) // 2]
+        if abs(drift) < 0.01 or abs(drift) > GlobalSettings.clockSlewLimit:
+            return 0
+        self.logger.debug("_followTimelineClock: slewing clock by %f (median of %d elements)" % (drift, len(drifts)), extra=self.getLoggerExtra())
+        self.document.clock.slewTo(now + drift)
+        return drift
+
+    def _elementStateChanged(self, elt, eltState, clockDrift=0):
+        """Timeline service has sent new state for this element. Return True if anything has changed.
+        clockDrift is the amount by which our clock is being slewed to follow the timeline service."""
         newState = eltState.get(NS_TIMELINE_INTERNAL("state"))
         if newState == 'idle':
             newState = None
         newProgress = eltState.get(NS_TIMELINE_INTERNAL("progress"))
         if newProgress:
-            newEpoch = self.document.clock.now() - float(newProgress)
+            newEpoch = self.document.clock.now() + clockDrift - float(newProgress)
         else:
             newEpoch = None
         newClockRunning = eltState.get(NS_TIMELINE_INTERNAL("clockRunning"))
@@ -1535,6 +2395,7 @@ class DocumentServe(object):
                 elt.attrib.pop(NS_TIMELINE_INTERNAL("clockRunning"))
             if newEpoch:
                 self.document.clock.stop()
+        self.document._elementUpdated(elt)
 
         return True
 
@@ -1543,6 +2404,7 @@ class DocumentServe(object):
             self.logger.info('forward %d operations to %d callbacks' % (len(operations), len(self.callbacks)), extra=self.getLoggerExtra())
         else:
             self.logger.debug('forward %d operations to %d callbacks' % (len(operations), len(self.callbacks)), extra=self.getLoggerExtra())
+        forwardStartTime = time.time()
         gen = self._nextGeneration(not operations)
         if operations:
             self._memorizeOperations(gen, operations)
@@ -1551,52 +2413,79 @@ class DocumentServe(object):
         #
         self.document.asynch().forwardDocumentModifications(dict(generation=gen, operations=operations))
         #
-        # Now forward to REST listeners (code to be removed soon)
+        # Now forward to REST listeners (code to be removed soon). Every callback has its own sender that
+        # delivers in order from a shared worker pool, so a slow timeline service does not stall editing.
+        # The first (oldest) callback is asked for state updates, and is the only one that gets empty updates.
+        # Messages are only queued here, so we cannot know whether they arrive: if the first callback fails
+        # _callbackFailed() removes it and asks the next one for state updates.
         #
-        toRemove = []
-        wantStateUpdates = True
-        for callback in self.callbacks:
-            try:
-                requestStartTime = time.time()  # Debugging: sometimes requests take a very long time
-                args = dict(generation=gen, operations=operations)
-                # for the first successful one, add updateState=True
-                if wantStateUpdates:
-                    args['wantStateUpdates'] = True
-                r = requests.put(callback, json=args)
-                r.raise_for_status()
-                wantStateUpdates = False
-            except requests.exceptions.RequestException:
-                self.logger.warning("forward: PUT failed for %s" % callback, extra=self.getLoggerExtra())
-                self.document.setError("Error communicating to timeline service")
-                toRemove.append(callback)
-            else:
-                requestDuration = time.time() - requestStartTime
-                if requestDuration > 2:
-                    self.logger.warning("forward: PUT took %d seconds for %s" % (requestDuration, callback), extra=self.getLoggerExtra())
-
+        senders = self._getCallbackSenders()
+        for sender in senders:
+            args = dict(generation=gen, operations=operations)
+            if sender is senders[0]:
+                args['wantStateUpdates'] = True
+            sender.send(args)
             # Only continue if we have anything to say...
-            if not operations and not wantStateUpdates:
+            if not operations:
                 break
+        metrics.FORWARD_DURATION.observe(time.time() - forwardStartTime)
+
+    @synchronized
+    def addCallback(self, url):
+        self.logger.info('addCallback(%s)' % url, extra=self.getLoggerExtra())
+        self.callbacks.add(url)
+
+    @synchronized
+    def removeCallback(self, url):
+        self.logger.info('removeCallback(%s)' % url, extra=self.getLoggerExtra())
+        self.callbacks.discard(url)
+        sender = self.callbackSenders.pop(url, None)
+        if sender:
+            sender.close()
 
-        for callback in toRemove:
-            self.logger.info('removeCallback(%s)' % callback, extra=self.getLoggerExtra())
-            self.callbacks.discard(callback)
+    @synchronized
+    def _getCallbackSenders(self):
+        """Return senders for all callbacks, oldest first"""
+        for url in list(self.callbackSenders.keys()):
+            if url not in self.callbacks:
+                self.callbackSenders.pop(url).close()
+        for url in sorted(self.callbacks):
+            if url not in self.callbackSenders:
+                self.callbackSenders[url] = forwarder.CallbackSender(url, self._callbackFailed, self.logger, self.getLoggerExtra())
+        return list(self.callbackSenders.values())
+
+    @synchronized
+    def _callbackFailed(self, sender):
+        """Called (from a forwarder worker) when a callback could not be reached"""
+        wasStateCallback = bool(self.callbackSenders) and next(iter(self.callbackSenders.values())) is sender
+        self.logger.warning("forward: PUT failed for %s" % sender.url, extra=self.getLoggerExtra())
+        self.document.setError("Error communicating to timeline service")
+        self.removeCallback(sender.url)
+        if wasStateCallback:
+            # Ask the next callback for state updates in stead
+            for nextSender in self._getCallbackSenders():
+                if nextSender.send(dict(generation=self._nextGeneration(True), operations=[], wantStateUpdates=True)):
+                    break
+
+    def _waitForwarded(self, timeout=None):
+        """Wait until all REST callbacks have been sent everything forwarded so far (for testing)"""
+        for sender in self._getCallbackSenders():
+            sender.waitIdle(timeout)
 
     @synchronized
     def _memorizeOperations(self, gen, operations):
         """Remember old operations, solater clients can refresh in case they missed some between getting the document and
         starting to listen to the broadcasts."""
-        assert len(self.operationHistory) <= gen
-        while len(self.operationHistory) < gen:
-            self.operationHistory.append((len(self.operationHistory), []))
-        self.operationHistory.append((gen, operations))
+        self.operationHistory.add(gen, operations)
 
-    @synchronized
+    @synchronizedRead
     def gethistory(self, oldest=None, viewer=False):
         if not oldest:
             oldest = 0
         oldest = int(oldest)
-        rv = self.operationHistory[oldest:]
+        rv = self.operationHistory.get(oldest)
+        if rv is None:
+            abort(410, "History before generation %d is no longer available, refetch timeline.xml" % (self.operationHistory.baseGeneration + 1))
         return rv
 
 
@@ -1633,6 +2522,16 @@ class DocumentSettings(object):
             enableControls=self.enableControls
             )
 
+    def getState(self):
+        """Return the settings that need to be persisted"""
+        return dict(
+            startPaused=self.startPaused,
+            playerMode=self.playerMode,
+            viewerExtraOffset=self.viewerExtraOffset,
+            previewFromWebcam=self.previewFromWebcam,
+            enableControls=self.enableControls
+            )
+
     def set(self, startPaused=None, playerMode=None, description=None, viewerExtraOffset=None, previewFromWebcam=None, enableControls=None):
         if startPaused is not None:
             self.startPaused = startPaused
@@ -1679,6 +2578,22 @@ class DocumentAsync(threading.Thread):
         self.socketOut = None
         self.channelIn = None
         self.channelOut = None
+        self.running = False
+        self.roomFrontend = str23compat(self.document.documentId)
+        self.roomUpdates = 'toBackend-' + str23compat(self.document.documentId)
+        self.roomModifications = 'toTimelines-' + str23compat(self.document.documentId)
+        # Broadcasts of the event list are done by a separate thread, which coalesces requests
+        self.broadcaster = None
+        self.broadcastCondition = threading.Condition(threading.Lock())
+        self.broadcastPending = False
+        self.broadcastsRequested = 0
+        self.broadcastsSent = 0
+        # Broadcasts are delta-encoded against the previous one. The frontend asks for a full
+        # snapshot (through requestBroadcastToFrontends(full=True)) when it has missed a version.
+        self.broadcastSendLock = threading.Lock()
+        self.broadcastVersion = 0
+        self.broadcastSnapshot = None
+        self.fullBroadcastPending = False
         if self.document.testMode:
             return
         websocket_service = GlobalSettings.websocketInternalService
@@ -1691,19 +2606,25 @@ class DocumentAsync(threading.Thread):
         self.channelIn = self.socketIn.define(SocketIONamespace, "/trigger")
         self.channelOut = self.socketOut.define(SocketIONamespace, "/trigger")
 
-        self.roomFrontend = str23compat(self.document.documentId)
-        self.roomUpdates = 'toBackend-' + str23compat(self.document.documentId)
-        self.roomModifications = 'toTimelines-' + str23compat(self.document.documentId)
-        self.channelIn.on('reconnect', self._setupChannel)
+        self.channelIn.on('reconnect', self._reconnected)
         self.channelIn.on('STATUS', self.incomingDocumentStatus)
         self._setupChannel()
         self.running = True
         self.start()
+        self._startBroadcaster()
         
+    def isConnected(self):
+        """Return True if we are connected to the websocket service (we are not in test mode)"""
+        return self.socketIn is not None
+
     def _setupChannel(self):
         self.logger.debug('DocumentAsync joining channel')
         self.channelIn.emit('JOIN', self.roomUpdates)
 
+    def _reconnected(self):
+        metrics.SOCKETIO_RECONNECTS.inc()
+        self._setupChannel()
+
     def getIncomingConnectionInfo(self):
         websocket_service = GlobalSettings.websocketInternalService
         # Remove trailing slash (not sure why it's there in the first place?)
@@ -1719,7 +2640,26 @@ class DocumentAsync(threading.Thread):
         return dict(server=websocket_service, channel='/trigger', room=self.roomModifications)
 
     def stop(self):
-        self.running = False
+        with self.broadcastCondition:
+            self.running = False
+            self.broadcastCondition.notify()
+
+    def close(self):
+        """Stop the threads and disconnect from the websocket service"""
+        self.stop()
+        for socket in (self.socketIn, self.socketOut):
+            if socket is None:
+                continue
+            try:
+                socket.disconnect()
+            except:
+                self.logger.exception('DocumentAsync: error disconnecting')
+
+    def _startBroadcaster(self):
+        self.running = True
+        self.broadcaster = threading.Thread(target=self._broadcastWorker, name='broadcaster-%s' % self.roomFrontend)
+        self.broadcaster.daemon = True
+        self.broadcaster.start()
 
     def run(self):
         self.logger.debug('DocumentAsync listener started')
@@ -1732,18 +2672,107 @@ class DocumentAsync(threading.Thread):
                 traceback.print_exc()
         self.logger.debug('DocumentAsync listener stopped')
 
-    @synchronized
-    def requestBroadcastToFrontends(self):
+    def requestBroadcastToFrontends(self, full=False):
+        """Request the event list to be sent to the frontends. Requests are coalesced by the
+        broadcaster thread: at most one broadcast is sent per GlobalSettings.broadcastInterval.
+        If full is true the next broadcast carries the complete event list in stead of a delta."""
+        with self.broadcastCondition:
+            self.broadcastsRequested += 1
+            if full:
+                self.fullBroadcastPending = True
+            if self.broadcaster is not None:
+                self.broadcastPending = True
+                self.broadcastCondition.notify()
+                return
+        # No broadcaster thread (test mode): do it synchronously
         self.broadcastEventsToFrontends()
 
-    @synchronized
+    def getBroadcastCounts(self):
+        """Return number of broadcasts requested and actually sent"""
+        with self.broadcastCondition:
+            return dict(requested=self.broadcastsRequested, sent=self.broadcastsSent)
+
+    def _broadcastWorker(self):
+        self.logger.debug('DocumentAsync broadcaster started')
+        lastBroadcast = 0
+        while True:
+            with self.broadcastCondition:
+                while self.running and not self.broadcastPending:
+                    self.broadcastCondition.wait()
+                if not self.running:
+                    break
+            # Wait out the rest of the interval, so that further requests are coalesced into this broadcast
+            delay = lastBroadcast + GlobalSettings.broadcastInterval - time.time()
+            if delay > 0:
+                time.sleep(delay)
+            with self.broadcastCondition:
+                self.broadcastPending = False
+            lastBroadcast = time.time()
+            try:
+                self.broadcastEventsToFrontends()
+            except:
+                self.logger.exception('DocumentAsync.broadcastEventsToFrontends() raised exception')
+        self.logger.debug('DocumentAsync broadcaster stopped')
+
     def broadcastEventsToFrontends(self):
-        events = self.document.events().get(caller='broadcast')
-        if not self.channelOut:
-            self.logger.debug('DocumentAsync.broadcastEventsToFrontends(...) skipped (test mode)')
-            return
-        self.logger.debug('DocumentAsync.broadcastEventsToFrontends(...)')
-        self.channelOut.emit("BROADCAST_EVENTS", self.roomFrontend, events)
+        with self.broadcastSendLock:
+            with self.broadcastCondition:
+                full = self.fullBroadcastPending
+                self.fullBroadcastPending = False
+            # Take the snapshot while holding the document lock (shared, we only read), but do not hold it while sending.
+            with self.lock.reading():
+                data = self.document.events().get(caller='broadcast')
+            message = self._encodeBroadcast(data, full)
+            if message is None:
+                self.logger.debug('DocumentAsync.broadcastEventsToFrontends(...) skipped (no changes)')
+                return
+            if not self.channelOut:
+                self.logger.debug('DocumentAsync.broadcastEventsToFrontends(...) skipped (test mode)')
+                return
+            self.logger.debug('DocumentAsync.broadcastEventsToFrontends(...) version %d' % message["version"])
+            self.channelOut.emit("BROADCAST_EVENTS", self.roomFrontend, message)
+        with self.broadcastCondition:
+            self.broadcastsSent += 1
+        metrics.BROADCASTS.inc()
+
+    def _encodeBroadcast(self, data, full):
+        """Return the message to broadcast for the event list in data, relative to what was sent previously.
+        This is either a full snapshot {version, full=True, remote, events} or a delta
+        {version, baseVersion, remote, added, changed, removed[, order]}. Returns None if nothing has changed."""
+        events = data["events"]
+        remote = data["remote"]
+        ids = [e["id"] for e in events]
+        byId = dict(zip(ids, events))
+        previous = self.broadcastSnapshot
+        if len(byId) != len(ids):
+            # Duplicate ids cannot be delta-encoded
+            full = True
+        if previous is None:
+            full = True
+        if full:
+            self.broadcastVersion += 1
+            self.broadcastSnapshot = (ids, byId, remote)
+            return dict(version=self.broadcastVersion, full=True, remote=remote, events=events)
+        oldIds, oldById, oldRemote = previous
+        added = [e for e in events if e["id"] not in oldById]
+        changed = [e for e in events if e["id"] in oldById and oldById[e["id"]] is not e and oldById[e["id"]] != e]
+        removed = [i for i in oldIds if i not in byId]
+        if not added and not changed and not removed and ids == oldIds and remote == oldRemote:
+            return None
+        self.broadcastVersion += 1
+        self.broadcastSnapshot = (ids, byId, remote)
+        rv = dict(
+            version=self.broadcastVersion,
+            baseVersion=self.broadcastVersion-1,
+            remote=remote,
+            added=added,
+            changed=changed,
+            removed=removed
+            )
+        # Only send the ordering if the frontend cannot reconstruct it by removing and appending
+        if [i for i in oldIds if i in byId] + [e["id"] for e in added] != ids:
+            rv["order"] = ids
+        return rv
 
     def forwardDocumentModifications(self, modifications):
         if not self.channelOut:
@@ -1754,6 +2783,7 @@ class DocumentAsync(threading.Thread):
 
     def incomingDocumentStatus(self, documentState):
         self.logger.debug('DocumentAsync.incomingDocumentStatus(%s)' % repr(documentState))
+        self.document.touch()
         self.document.serve()._setDocumentState(documentState)
 
 class DocumentEditing:
@@ -1765,15 +2795,21 @@ class DocumentEditing:
         self.logger.debug('DocumentEditing: created')
         threading.Thread.__init__(self)
 
+    @synchronizedRead
     def getChapters(self):
         """Return complete chapter tree.
         Returns: {id=str, name=str, tracks=[{id=str, region=str}], chapters=[...]}
         """
-        exprChapter = ".//tl:par[@au:type='chapter']"
-        rootChapterElt = self.tree.getroot().find(exprChapter, NAMESPACES)
+        # Equivalent to XPath .//tl:par[@au:type='chapter'], but using the attribute index
+        rootChapterElt = None
+        for elt in self.document._getElementsByAttribute(NS_AUTH('type'), 'chapter'):
+            if elt.tag == NS_TIMELINE('par') and elt is not self.tree.getroot():
+                rootChapterElt = elt
+                break
         rv = self._getChapterInfo(rootChapterElt, includeChapters=True, includeElements=True)
         return rv
 
+    @synchronizedRead
     def getChapter(self, chapterId):
         """Return per-chapter datastructure.
         Returns: {id=str, name=str, tracks=[{id=str, region=str, elements=[{asset=str, begin=float, dur=float}]}]}
@@ -1828,6 +2864,7 @@ class DocumentEditing:
             rv['chapters'] = chapterList
         return rv
 
+    @synchronizedRead
     def getAssets(self):
         """Return complete list of assets.
         Returns [{id=str, name=str, description=str, previewUrl=str}]
@@ -1843,6 +2880,7 @@ class DocumentEditing:
             rv.append(dict(id=id, name=name, description=descr, previewUrl=url, duration=duration))
         return rv
 
+    @synchronizedRead
     def getLayout(self):
         """Return complete layout.
         Returns {devices=[{type=str, orientation=str, name=str, areas=[{region=str, x=float, y=float, w=float, h=float}]}], regions=[{id=str, name=str, color=str}]}
@@ -1892,8 +2930,8 @@ class DocumentEditing:
         pos = list(parentElt).index(chapterElt)
         newElt = self._createChapter()
         parentElt.insert(pos, newElt)
+        self.document._ensureId(newElt, register=False)
         self.document._elementAdded(newElt, parentElt)
-        self.document._ensureId(newElt)
         newID = newElt.get(NS_XML("id"))
         return newID
 
@@ -1910,8 +2948,8 @@ class DocumentEditing:
             parentElt.append(newElt)
         else:
             parentElt.insert(pos+1, newElt)
+        self.document._ensureId(newElt, register=False)
         self.document._elementAdded(newElt, parentElt)
-        self.document._ensureId(newElt)
         newID = newElt.get(NS_XML("id"))
         return newID
 
@@ -1925,8 +2963,8 @@ class DocumentEditing:
         newElt = self._createChapter()
         # xxxjack should move content from chapterElt into newElt
         subChapterListElt.append(newElt)
+        self.document._ensureId(newElt, register=False)
         self.document._elementAdded(newElt, subChapterListElt)
-        self.document._ensureId(newElt)
         newID = newElt.get(NS_XML("id"))
         return newID
 
@@ -1942,8 +2980,8 @@ class DocumentEditing:
             }
         newElt = ET.Element(NS_TIMELINE("seq"), data)
         chapterElt.append(newElt)
+        self.document._ensureId(newElt, register=False)
         self.document._elementAdded(newElt, chapterElt)
-        self.document._ensureId(newElt)
         return newElt
 
     @edit
@@ -1971,8 +3009,8 @@ class DocumentEditing:
         regionElt = self.document._getElementByID(regionID)
         trackElt = self._createTrack(regionID)
         chapterElt.append(trackElt)
+        self.document._ensureId(trackElt, register=False)
         self.document._elementAdded(trackElt, chapterElt)
-        self.document._ensureId(trackElt)
         newID = trackElt.get(NS_XML("id"))
         return newID
 
@@ -2008,8 +3046,8 @@ class DocumentEditing:
         else:
             trackElt.insert(int(insertPosition), newElt)
 
+        self.document._ensureId(newElt, register=False)
         self.document._elementAdded(newElt, trackElt)
-        self.document._ensureId(newElt)
         newID = newElt.get(NS_XML("id"))
         return newID
 
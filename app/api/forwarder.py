@@ -0,0 +1,137 @@
+"""Copyright 2018 Centrum Wiskunde & Informatica
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+from __future__ import absolute_import
+from __future__ import unicode_literals
+from future import standard_library
+standard_library.install_aliases()
+from builtins import object
+from builtins import range
+import threading
+import time
+import collections
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from .globalSettings import GlobalSettings
+from . import metrics
+
+# Client errors that are worth retrying: request timeout and too many requests
+RETRYABLE_STATUS = (408, 429)
+
+#
+# All callback senders share a single bounded pool of worker threads.
+#
+_executor = None
+_executorLock = threading.Lock()
+
+def _getExecutor():
+    global _executor
+    with _executorLock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=GlobalSettings.forwardWorkers)
+        return _executor
+
+class CallbackSender(object):
+    """Sends messages to a single REST callback URL. Messages are queued and PUT in order by a
+    worker from the shared pool, using a keep-alive session. Each PUT has a timeout and is retried
+    with exponential backoff. When a message cannot be delivered the sender closes itself and
+    calls onFailure(sender)."""
+
+    def __init__(self, url, onFailure, logger, loggerExtra=None):
+        self.url = url
+        self.onFailure = onFailure
+        self.logger = logger
+        self.loggerExtra = loggerExtra
+        self.session = requests.Session()
+        self.lock = threading.Lock()
+        self.idle = threading.Condition(self.lock)
+        self.queue = collections.deque()
+        self.busy = False
+        self.dead = False
+
+    def send(self, message):
+        """Queue a message for delivery. Returns False if this sender is dead."""
+        with self.lock:
+            if self.dead:
+                return False
+            self.queue.append(message)
+            if self.busy:
+                return True
+            self.busy = True
+        _getExecutor().submit(self._drain)
+        return True
+
+    def close(self):
+        """Stop sending, and drop any queued messages"""
+        with self.lock:
+            self.dead = True
+            self.queue.clear()
+        self.session.close()
+
+    def waitIdle(self, timeout=None):
+        """Wait until all queued messages have been delivered (or dropped). Returns True if idle."""
+        with self.lock:
+            if timeout is None:
+                while self.busy:
+                    self.idle.wait()
+            else:
+                deadline = time.time() + timeout
+                while self.busy:
+                    remaining = deadline - time.time()
+                    if remaining <= 0:
+                        break
+                    self.idle.wait(remaining)
+            return not self.busy
+
+    def _drain(self):
+        while True:
+            with self.lock:
+                if self.dead or not self.queue:
+                    self.busy = False
+                    self.idle.notify_all()
+                    return
+                message = self.queue.popleft()
+            if not self._put(message):
+                self.close()
+                try:
+                    self.onFailure(self)
+                finally:
+                    with self.lock:
+                        self.busy = False
+                        self.idle.notify_all()
+                return
+
+    def _put(self, message):
+        """PUT a single message, retrying on failure. Returns True if delivered."""
+        attempts = GlobalSettings.forwardRetries + 1
+        for attempt in range(attempts):
+            if attempt:
+                time.sleep(GlobalSettings.forwardBackoff * (2 ** (attempt-1)))
+            requestStartTime = time.time()
+            try:
+                r = self.session.put(self.url, json=message, timeout=GlobalSettings.forwardTimeout)
+                r.raise_for_status()
+            except requests.exceptions.RequestException as e:
+                self.logger.warning("forward: PUT attempt %d of %d failed for %s: %s" % (attempt+1, attempts, self.url, e), extra=self.loggerExtra)
+                response = getattr(e, 'response', None)
+                if response is not None and 400 <= response.status_code < 500 and response.status_code not in RETRYABLE_STATUS:
+                    # Client errors will not go away by retrying
+                    return False
+                continue
+            requestDuration = time.time() - requestStartTime
+            metrics.CALLBACK_PUT_DURATION.observe(requestDuration)
+            if requestDuration > 2:
+                self.logger.warning("forward: PUT took %d seconds for %s" % (requestDuration, self.url), extra=self.loggerExtra)
+            return True
+        return False
@@ -58,6 +58,153 @@ class GlobalSettings(object):
     # Mode in which the preview player runs (tv or standalone)
     mode = "standalone"
 
+    # Event list broadcasts to the trigger tool frontends are coalesced: at most
+    # one is sent per this many seconds
+    broadcastInterval = float(os.getenv(
+        "BROADCAST_INTERVAL",
+        "0.05"
+        ))
+
+    # Forwarding document operations to REST callbacks: number of worker threads
+    # shared by all documents, timeout per PUT, and retries (with exponential
+    # backoff starting at forwardBackoff seconds) before a callback is dropped
+    forwardWorkers = int(os.getenv(
+        "FORWARD_WORKERS",
+        "8"
+        ))
+    forwardTimeout = float(os.getenv(
+        "FORWARD_TIMEOUT",
+        "5"
+        ))
+    forwardRetries = int(os.getenv(
+        "FORWARD_RETRIES",
+        "2"
+        ))
+    forwardBackoff = float(os.getenv(
+        "FORWARD_BACKOFF",
+        "0.5"
+        ))
+
+    # Documents larger than this many bytes are refused when loading (0 means no limit)
+    maxDocumentSize = int(os.getenv(
+        "MAX_DOCUMENT_SIZE",
+        str(64*1024*1024)
+        ))
+
+    # Number of documents that are loaded concurrently in the background
+    loadWorkers = int(os.getenv(
+        "LOAD_WORKERS",
+        "4"
+        ))
+
+    # Fetching layout and client documents: connection pool size, timeout, number of
+    # cached documents, how long a response is considered fresh if the server does
+    # not specify max-age, and interval for refreshing documents in use in the
+    # background (0 disables background refresh)
+    httpPoolSize = int(os.getenv(
+        "HTTP_POOL_SIZE",
+        "32"
+        ))
+    httpTimeout = float(os.getenv(
+        "HTTP_TIMEOUT",
+        "10"
+        ))
+    httpCacheEntries = int(os.getenv(
+        "HTTP_CACHE_ENTRIES",
+        "256"
+        ))
+    httpCacheMaxAge = int(os.getenv(
+        "HTTP_CACHE_MAX_AGE",
+        "10"
+        ))
+    httpCacheRefreshInterval = float(os.getenv(
+        "HTTP_CACHE_REFRESH_INTERVAL",
+        "0"
+        ))
+
+    # Persistent document store: directory (documents are not persisted if unset), interval
+    # between snapshots of modified documents, and how long journal writes are collected
+    # before they are committed to disk together
+    persistenceDirectory = os.getenv(
+        "PERSISTENCE_DIRECTORY",
+        None
+        )
+    snapshotInterval = float(os.getenv(
+        "SNAPSHOT_INTERVAL",
+        "30"
+        ))
+    journalFlushInterval = float(os.getenv(
+        "JOURNAL_FLUSH_INTERVAL",
+        "0.05"
+        ))
+
+    # In-memory documents: approximate memory budget in bytes (0 means no limit), how long a
+    # document must be unused before it may be spilled to disk when over budget (this is also
+    # the interval at which the budget is checked), and the directory for spilled documents if
+    # persistenceDirectory is not set (a temporary directory if this is not set either)
+    documentMemoryBudget = int(os.getenv(
+        "DOCUMENT_MEMORY_BUDGET",
+        str(1024*1024*1024)
+        ))
+    documentIdleTime = float(os.getenv(
+        "DOCUMENT_IDLE_TIME",
+        "300"
+        ))
+    spillDirectory = os.getenv(
+        "SPILL_DIRECTORY",
+        None
+        )
+
+    # Multi-process mode: number of worker processes (1 means a single process without router)
+    # and the port of the first worker. The supervisor passes WORKER_INDEX, WORKER_COUNT and
+    # WORKER_PORT to every worker.
+    workers = int(os.getenv(
+        "WORKERS",
+        "1"
+        ))
+    workerBasePort = int(os.getenv(
+        "WORKER_BASE_PORT",
+        "8100"
+        ))
+    workerIndex = int(os.getenv(
+        "WORKER_INDEX",
+        "0"
+        ))
+    workerCount = int(os.getenv(
+        "WORKER_COUNT",
+        "1"
+        ))
+
+    # Number of generations of forwarded operations kept for clients that missed broadcasts.
+    # Clients that are further behind must refetch the timeline document.
+    historyWindow = int(os.getenv(
+        "HISTORY_WINDOW",
+        "1000"
+        ))
+
+    # The document clock follows the preview player by slewing: it runs at most clockSlewRate (a fraction)
+    # faster or slower until it has caught up. Differences of more than clockSlewLimit seconds make it jump.
+    # The offset applied for viewers (the viewerExtraOffset setting) moves at the same rate.
+    clockSlewRate = float(os.getenv(
+        "CLOCK_SLEW_RATE",
+        "0.1"
+        ))
+    clockSlewLimit = float(os.getenv(
+        "CLOCK_SLEW_LIMIT",
+        "2.0"
+        ))
+
+    # Lock profiling (wait and hold times of document and clock locks, see /api/v1/lockstats),
+    # and the hold time in seconds above which a sample of the holder is kept
+    lockProfiling = os.getenv(
+        "LOCK_PROFILING",
+        ""
+        ).lower() in ("1", "true", "yes")
+    lockSlowThreshold = float(os.getenv(
+        "LOCK_SLOW_THRESHOLD",
+        "0.1"
+        ))
+
     # Logging parameters for the authoring service
     noKibana = (kibanaService == "")
     logLevel = os.getenv(
@@ -0,0 +1,192 @@
+"""Copyright 2018 Centrum Wiskunde & Informatica
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+from __future__ import absolute_import
+from __future__ import unicode_literals
+from future import standard_library
+standard_library.install_aliases()
+from builtins import object
+import threading
+import time
+import re
+import collections
+import logging
+import requests
+import requests.adapters
+from .globalSettings import GlobalSettings
+
+logger = logging.getLogger(__name__)
+
+MAX_AGE = re.compile(r'(?:^|,)\s*max-age\s*=\s*"?(\d+)"?', re.IGNORECASE)
+
+class CacheEntry(object):
+    """A cached response body with its validators"""
+    def __init__(self, url):
+        self.url = url
+        self.text = None
+        self.etag = None
+        self.lastModified = None
+        self.expires = 0
+        self.lastUsed = 0
+        self.lastFetched = 0
+
+class HttpCache(object):
+    """Process-wide HTTP client: pooled keep-alive connections and an in-memory cache of
+    response bodies. Cached responses are served while fresh (max-age, or
+    GlobalSettings.httpCacheMaxAge if the server does not say), and revalidated with
+    If-None-Match/If-Modified-Since when stale. Concurrent requests for the same URL
+    result in a single fetch. Optionally, a background thread revalidates entries that
+    are in use before they go stale."""
+
+    def __init__(self, maxEntries=None, defaultMaxAge=None, refreshInterval=None):
+        self.maxEntries = maxEntries if maxEntries is not None else GlobalSettings.httpCacheEntries
+        self.defaultMaxAge = defaultMaxAge if defaultMaxAge is not None else GlobalSettings.httpCacheMaxAge
+        self.refreshInterval = refreshInterval if refreshInterval is not None else GlobalSettings.httpCacheRefreshInterval
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=16, pool_maxsize=GlobalSettings.httpPoolSize)
+        self.session.mount('http://', adapter)
+        self.session.mount('https://', adapter)
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()
+        self.inflight = {}
+        self.fetches = 0
+        self.hits = 0
+        self.refresher = None
+        if self.refreshInterval:
+            self.refresher = threading.Thread(target=self._refreshWorker, name='httpcache-refresh')
+            self.refresher.daemon = True
+            self.refresher.start()
+
+    def getText(self, url):
+        """Return the body of url as text, from the cache if possible. Raises requests exceptions on failure,
+        including HTTPError for error responses, which are not cached."""
+        while True:
+            with self.lock:
+                entry = self.entries.get(url)
+                now = time.time()
+                if entry is not None and entry.text is not None and now < entry.expires:
+                    self.entries.move_to_end(url)
+                    entry.lastUsed = now
+                    self.hits += 1
+                    return entry.text
+                done = self.inflight.get(url)
+                if done is None:
+                    # We are going to fetch it. Others will wait for us.
+                    done = self.inflight[url] = threading.Event()
+                    break
+            # Someone else is fetching it. Wait for them and try again.
+            done.wait()
+        try:
+            return self._fetch(url, entry)
+        finally:
+            with self.lock:
+                del self.inflight[url]
+            done.set()
+
+    def getCounts(self):
+        """Return number of network fetches (including revalidations) and cache hits"""
+        with self.lock:
+            return dict(fetches=self.fetches, hits=self.hits, entries=len(self.entries))
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+    def _fetch(self, url, entry):
+        headers = {}
+        if entry is not None and entry.text is not None:
+            if entry.etag:
+                headers['If-None-Match'] = entry.etag
+            if entry.lastModified:
+                headers['If-Modified-Since'] = entry.lastModified
+        with self.lock:
+            self.fetches += 1
+        r = self.session.get(url, headers=headers, timeout=GlobalSettings.httpTimeout)
+        if r.status_code == 304 and not headers:
+            # Not modified, but we did not revalidate so we have no body (a misbehaving proxy, for example).
+            # Ask again, and make sure we get the body this time.
+            with self.lock:
+                self.fetches += 1
+            r = self.session.get(url, headers={'Cache-Control': 'no-cache'}, timeout=GlobalSettings.httpTimeout)
+            if r.status_code == 304:
+                raise requests.exceptions.HTTPError('304 Not Modified for unconditional request for %s' % url, response=r)
+        now = time.time()
+        if r.status_code == 304:
+            text = entry.text
+        else:
+            r.raise_for_status()
+            text = r.text
+            entry = CacheEntry(url)
+            entry.text = text
+            entry.etag = r.headers.get('ETag')
+            entry.lastModified = r.headers.get('Last-Modified')
+        cacheControl = r.headers.get('Cache-Control', '')
+        if 'no-store' in cacheControl.lower():
+            with self.lock:
+                self.entries.pop(url, None)
+            return text
+        maxAge = self.defaultMaxAge
+        match = MAX_AGE.search(cacheControl)
+        if match:
+            maxAge = int(match.group(1))
+        if 'no-cache' in cacheControl.lower():
+            maxAge = 0
+        entry.expires = now + maxAge
+        entry.lastFetched = now
+        entry.lastUsed = now
+        with self.lock:
+            self.entries[url] = entry
+            self.entries.move_to_end(url)
+            while len(self.entries) > self.maxEntries:
+                self.entries.popitem(last=False)
+        return text
+
+    def _refreshWorker(self):
+        while True:
+            time.sleep(self.refreshInterval)
+            now = time.time()
+            with self.lock:
+                # Hot entries: used since they were last fetched, and going stale before the next round
+                urls = [
+                    e.url for e in self.entries.values()
+                    if e.lastUsed > e.lastFetched and e.expires < now + self.refreshInterval and e.url not in self.inflight
+                    ]
+            for url in urls:
+                with self.lock:
+                    entry = self.entries.get(url)
+                    if entry is None or url in self.inflight:
+                        continue
+                    done = self.inflight[url] = threading.Event()
+                try:
+                    self._fetch(url, entry)
+                except requests.exceptions.RequestException as e:
+                    logger.warning('httpcache: background refresh of %s failed: %s' % (url, e))
+                finally:
+                    with self.lock:
+                        del self.inflight[url]
+                    done.set()
+
+_cache = None
+_cacheLock = threading.Lock()
+
+def getCache():
+    """Return the process-wide cache"""
+    global _cache
+    with _cacheLock:
+        if _cache is None:
+            _cache = HttpCache()
+        return _cache
+
+def getText(url):
+    return getCache().getText(url)
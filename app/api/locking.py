@@ -0,0 +1,150 @@
+"""Copyright 2018 Centrum Wiskunde & Informatica
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+from __future__ import absolute_import
+from __future__ import unicode_literals
+from builtins import object
+import threading
+import time
+
+class ReadWriteLock(object):
+    """Reentrant reader/writer lock. Used as a normal lock (acquire(), release(), with) it is
+    an exclusive lock that behaves like an RLock. acquireRead()/releaseRead() (or
+    "with lock.reading()") obtain it in shared mode: any number of threads can read at the
+    same time, but not while a thread holds it exclusively.
+
+    A thread that holds the lock exclusively can also obtain it in shared mode. A thread that
+    only holds it in shared mode cannot obtain it exclusively (that would deadlock when two
+    readers try it at the same time), this raises RuntimeError. Waiting writers have
+    preference over new readers, so a steady stream of readers cannot starve edits."""
+
+    def __init__(self):
+        self._condition = threading.Condition(threading.Lock())
+        self._owner = None  # Thread holding the lock exclusively
+        self._ownerCount = 0
+        self._readers = {}  # thread -> count, for threads holding the lock in shared mode
+        self._writersWaiting = 0
+        self._reading = _ReadContext(self)
+
+    def acquire(self, blocking=True, timeout=-1):
+        me = threading.current_thread()
+        with self._condition:
+            if self._owner is me:
+                self._ownerCount += 1
+                return True
+            if me in self._readers:
+                raise RuntimeError("ReadWriteLock: cannot obtain exclusive lock while holding shared lock")
+            if not self._canWrite():
+                if not blocking:
+                    return False
+                deadline = time.time() + timeout if timeout >= 0 else None
+                self._writersWaiting += 1
+                try:
+                    while not self._canWrite():
+                        if not self._wait(deadline):
+                            return False
+                finally:
+                    self._writersWaiting -= 1
+            self._owner = me
+            self._ownerCount = 1
+            return True
+
+    def release(self):
+        with self._condition:
+            if self._owner is not threading.current_thread():
+                raise RuntimeError("ReadWriteLock: release of lock not held exclusively")
+            self._ownerCount -= 1
+            if self._ownerCount == 0:
+                self._owner = None
+                self._condition.notify_all()
+
+    __enter__ = acquire
+
+    def __exit__(self, *args):
+        self.release()
+
+    def acquireRead(self, blocking=True, timeout=-1):
+        me = threading.current_thread()
+        with self._condition:
+            if self._owner is me:
+                # Nested inside an exclusive hold: count it as such
+                self._ownerCount += 1
+                return True
+            if me in self._readers:
+                # Reentrant read: must not wait for waiting writers, they are waiting for us
+                self._readers[me] += 1
+                return True
+            if not self._canRead():
+                if not blocking:
+                    return False
+                deadline = time.time() + timeout if timeout >= 0 else None
+                while not self._canRead():
+                    if not self._wait(deadline):
+                        return False
+            self._readers[me] = 1
+            return True
+
+    def releaseRead(self):
+        me = threading.current_thread()
+        with self._condition:
+            if self._owner is me:
+                self._ownerCount -= 1
+                if self._ownerCount == 0:
+                    self._owner = None
+                    self._condition.notify_all()
+                return
+            count = self._readers.get(me)
+            if not count:
+                raise RuntimeError("ReadWriteLock: release of lock not held in shared mode")
+            if count == 1:
+                del self._readers[me]
+                if not self._readers:
+                    self._condition.notify_all()
+            else:
+                self._readers[me] = count - 1
+
+    def reading(self):
+        """Return a context manager that holds the lock in shared mode"""
+        return self._reading
+
+    def isWriting(self):
+        """Return True if the current thread holds the lock exclusively"""
+        return self._owner is threading.current_thread()
+
+    def _canWrite(self):
+        return self._owner is None and not self._readers
+
+    def _canRead(self):
+        return self._owner is None and not self._writersWaiting
+
+    def _wait(self, deadline):
+        if deadline is None:
+            self._condition.wait()
+            return True
+        remaining = deadline - time.time()
+        if remaining <= 0:
+            return False
+        self._condition.wait(remaining)
+        return True
+
+class _ReadContext(object):
+    def __init__(self, lock):
+        self.lock = lock
+
+    def __enter__(self):
+        self.lock.acquireRead()
+        return self.lock
+
+    def __exit__(self, *args):
+        self.lock.releaseRead()
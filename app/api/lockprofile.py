@@ -0,0 +1,232 @@
+"""Copyright 2018 Centrum Wiskunde & Informatica
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+from __future__ import absolute_import
+from __future__ import unicode_literals
+from builtins import object
+import os
+import sys
+import time
+import threading
+import traceback
+import collections
+from . import locking
+from .globalSettings import GlobalSettings
+
+#
+# Lock profiling: for every kind of lock (document, clock) we keep histograms of the time spent
+# waiting for the lock and the time it was held, per-call-site totals, and samples of holders that
+# held the lock for longer than GlobalSettings.lockSlowThreshold. Only the outermost acquire of a
+# reentrant lock is measured. Enabled with GlobalSettings.lockProfiling, for locks created after that.
+#
+
+# Upper bounds (seconds) of the histogram buckets, the last bucket is unbounded
+BUCKETS = (0.0001, 0.001, 0.01, 0.1, 1.0, 10.0)
+SLOW_SAMPLES = 32
+
+_IGNORED_FILES = (os.path.basename(__file__).replace('.pyc', '.py'), 'locking.py')
+
+class Histogram(object):
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def add(self, value):
+        index = 0
+        for bound in BUCKETS:
+            if value <= bound:
+                break
+            index += 1
+        self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+        if value > self.max:
+            self.max = value
+
+    def get(self):
+        return dict(buckets=list(BUCKETS), counts=list(self.counts), count=self.count, sum=self.sum, max=self.max)
+
+class LockStats(object):
+    """Statistics for all locks of one kind"""
+    def __init__(self, name):
+        self.name = name
+        self.lock = threading.Lock()
+        self.wait = Histogram()
+        self.hold = Histogram()
+        self.sites = {}  # call site -> [count, holdSum, holdMax, waitSum]
+        self.slow = collections.deque(maxlen=SLOW_SAMPLES)
+
+    def record(self, site, wait, hold):
+        slow = hold >= GlobalSettings.lockSlowThreshold
+        if slow:
+            # Only slow holders pay for a stack trace
+            stack = traceback.format_stack(limit=8)[:-2]
+        with self.lock:
+            self.wait.add(wait)
+            self.hold.add(hold)
+            siteStats = self.sites.get(site)
+            if siteStats is None:
+                siteStats = self.sites[site] = [0, 0.0, 0.0, 0.0]
+            siteStats[0] += 1
+            siteStats[1] += hold
+            if hold > siteStats[2]:
+                siteStats[2] = hold
+            siteStats[3] += wait
+            if slow:
+                self.slow.append(dict(site=site, hold=hold, wait=wait, time=time.time(), thread=threading.current_thread().name, stack=stack))
+
+    def get(self):
+        with self.lock:
+            sites = dict(
+                (site, dict(count=s[0], holdSum=s[1], holdMax=s[2], waitSum=s[3]))
+                for site, s in self.sites.items()
+                )
+            return dict(wait=self.wait.get(), hold=self.hold.get(), sites=sites, slow=list(self.slow))
+
+_stats = {}
+_statsLock = threading.Lock()
+
+def isEnabled():
+    return GlobalSettings.lockProfiling
+
+def getLockStats(name):
+    with _statsLock:
+        stats = _stats.get(name)
+        if stats is None:
+            stats = _stats[name] = LockStats(name)
+        return stats
+
+def getStats():
+    """Return statistics of all kinds of locks"""
+    with _statsLock:
+        allStats = list(_stats.values())
+    return dict(
+        enabled=GlobalSettings.lockProfiling,
+        slowThreshold=GlobalSettings.lockSlowThreshold,
+        locks=dict((stats.name, stats.get()) for stats in allStats)
+        )
+
+def reset():
+    with _statsLock:
+        _stats.clear()
+
+def callSite():
+    """Return "file:function" of the code that is acquiring the lock. For methods decorated with
+    @synchronized and friends this is the decorated method."""
+    frame = sys._getframe(2)
+    while frame is not None:
+        code = frame.f_code
+        filename = os.path.basename(code.co_filename)
+        if code.co_name == 'wrapper' and 'method' in frame.f_locals:
+            method = frame.f_locals['method']
+            return '%s:%s' % (filename, getattr(method, '__qualname__', method.__name__))
+        if filename not in _IGNORED_FILES and code.co_name not in ('__enter__', 'wrapper'):
+            return '%s:%s' % (filename, code.co_name)
+        frame = frame.f_back
+    return '?'
+
+class ProfiledRLock(object):
+    """threading.RLock that records its statistics under name"""
+
+    def __init__(self, name):
+        self._lock = threading.RLock()
+        self.stats = getLockStats(name)
+        self._depth = 0
+        self._acquired = 0
+        self._wait = 0
+        self._site = None
+
+    def acquire(self, blocking=True, timeout=-1):
+        t0 = time.time()
+        if not self._lock.acquire(blocking, timeout):
+            return False
+        self._depth += 1
+        if self._depth == 1:
+            self._acquired = time.time()
+            self._wait = self._acquired - t0
+            self._site = callSite()
+        return True
+
+    def release(self):
+        self._depth -= 1
+        if self._depth:
+            self._lock.release()
+            return
+        hold = time.time() - self._acquired
+        site = self._site
+        wait = self._wait
+        self._lock.release()
+        self.stats.record(site, wait, hold)
+
+    __enter__ = acquire
+
+    def __exit__(self, *args):
+        self.release()
+
+class ProfiledReadWriteLock(locking.ReadWriteLock):
+    """locking.ReadWriteLock that records its statistics under name. Shared holds are recorded
+    with call site suffix " (read)"."""
+
+    def __init__(self, name):
+        locking.ReadWriteLock.__init__(self)
+        self.stats = getLockStats(name)
+        self._writeStart = None
+        self._readStarts = {}  # thread -> (acquired, wait, site)
+
+    def acquire(self, blocking=True, timeout=-1):
+        t0 = time.time()
+        if not locking.ReadWriteLock.acquire(self, blocking, timeout):
+            return False
+        if self._ownerCount == 1:
+            now = time.time()
+            self._writeStart = (now, now - t0, callSite())
+        return True
+
+    __enter__ = acquire
+
+    def release(self):
+        writeStart = None
+        if self._ownerCount == 1:
+            writeStart, self._writeStart = self._writeStart, None
+        locking.ReadWriteLock.release(self)
+        if writeStart:
+            self._record(writeStart)
+
+    def acquireRead(self, blocking=True, timeout=-1):
+        t0 = time.time()
+        if not locking.ReadWriteLock.acquireRead(self, blocking, timeout):
+            return False
+        me = threading.current_thread()
+        if self._readers.get(me) == 1 and me not in self._readStarts:
+            now = time.time()
+            self._readStarts[me] = (now, now - t0, callSite() + ' (read)')
+        return True
+
+    def releaseRead(self):
+        me = threading.current_thread()
+        start = None
+        if self._owner is me:
+            if self._ownerCount == 1:
+                start, self._writeStart = self._writeStart, None
+        elif self._readers.get(me) == 1:
+            start = self._readStarts.pop(me, None)
+        locking.ReadWriteLock.releaseRead(self)
+        if start:
+            self._record(start)
+
+    def _record(self, start):
+        acquired, wait, site = start
+        self.stats.record(site, wait, time.time() - acquired)
@@ -0,0 +1,212 @@
+"""Copyright 2018 Centrum Wiskunde & Informatica
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+from __future__ import absolute_import
+from __future__ import unicode_literals
+from builtins import object
+import threading
+import logging
+
+logger = logging.getLogger(__name__)
+
+#
+# Operational metrics, exported in the Prometheus text exposition format at /api/v1/metrics.
+# Updating a metric costs a lock and a few additions. Values that need looking at all documents
+# (document and element counts) are gauges with a function that is only called when the
+# metrics are rendered. In multi-process mode the router combines the metrics of all workers,
+# adding a worker label.
+#
+
+LATENCY_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1.0, 5.0, 10.0)
+
+def _formatLabels(labelNames, labelValues, extra=None):
+    pairs = ['%s="%s"' % (k, str(v).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')) for k, v in zip(labelNames, labelValues)]
+    if extra:
+        pairs.append(extra)
+    if not pairs:
+        return ''
+    return '{' + ','.join(pairs) + '}'
+
+def _formatValue(value):
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+class _Metric(object):
+    TYPE = None
+
+    def __init__(self, name, help, labelNames=()):
+        self.name = name
+        self.help = help
+        self.labelNames = tuple(labelNames)
+        self.lock = threading.Lock()
+        self.values = {}  # label values tuple -> value
+
+    def render(self):
+        rv = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s %s' % (self.name, self.TYPE)]
+        rv += self._renderValues()
+        return rv
+
+    def _renderValues(self):
+        with self.lock:
+            items = sorted(self.values.items())
+        return ['%s%s %s' % (self.name, _formatLabels(self.labelNames, labels), _formatValue(value)) for labels, value in items]
+
+class Counter(_Metric):
+    TYPE = 'counter'
+
+    def inc(self, amount=1, labels=()):
+        with self.lock:
+            self.values[labels] = self.values.get(labels, 0) + amount
+
+    def get(self, labels=()):
+        with self.lock:
+            return self.values.get(labels, 0)
+
+class Gauge(_Metric):
+    """Gauge that is either set explicitly, or computed when rendered by a function returning the value
+    (or a list of (labels, value) for gauges with labels)"""
+    TYPE = 'gauge'
+
+    def __init__(self, name, help, labelNames=()):
+        _Metric.__init__(self, name, help, labelNames)
+        self.function = None
+
+    def set(self, value, labels=()):
+        with self.lock:
+            self.values[labels] = value
+
+    def setFunction(self, function):
+        self.function = function
+
+    def _renderValues(self):
+        if self.function:
+            try:
+                value = self.function()
+            except:
+                logger.exception('metrics: cannot compute %s' % self.name)
+                return []
+            with self.lock:
+                if self.labelNames:
+                    self.values = dict((tuple(labels), v) for labels, v in value)
+                else:
+                    self.values = {(): value}
+        return _Metric._renderValues(self)
+
+class Histogram(_Metric):
+    TYPE = 'histogram'
+
+    def __init__(self, name, help, labelNames=(), buckets=LATENCY_BUCKETS):
+        _Metric.__init__(self, name, help, labelNames)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, labels=()):
+        index = 0
+        for bound in self.buckets:
+            if value <= bound:
+                break
+            index += 1
+        with self.lock:
+            entry = self.values.get(labels)
+            if entry is None:
+                # Per-bucket counts (not cumulative), plus sum
+                entry = self.values[labels] = [[0] * (len(self.buckets) + 1), 0.0]
+            entry[0][index] += 1
+            entry[1] += value
+
+    def getCount(self, labels=()):
+        with self.lock:
+            entry = self.values.get(labels)
+            return sum(entry[0]) if entry else 0
+
+    def _renderValues(self):
+        with self.lock:
+            items = sorted((labels, (list(counts), total)) for labels, (counts, total) in self.values.items())
+        rv = []
+        for labels, (counts, total) in items:
+            rv += renderHistogram(self.name, self.labelNames, labels, self.buckets, counts, total)
+        return rv
+
+def renderHistogram(name, labelNames, labels, buckets, counts, total):
+    """Return exposition lines for a histogram given its per-bucket (not cumulative) counts"""
+    rv = []
+    cumulative = 0
+    for bound, count in zip(tuple(buckets) + (float('inf'),), counts):
+        cumulative += count
+        rv.append('%s_bucket%s %d' % (name, _formatLabels(labelNames, labels, 'le="%s"' % _formatValue(float(bound))), cumulative))
+    rv.append('%s_sum%s %s' % (name, _formatLabels(labelNames, labels), _formatValue(float(total))))
+    rv.append('%s_count%s %d' % (name, _formatLabels(labelNames, labels), cumulative))
+    return rv
+
+class Registry(object):
+    def __init__(self):
+        self.metrics = []
+        self.collectors = []
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def addCollector(self, collector):
+        """Add a function returning extra exposition lines"""
+        self.collectors.append(collector)
+
+    def render(self):
+        rv = []
+        for metric in self.metrics:
+            rv += metric.render()
+        for collector in self.collectors:
+            try:
+                rv += collector()
+            except:
+                logger.exception('metrics: collector failed')
+        return '\n'.join(rv) + '\n'
+
+REGISTRY = Registry()
+
+REQUEST_DURATION = REGISTRY.register(Histogram(
+    'authoring_request_duration_seconds',
+    'Time to handle a REST request (until the response starts), per route family',
+    ('family',)))
+DOCUMENTS = REGISTRY.register(Gauge(
+    'authoring_documents',
+    'Number of documents, by where they are kept',
+    ('where',)))
+ELEMENTS = REGISTRY.register(Gauge(
+    'authoring_document_elements',
+    'Total number of elements in the documents in memory'))
+HISTORY_ENTRIES = REGISTRY.register(Gauge(
+    'authoring_history_entries',
+    'Total number of generations with operations in the operation histories of the documents in memory'))
+BROADCASTS = REGISTRY.register(Counter(
+    'authoring_broadcasts_total',
+    'Event list broadcasts sent to the frontends'))
+FORWARD_DURATION = REGISTRY.register(Histogram(
+    'authoring_forward_duration_seconds',
+    'Time to fan out document modifications to the websocket and REST listeners'))
+CALLBACK_PUT_DURATION = REGISTRY.register(Histogram(
+    'authoring_callback_put_duration_seconds',
+    'Time for a single PUT of document modifications to a REST callback (timeline service)'))
+SOCKETIO_RECONNECTS = REGISTRY.register(Counter(
+    'authoring_socketio_reconnects_total',
+    'Reconnects of the socket.io connections to the websocket service'))
+LATE_CALLBACKS = REGISTRY.register(Counter(
+    'authoring_clock_late_callbacks_total',
+    'Clock callbacks that were run more than 0.1 seconds late'))
+CALLBACK_LATENESS = REGISTRY.register(Histogram(
+    'authoring_clock_callback_lateness_seconds',
+    'How late clock callbacks were taken from the queue, relative to their scheduled time'))
+
+def render():
+    return REGISTRY.render()
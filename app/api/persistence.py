@@ -0,0 +1,238 @@
+"""Copyright 2018 Centrum Wiskunde & Informatica
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+from __future__ import absolute_import
+from __future__ import unicode_literals
+from future import standard_library
+standard_library.install_aliases()
+from builtins import object
+import os
+import json
+import uuid
+import time
+import shutil
+import threading
+import logging
+from .globalSettings import GlobalSettings
+
+logger = logging.getLogger(__name__)
+
+#
+# A document store keeps every document as a snapshot (the complete live document plus metadata,
+# including the sequence number of the last journal entry it contains) and a journal of edit
+# command lists made after that snapshot. FilesystemDocumentStore is the only implementation; other
+# stores need the same methods.
+#
+
+class FilesystemDocumentStore(object):
+    """Stores every document in its own directory, as snapshot.json plus journal.jsonl. Journal
+    entries are group-committed: appendJournal only queues them, and a flusher thread writes and
+    fsyncs everything queued at most every flushInterval seconds."""
+
+    SNAPSHOT = 'snapshot.json'
+    JOURNAL = 'journal.jsonl'
+
+    def __init__(self, directory, flushInterval=None):
+        self.directory = directory
+        self.flushInterval = flushInterval if flushInterval is not None else GlobalSettings.journalFlushInterval
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        self.lock = threading.Lock()
+        self.pendingChanged = threading.Condition(self.lock)
+        self.pending = {}
+        self.fileLock = threading.Lock()
+        self.running = True
+        self.flushes = 0
+        self.flusher = threading.Thread(target=self._flushWorker, name='journal-flusher')
+        self.flusher.daemon = True
+        self.flusher.start()
+
+    def _path(self, documentId, name=None):
+        if name is None:
+            return os.path.join(self.directory, str(documentId))
+        return os.path.join(self.directory, str(documentId), name)
+
+    def listDocuments(self):
+        """Return the ids of all stored documents"""
+        rv = []
+        for name in sorted(os.listdir(self.directory)):
+            if os.path.exists(self._path(name, self.SNAPSHOT)):
+                try:
+                    rv.append(uuid.UUID(name))
+                except ValueError:
+                    pass
+        return rv
+
+    def saveSnapshot(self, documentId, data, meta):
+        content = json.dumps(dict(meta=meta, data=data))
+        with self.fileLock:
+            dirname = self._path(documentId)
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            self._writeFile(self._path(documentId, self.SNAPSHOT), content)
+
+    def loadSnapshot(self, documentId):
+        """Return (data, meta) of the last snapshot, or None"""
+        filename = self._path(documentId, self.SNAPSHOT)
+        if not os.path.exists(filename):
+            return None
+        with open(filename) as fp:
+            content = json.load(fp)
+        return content['data'], content['meta']
+
+    def appendJournal(self, documentId, entry):
+        """Append entry (a dict with at least seq) to the journal. Returns before it is on disk."""
+        # Serialize now: the commands may be modified by the caller after we return
+        line = json.dumps(entry)
+        with self.pendingChanged:
+            self.pending.setdefault(str(documentId), []).append(line)
+            self.pendingChanged.notify()
+
+    def readJournal(self, documentId):
+        """Return list of journal entries, oldest first"""
+        filename = self._path(documentId, self.JOURNAL)
+        rv = []
+        if not os.path.exists(filename):
+            return rv
+        with open(filename) as fp:
+            for line in fp:
+                try:
+                    rv.append(json.loads(line))
+                except ValueError:
+                    # Torn write at the end of the journal
+                    logger.warning('readJournal(%s): ignoring unreadable entry after seq %s' % (documentId, rv[-1]['seq'] if rv else None))
+                    break
+        return rv
+
+    def compactJournal(self, documentId, seq):
+        """Drop journal entries with sequence number seq or lower, they are in the snapshot"""
+        with self.fileLock:
+            self._flushPending()
+            entries = [json.dumps(e) for e in self.readJournal(documentId) if e['seq'] > seq]
+            filename = self._path(documentId, self.JOURNAL)
+            if entries or os.path.exists(filename):
+                self._writeFile(filename, ''.join(e + '\n' for e in entries))
+
+    def deleteDocument(self, documentId):
+        with self.fileLock:
+            with self.lock:
+                self.pending.pop(str(documentId), None)
+            shutil.rmtree(self._path(documentId), ignore_errors=True)
+
+    def flush(self):
+        """Write all journal entries to stable storage"""
+        with self.fileLock:
+            self._flushPending()
+
+    def close(self):
+        with self.pendingChanged:
+            self.running = False
+            self.pendingChanged.notify()
+        self.flush()
+
+    def _writeFile(self, filename, content):
+        """Atomically replace filename with content"""
+        tmpFilename = filename + '.tmp'
+        with open(tmpFilename, 'w') as fp:
+            fp.write(content)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(tmpFilename, filename)
+
+    def _flushPending(self):
+        """Write all queued journal entries, one write and fsync per document. Call with fileLock held."""
+        with self.lock:
+            pending = self.pending
+            self.pending = {}
+        for documentId, lines in pending.items():
+            dirname = self._path(documentId)
+            if not os.path.isdir(dirname):
+                os.makedirs(dirname)
+            with open(self._path(documentId, self.JOURNAL), 'a') as fp:
+                fp.write(''.join(line + '\n' for line in lines))
+                fp.flush()
+                os.fsync(fp.fileno())
+        if pending:
+            self.flushes += 1
+
+    def _flushWorker(self):
+        while True:
+            with self.pendingChanged:
+                while self.running and not self.pending:
+                    self.pendingChanged.wait()
+                if not self.running:
+                    return
+            # Give other edits the chance to join this commit
+            time.sleep(self.flushInterval)
+            try:
+                self.flush()
+            except:
+                logger.exception('journal flush failed')
+
+class DocumentPersister(threading.Thread):
+    """Thread that snapshots modified documents every interval seconds"""
+
+    def __init__(self, documents, interval=None):
+        threading.Thread.__init__(self, name='document-persister')
+        self.daemon = True
+        self.documents = documents
+        self.interval = interval if interval is not None else GlobalSettings.snapshotInterval
+        self.running = True
+
+    def run(self):
+        while self.running:
+            time.sleep(self.interval)
+            self.snapshotAll()
+
+    def snapshotAll(self):
+        for doc in list(self.documents.values()):
+            try:
+                if doc.needsSnapshot():
+                    doc.snapshot()
+            except:
+                logger.exception('snapshot of document %s failed' % doc.documentId)
+
+def restoreDocument(store, documentId, documentClass, persist=True):
+    """Recreate a document from store: load the snapshot and replay the journal entries made after it.
+    If persist is true the document is persisted in store from then on."""
+    snapshot = store.loadSnapshot(documentId)
+    if snapshot is None:
+        raise KeyError(documentId)
+    data, meta = snapshot
+    doc = documentClass(documentId)
+    doc.restore(data, meta)
+    replayed = 0
+    for entry in store.readJournal(documentId):
+        if entry['seq'] <= doc.journalSeq:
+            continue
+        doc.replay(entry)
+        replayed += 1
+    logger.info('restored document %s (%d journal entries replayed)' % (documentId, replayed))
+    if persist:
+        doc.setStore(store)
+    return doc
+
+def restoreDocuments(store, documentClass, accept=None):
+    """Recreate all documents in store (for which accept(documentId) is true). Returns list of documents."""
+    rv = []
+    for documentId in store.listDocuments():
+        if accept and not accept(documentId):
+            continue
+        try:
+            doc = restoreDocument(store, documentId, documentClass)
+        except:
+            logger.exception('could not restore document %s' % documentId)
+            continue
+        rv.append(doc)
+    return rv
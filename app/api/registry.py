@@ -0,0 +1,250 @@
+"""Copyright 2018 Centrum Wiskunde & Informatica
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+from __future__ import absolute_import
+from __future__ import unicode_literals
+from future import standard_library
+standard_library.install_aliases()
+from builtins import object
+import time
+import tempfile
+import threading
+import collections
+import logging
+from . import persistence
+from .globalSettings import GlobalSettings
+
+logger = logging.getLogger(__name__)
+
+class DocumentRegistry(object):
+    """All documents, by documentId. Documents are kept in memory up to an approximate memory
+    budget. When over budget, documents that have not been used for idleTime seconds are
+    spilled to a document store, least recently used first. Their threads are stopped. Documents
+    that live clients are connected to (see Document.isLive()) are never spilled. Spilled
+    documents are restored transparently when they are accessed again.
+
+    Iterating, len() and "in" include spilled documents, values() and items() only return the
+    documents in memory."""
+
+    def __init__(self, documentClass, memoryBudget=None, idleTime=None, spillDirectory=None):
+        self.documentClass = documentClass
+        self.memoryBudget = memoryBudget if memoryBudget is not None else GlobalSettings.documentMemoryBudget
+        self.idleTime = idleTime if idleTime is not None else GlobalSettings.documentIdleTime
+        self.spillDirectory = spillDirectory if spillDirectory is not None else GlobalSettings.spillDirectory
+        self.lock = threading.RLock()
+        self.changed = threading.Condition(self.lock)
+        self.resident = collections.OrderedDict()  # documentId -> document, least recently used first
+        self.spilled = {}  # documentId -> (store, description)
+        self.busy = set()  # documentIds being spilled or restored, without holding the lock
+        self.store = None
+        self.spillStore = None
+        self.evictions = 0
+        self.restores = 0
+        self.sweeper = None
+
+    def setStore(self, store):
+        """Spill documents to store (the persistent store) in stead of a private one"""
+        self.store = store
+
+    def start(self):
+        """Start a thread that checks the memory budget every idleTime seconds"""
+        if self.sweeper or not self.memoryBudget:
+            return
+        self.sweeper = threading.Thread(target=self._sweepWorker, name='document-registry')
+        self.sweeper.daemon = True
+        self.sweeper.start()
+
+    def _waitNotBusy(self, documentId):
+        """Wait until documentId is not being spilled or restored. Call with the lock held."""
+        while documentId in self.busy:
+            self.changed.wait()
+
+    def _setNotBusy(self, documentId):
+        with self.lock:
+            self.busy.discard(documentId)
+            self.changed.notify_all()
+
+    def __getitem__(self, documentId):
+        with self.lock:
+            self._waitNotBusy(documentId)
+            doc = self.resident.get(documentId)
+            if doc is not None:
+                self.resident.move_to_end(documentId)
+                doc.touch()
+                return doc
+            if documentId not in self.spilled:
+                raise KeyError(documentId)
+            # Restore without holding the lock, so lookups of other documents can continue
+            self.busy.add(documentId)
+        try:
+            doc = self._restore(documentId)
+        finally:
+            self._setNotBusy(documentId)
+        doc.touch()
+        self.evict(keep=documentId)
+        return doc
+
+    def get(self, documentId, default=None):
+        try:
+            return self[documentId]
+        except KeyError:
+            return default
+
+    def __setitem__(self, documentId, doc):
+        with self.lock:
+            self._waitNotBusy(documentId)
+            self.spilled.pop(documentId, None)
+            self.resident[documentId] = doc
+            self.resident.move_to_end(documentId)
+            doc.touch()
+        self.evict(keep=documentId)
+
+    def __delitem__(self, documentId):
+        doc = None
+        with self.lock:
+            self._waitNotBusy(documentId)
+            if documentId in self.resident:
+                doc = self.resident.pop(documentId)
+                store = doc.store
+            elif documentId in self.spilled:
+                store, _ = self.spilled.pop(documentId)
+            else:
+                raise KeyError(documentId)
+        # Not holding the lock: closing takes the document lock
+        if doc is not None:
+            doc.close()
+        if store is not None and store is self.spillStore:
+            store.deleteDocument(documentId)
+
+    def __contains__(self, documentId):
+        with self.lock:
+            return documentId in self.resident or documentId in self.spilled
+
+    def __len__(self):
+        with self.lock:
+            return len(self.resident) + len(self.spilled)
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def keys(self):
+        with self.lock:
+            return list(self.resident.keys()) + list(self.spilled.keys())
+
+    def values(self):
+        with self.lock:
+            return list(self.resident.values())
+
+    def items(self):
+        with self.lock:
+            return list(self.resident.items())
+
+    def getDescriptions(self):
+        """Return list of (documentId, description, state) for all documents, without restoring any"""
+        with self.lock:
+            rv = [(k, d.getDescription(), d.loadState) for k, d in self.resident.items()]
+            rv += [(k, description, 'loaded') for k, (store, description) in self.spilled.items()]
+            return rv
+
+    def getSize(self):
+        """Return approximate memory used by the documents in memory"""
+        return sum(doc.approximateSize() for doc in self.values())
+
+    def evict(self, keep=None):
+        """Spill idle documents (except keep), least recently used first, until we are within the memory budget.
+        Sizes are computed and documents are spilled without holding the lock."""
+        if not self.memoryBudget:
+            return
+        # Documents that are loading are locked until they are loaded, do not wait for them
+        sizes = [(documentId, doc, doc.approximateSize() if doc.loadState == 'loaded' else 0) for documentId, doc in self.items()]
+        size = sum(docSize for _, _, docSize in sizes)
+        if size <= self.memoryBudget:
+            return
+        cutoff = time.time() - self.idleTime
+        for documentId, doc, docSize in sizes:
+            if size <= self.memoryBudget:
+                break
+            # Documents with live connections (preview player, websocket) are not idle, even if nobody edits them
+            if documentId == keep or doc.lastAccess > cutoff or doc.loadState != 'loaded' or doc.isLive():
+                continue
+            if self._spill(documentId, doc):
+                size -= docSize
+        if size > self.memoryBudget:
+            logger.warning('documents use %d bytes, budget is %d, but no more documents are idle' % (size, self.memoryBudget))
+
+    def _spill(self, documentId, doc):
+        # Skip documents that are being used right now
+        if not doc.lock.acquire(False):
+            return False
+        try:
+            if doc.isLive():
+                return False
+            with self.lock:
+                if self.resident.get(documentId) is not doc or documentId in self.busy:
+                    return False
+                # Lookups of this document wait until it has been spilled
+                self.busy.add(documentId)
+            try:
+                store = doc.store
+                if store is None:
+                    store = self.store or self._getSpillStore()
+                    doc.setStore(store)
+                elif doc.needsSnapshot():
+                    doc.snapshot()
+                store.flush()
+            except:
+                logger.exception('could not spill document %s' % documentId)
+                self._setNotBusy(documentId)
+                return False
+            with self.lock:
+                del self.resident[documentId]
+                self.spilled[documentId] = (store, doc.getDescription())
+                self.evictions += 1
+            self._setNotBusy(documentId)
+        finally:
+            doc.lock.release()
+        doc.close()
+        logger.info('spilled document %s' % documentId)
+        return True
+
+    def _restore(self, documentId):
+        """Restore a spilled document. Call with documentId marked busy, without holding the lock."""
+        with self.lock:
+            store, _ = self.spilled[documentId]
+        if store is self.spillStore:
+            # Documents that were not persistent do not stay in the spill store
+            doc = persistence.restoreDocument(store, documentId, self.documentClass, persist=False)
+            store.deleteDocument(documentId)
+        else:
+            doc = persistence.restoreDocument(store, documentId, self.documentClass)
+        with self.lock:
+            del self.spilled[documentId]
+            self.resident[documentId] = doc
+            self.restores += 1
+        return doc
+
+    def _getSpillStore(self):
+        with self.lock:
+            if self.spillStore is None:
+                directory = self.spillDirectory or tempfile.mkdtemp(prefix='2immerse-spill-')
+                self.spillStore = persistence.FilesystemDocumentStore(directory)
+            return self.spillStore
+
+    def _sweepWorker(self):
+        while True:
+            time.sleep(self.idleTime or 1)
+            try:
+                self.evict()
+            except:
+                logger.exception('document registry: evict failed')
@@ -0,0 +1,305 @@
+"""Copyright 2018 Centrum Wiskunde & Informatica
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+from __future__ import absolute_import
+from __future__ import unicode_literals
+from future import standard_library
+standard_library.install_aliases()
+from builtins import object
+from builtins import range
+import os
+import re
+import sys
+import json
+import uuid
+import time
+import threading
+import collections
+import subprocess
+import urllib.parse
+import logging
+import requests
+import requests.adapters
+
+logger = logging.getLogger(__name__)
+
+#
+# Multi-process mode: a supervisor starts a number of worker processes (each a complete
+# backend) and runs a Router in front of them. Documents are sharded over the workers by
+# documentId: a worker only creates documentIds it owns, so every request for a document
+# can be sent to the right worker without any shared state.
+#
+
+API_ROOT = '/api/v1'
+DOCUMENT_PATH = re.compile(r'^%s/document/([0-9a-fA-F]{8}-?[0-9a-fA-F]{4}-?[0-9a-fA-F]{4}-?[0-9a-fA-F]{4}-?[0-9a-fA-F]{12})(/|$)' % API_ROOT)
+
+# Headers that apply to a single connection, and are not passed on by the router
+HOP_BY_HOP_HEADERS = set([
+    'connection', 'keep-alive', 'proxy-authenticate', 'proxy-authorization',
+    'te', 'trailers', 'transfer-encoding', 'upgrade'
+    ])
+
+CHUNK_SIZE = 64*1024
+
+METRIC_NAME = re.compile(r'[a-zA-Z_:][a-zA-Z0-9_:]*')
+
+def getWorkerIndex(documentId, workerCount):
+    """Return the index of the worker that owns documentId"""
+    if workerCount <= 1:
+        return 0
+    return uuid.UUID(str(documentId)).int % workerCount
+
+def newDocumentId(workerIndex, workerCount):
+    """Return a new random documentId owned by worker workerIndex"""
+    while True:
+        documentId = uuid.uuid4()
+        if getWorkerIndex(documentId, workerCount) == workerIndex:
+            return documentId
+
+def addWorkerLabel(line, workerIndex):
+    """Add a worker label to a sample line in the Prometheus text format"""
+    name = METRIC_NAME.match(line).group(0)
+    rest = line[len(name):]
+    label = 'worker="%d"' % workerIndex
+    if rest.startswith('{'):
+        return '%s{%s,%s' % (name, label, rest[1:])
+    return '%s{%s}%s' % (name, label, rest)
+
+def mergeLockStats(allStats):
+    """Merge the lockstats of the workers, given as a list of (workerIndex, stats). Histograms and
+    call site totals are added up, slow holder samples are combined and get the worker index."""
+    rv = dict(enabled=False, slowThreshold=None, locks={})
+    for index, stats in allStats:
+        rv['enabled'] = rv['enabled'] or stats['enabled']
+        if rv['slowThreshold'] is None:
+            rv['slowThreshold'] = stats['slowThreshold']
+        for name, lockStats in stats['locks'].items():
+            merged = rv['locks'].get(name)
+            if merged is None:
+                merged = rv['locks'][name] = dict(wait=None, hold=None, sites={}, slow=[])
+            for which in ('wait', 'hold'):
+                histogram = lockStats[which]
+                total = merged[which]
+                if total is None:
+                    merged[which] = dict(histogram, counts=list(histogram['counts']))
+                    continue
+                total['counts'] = [a+b for a, b in zip(total['counts'], histogram['counts'])]
+                total['count'] += histogram['count']
+                total['sum'] += histogram['sum']
+                total['max'] = max(total['max'], histogram['max'])
+            for site, siteStats in lockStats['sites'].items():
+                total = merged['sites'].get(site)
+                if total is None:
+                    merged['sites'][site] = dict(siteStats)
+                    continue
+                total['count'] += siteStats['count']
+                total['holdSum'] += siteStats['holdSum']
+                total['holdMax'] = max(total['holdMax'], siteStats['holdMax'])
+                total['waitSum'] += siteStats['waitSum']
+            merged['slow'] += [dict(sample, worker=index) for sample in lockStats['slow']]
+    for merged in rv['locks'].values():
+        merged['slow'].sort(key=lambda sample: sample['time'])
+    return rv
+
+class Router(object):
+    """WSGI application that proxies requests to the workers. Document requests go to the owning
+    worker, new documents are spread round-robin, the document listing, metrics and lock statistics
+    are aggregated over all workers and configuration changes are sent to all workers. Everything
+    else goes to the first worker."""
+
+    def __init__(self, workerUrls, timeout=None):
+        self.workerUrls = list(workerUrls)
+        self.timeout = timeout
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=len(self.workerUrls), pool_maxsize=64)
+        self.session.mount('http://', adapter)
+        self.lock = threading.Lock()
+        self.nextWorker = 0
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        method = environ['REQUEST_METHOD']
+        match = DOCUMENT_PATH.match(path)
+        if match:
+            workerUrl = self.workerUrls[getWorkerIndex(match.group(1), len(self.workerUrls))]
+            return self._proxy(workerUrl, environ, start_response)
+        if path == API_ROOT + '/document' and method == 'GET':
+            return self._listDocuments(environ, start_response)
+        if path == API_ROOT + '/metrics' and method == 'GET':
+            return self._metrics(environ, start_response)
+        if path == API_ROOT + '/lockstats' and method == 'GET':
+            return self._lockstats(environ, start_response)
+        if path == API_ROOT + '/document' and method == 'POST':
+            with self.lock:
+                workerUrl = self.workerUrls[self.nextWorker]
+                self.nextWorker = (self.nextWorker + 1) % len(self.workerUrls)
+            return self._proxy(workerUrl, environ, start_response)
+        if path == API_ROOT + '/configuration' and method == 'PUT':
+            body = self._readBody(environ)
+            for workerUrl in self.workerUrls[1:]:
+                try:
+                    self._request(workerUrl, environ, body).close()
+                except requests.exceptions.RequestException as e:
+                    logger.error('router: configuration not sent to %s: %s' % (workerUrl, e))
+            return self._proxy(self.workerUrls[0], environ, start_response, body)
+        return self._proxy(self.workerUrls[0], environ, start_response)
+
+    def _readBody(self, environ):
+        try:
+            length = int(environ.get('CONTENT_LENGTH') or 0)
+        except ValueError:
+            length = 0
+        if length <= 0:
+            return None
+        return environ['wsgi.input'].read(length)
+
+    def _request(self, workerUrl, environ, body, stream=False):
+        headers = {}
+        for k, v in environ.items():
+            if k.startswith('HTTP_'):
+                name = k[5:].replace('_', '-').title()
+                if name.lower() not in HOP_BY_HOP_HEADERS:
+                    headers[name] = v
+        if environ.get('CONTENT_TYPE'):
+            headers['Content-Type'] = environ['CONTENT_TYPE']
+        url = workerUrl + urllib.parse.quote(environ.get('PATH_INFO', ''))
+        if environ.get('QUERY_STRING'):
+            url += '?' + environ['QUERY_STRING']
+        return self.session.request(
+            environ['REQUEST_METHOD'], url,
+            headers=headers,
+            data=body,
+            stream=stream,
+            allow_redirects=False,
+            timeout=self.timeout
+            )
+
+    def _proxy(self, workerUrl, environ, start_response, body=None):
+        if body is None:
+            body = self._readBody(environ)
+        try:
+            r = self._request(workerUrl, environ, body, stream=True)
+        except requests.exceptions.RequestException as e:
+            logger.error('router: %s not reachable: %s' % (workerUrl, e))
+            start_response('502 Bad Gateway', [('Content-Type', 'text/plain')])
+            return [b'Worker not reachable\n']
+        headers = [(k, v) for k, v in r.raw.headers.items() if k.lower() not in HOP_BY_HOP_HEADERS]
+        start_response('%d %s' % (r.status_code, r.reason), headers)
+        return self._stream(r)
+
+    def _stream(self, r):
+        try:
+            for chunk in r.raw.stream(CHUNK_SIZE, decode_content=False):
+                yield chunk
+        finally:
+            r.close()
+
+    def _getFromWorkers(self, environ, parse):
+        """Send the request to all workers, return (workerIndex, parse(response)) for those that answered"""
+        rv = []
+        for index, workerUrl in enumerate(self.workerUrls):
+            try:
+                r = self._request(workerUrl, environ, None)
+                r.raise_for_status()
+                rv.append((index, parse(r)))
+            except (requests.exceptions.RequestException, ValueError) as e:
+                logger.error('router: %s failed for %s: %s' % (environ.get('PATH_INFO'), workerUrl, e))
+        return rv
+
+    def _reply(self, start_response, data, contentType='application/json'):
+        data = data.encode('utf8')
+        start_response('200 OK', [
+            ('Content-Type', contentType),
+            ('Content-Length', str(len(data))),
+            ('Access-Control-Allow-Origin', '*')
+            ])
+        return [data]
+
+    def _listDocuments(self, environ, start_response):
+        rv = []
+        for index, documents in self._getFromWorkers(environ, lambda r: r.json()):
+            rv += documents
+        return self._reply(start_response, json.dumps(rv))
+
+    def _metrics(self, environ, start_response):
+        """Combine the metrics of all workers, with a worker label on every sample"""
+        families = collections.OrderedDict()  # metric name -> (comment lines, sample lines)
+        for index, text in self._getFromWorkers(environ, lambda r: r.text):
+            family = families.setdefault(None, ([], []))
+            for line in text.splitlines():
+                if not line:
+                    continue
+                if line.startswith('#'):
+                    fields = line.split(None, 3)
+                    if len(fields) >= 3 and fields[1] in ('HELP', 'TYPE'):
+                        family = families.setdefault(fields[2], ([], []))
+                    if line not in family[0]:
+                        family[0].append(line)
+                    continue
+                family[1].append(addWorkerLabel(line, index))
+        lines = []
+        for comments, samples in families.values():
+            lines += comments + samples
+        return self._reply(start_response, '\n'.join(lines) + '\n', 'text/plain; version=0.0.4')
+
+    def _lockstats(self, environ, start_response):
+        """Combine the lock statistics of all workers"""
+        allStats = self._getFromWorkers(environ, lambda r: r.json())
+        return self._reply(start_response, json.dumps(mergeLockStats(allStats)))
+
+class Supervisor(object):
+    """Starts workerCount worker processes running script, listening on consecutive ports
+    starting at basePort, and restarts them when they exit."""
+
+    def __init__(self, script, workerCount, basePort, restartDelay=1):
+        self.script = script
+        self.workerCount = workerCount
+        self.basePort = basePort
+        self.restartDelay = restartDelay
+        self.processes = [None] * workerCount
+        self.running = False
+        self.monitor = None
+
+    def getWorkerUrls(self):
+        return ['http://127.0.0.1:%d' % (self.basePort + i) for i in range(self.workerCount)]
+
+    def start(self):
+        self.running = True
+        for i in range(self.workerCount):
+            self._startWorker(i)
+        self.monitor = threading.Thread(target=self._monitorWorker, name='supervisor')
+        self.monitor.daemon = True
+        self.monitor.start()
+
+    def stop(self):
+        self.running = False
+        for process in self.processes:
+            if process and process.poll() is None:
+                process.terminate()
+
+    def _startWorker(self, index):
+        env = dict(os.environ)
+        env['WORKER_INDEX'] = str(index)
+        env['WORKER_COUNT'] = str(self.workerCount)
+        env['WORKER_PORT'] = str(self.basePort + index)
+        logger.info('supervisor: starting worker %d on port %d' % (index, self.basePort + index))
+        self.processes[index] = subprocess.Popen([sys.executable, self.script], env=env)
+
+    def _monitorWorker(self):
+        while self.running:
+            time.sleep(self.restartDelay)
+            for i, process in enumerate(self.processes):
+                if self.running and process.poll() is not None:
+                    logger.error('supervisor: worker %d exited with status %s, restarting' % (i, process.returncode))
+                    self._startWorker(i)
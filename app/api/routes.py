@@ -18,12 +18,15 @@ from future import standard_library
 standard_library.install_aliases()
 from app import app
 from .api import api
-from flask import Response, request, abort, redirect, jsonify
+from flask import Response, request, abort, redirect, jsonify, g
 import json
 import os
+import time
 import urllib.parse
 import urllib.request, urllib.parse, urllib.error
 from . import globalSettings
+from . import streaming
+from . import metrics
 from .globalSettings import GlobalSettings
 from app import myLogging
 
@@ -45,6 +48,38 @@ app.after_request(add_cors_headers)
 API_ROOT = '/api/v1'
 
 
+#
+# Request latency metrics, per route family (the aspect of the document the route is for)
+#
+ROUTE_FAMILIES = ('events', 'serve', 'editing', 'xml', 'remote', 'settings')
+
+def _routeFamily():
+    rule = request.url_rule
+    if rule is None:
+        return 'unknown'
+    parts = rule.rule.split('/')
+    # Per-document routes look like /api/v1/document/<uuid:documentId>/<family>/...
+    if len(parts) > 5 and parts[3] == 'document':
+        family = parts[5]
+        if family == 'viewer':
+            return 'serve'
+        if family in ROUTE_FAMILIES:
+            return family
+        return 'document'
+    return 'global'
+
+def start_request_timer():
+    g.requestStartTime = time.time()
+app.before_request(start_request_timer)
+
+def observe_request_duration(response):
+    startTime = getattr(g, 'requestStartTime', None)
+    if startTime is not None:
+        metrics.REQUEST_DURATION.observe(time.time() - startTime, (_routeFamily(),))
+    return response
+app.after_request(observe_request_duration)
+
+
 #
 # Get externally accessible URL for an endpoint. Only call while inside a request.
 #
@@ -77,6 +112,17 @@ def get_docRoot(localPath=API_ROOT):
     return docRoot
 
 
+#
+# Return a timeline document as a conditional response: clients that send the current ETag get a 304.
+#
+def _timelineResponse(timelineAndETag):
+    data, etag = timelineAndETag
+    response = Response(data, mimetype="application/xml")
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
+
 def handle_error(code, status, error):
     response = jsonify({"message": error.description})
     response.status = status
@@ -99,6 +145,16 @@ def handle_405(error):
     return handle_error(405, "Method Not Allowed", error)
 
 
+@app.errorhandler(409)
+def handle_409(error):
+    return handle_error(409, "Conflict", error)
+
+
+@app.errorhandler(410)
+def handle_410(error):
+    return handle_error(410, "Gone", error)
+
+
 #
 # Global routes
 #
@@ -134,29 +190,31 @@ def put_configuration():
 
 @app.route(API_ROOT + "/document/<uuid:documentId>", methods=["GET", "PUT"])
 def document_instance(documentId):
-    try:
-        document = api.documents[documentId]
-    except KeyError:
-        abort(404)
+    document = api.getDocument(documentId)
     return document.index()
 
 
 @app.route(API_ROOT + "/document/<uuid:documentId>", methods=["DELETE"])
 def delete_document(documentId):
-    try:
-        del api.documents[documentId]
-    except KeyError:
-        abort(404)
-
+    api.deleteDocument(documentId)
     return ""
 
 
-@app.route(API_ROOT + "/document/<uuid:documentId>/<string:verb>")
-def document_instance_verb(documentId, verb):
+@app.route(API_ROOT + "/document/<uuid:documentId>/state", methods=["GET"])
+def document_state(documentId):
+    # Not api.getDocument(): this must also work while the document is loading
     try:
         document = api.documents[documentId]
     except KeyError:
         abort(404)
+    wait = request.args.get('wait')
+    rv = document.getLoadState(wait=float(wait) if wait else None)
+    return Response(json.dumps(rv), mimetype="application/json")
+
+
+@app.route(API_ROOT + "/document/<uuid:documentId>/<string:verb>")
+def document_instance_verb(documentId, verb):
+    document = api.getDocument(documentId)
     try:
         func = getattr(document, verb)
     except AttributeError:
@@ -172,10 +230,7 @@ def document_instance_verb(documentId, verb):
 
 @app.route(API_ROOT + "/document/<uuid:documentId>/xml/copy", methods=["POST"])
 def document_xml_paste(documentId):
-    try:
-        document = api.documents[documentId]
-    except KeyError:
-        abort(404)
+    document = api.getDocument(documentId)
     xml = document.xml()
     assert xml
     rv = xml.copy(path=request.args['path'], where=request.args['where'], sourcepath=request.args['sourcepath'])
@@ -184,10 +239,7 @@ def document_xml_paste(documentId):
 
 @app.route(API_ROOT + "/document/<uuid:documentId>/xml/move", methods=["POST"])
 def document_xml_move(documentId):
-    try:
-        document = api.documents[documentId]
-    except KeyError:
-        abort(404)
+    document = api.getDocument(documentId)
     xml = document.xml()
     assert xml
     rv = xml.move(path=request.args['path'], where=request.args['where'], sourcepath=request.args['sourcepath'])
@@ -196,10 +248,7 @@ def document_xml_move(documentId):
 
 @app.route(API_ROOT + "/document/<uuid:documentId>/xml/modifyData", methods=["PUT"])
 def document_xml_modify(documentId):
-    try:
-        document = api.documents[documentId]
-    except KeyError:
-        abort(404)
+    document = api.getDocument(documentId)
     xml = document.xml()
     assert xml
     rv = xml.modifyData(path=request.args['path'], data=request.args['data'])
@@ -216,22 +265,16 @@ def document_xml_modify(documentId):
 
 @app.route(API_ROOT + "/document/<uuid:documentId>/events")
 def document_events_get(documentId):
-    try:
-        document = api.documents[documentId]
-    except KeyError:
-        abort(404)
+    document = api.getDocument(documentId)
     events = document.events()
     assert events
     rv = events.get()
-    return Response(json.dumps(rv["events"]), mimetype="application/json")
+    return streaming.jsonListResponse(rv["events"])
 
 
 @app.route(API_ROOT + "/document/<uuid:documentId>/events/<id>/trigger", methods=["POST"])
 def document_events_trigger(documentId, id):
-    try:
-        document = api.documents[documentId]
-    except KeyError:
-        abort(404)
+    document = api.getDocument(documentId)
 
     events = document.events()
     assert events
@@ -245,10 +288,7 @@ def document_events_trigger(documentId, id):
 
 @app.route(API_ROOT + "/document/<uuid:documentId>/events/<id>/enqueue", methods=["POST"])
 def document_events_enqueue(documentId, id):
-    try:
-        document = api.documents[documentId]
-    except KeyError:
-        abort(404)
+    document = api.getDocument(documentId)
 
     events = document.events()
     assert events
@@ -262,10 +302,7 @@ def document_events_enqueue(documentId, id):
 
 @app.route(API_ROOT + "/document/<uuid:documentId>/events/<id>/dequeue", methods=["POST"])
 def document_events_dequeue(documentId, id):
-    try:
-        document = api.documents[documentId]
-    except KeyError:
-        abort(404)
+    document = api.getDocument(documentId)
 
     events = document.events()
     assert events
@@ -277,10 +314,7 @@ def document_events_dequeue(documentId, id):
 
 @app.route(API_ROOT + "/document/<uuid:documentId>/events/<id>/modify", methods=["PUT"])
 def document_events_modify(documentId, id):
-    try:
-        document = api.documents[documentId]
-    except KeyError:
-        abort(404)
+    document = api.getDocument(documentId)
 
     events = document.events()
     assert events
@@ -294,12 +328,10 @@ def document_events_modify(documentId, id):
 
 @app.route(API_ROOT + "/document/<uuid:documentId>/events/requestbroadcast", methods=["GET"])
 def document_request_broadcast(documentId):
-    try:
-        document = api.documents[documentId]
-    except KeyError:
-        abort(404)
+    document = api.getDocument(documentId)
 
-    document.asynch().requestBroadcastToFrontends()
+    # Frontends call this when they have missed a delta, so send the complete list
+    document.asynch().requestBroadcastToFrontends(full=True)
 
     return ""
 
@@ -309,10 +341,7 @@ def document_request_broadcast(documentId):
 #
 @app.route(API_ROOT + "/document/<uuid:documentId>/settings")
 def document_settings_get(documentId):
-    try:
-        document = api.documents[documentId]
-    except KeyError:
-        abort(404)
+    document = api.getDocument(documentId)
     settings = document.settings()
     assert settings
     rv = settings.get(frontend=get_docRoot("/trigger"), backend=get_docRoot())
@@ -321,10 +350,7 @@ def document_settings_get(documentId):
 
 @app.route(API_ROOT + "/document/<uuid:documentId>/settings", methods=["PUT"])
 def document_settings_put(documentId):
-    try:
-        document = api.documents[documentId]
-    except KeyError:
-        abort(404)
+    document = api.getDocument(documentId)
     settings = document.settings()
     assert settings
 
@@ -339,10 +365,7 @@ def document_settings_put(documentId):
 #
 @app.route(API_ROOT + "/document/<uuid:documentId>/remote")
 def document_remote_get(documentId):
-    try:
-        document = api.documents[documentId]
-    except KeyError:
-        abort(404)
+    document = api.getDocument(documentId)
     remote = document.remote()
     assert remote
     rv = remote.get()
@@ -351,10 +374,7 @@ def document_remote_get(documentId):
 
 @app.route(API_ROOT + "/document/<uuid:documentId>/remote/control", methods=["POST"])
 def document_remote_control(documentId):
-    try:
-        document = api.documents[documentId]
-    except KeyError:
-        abort(404)
+    document = api.getDocument(documentId)
     remote = document.remote()
     assert remote
     command = request.get_json()
@@ -366,10 +386,7 @@ def document_remote_control(documentId):
 #
 @app.route(API_ROOT + "/document/<uuid:documentId>/editing/<string:verb>", methods=["GET", "POST"])
 def document_editing_verb(documentId, verb):
-    try:
-        document = api.documents[documentId]
-    except KeyError:
-        abort(404)
+    document = api.getDocument(documentId)
     editing = document.editing()
     assert editing
     try:
@@ -391,31 +408,22 @@ def document_editing_verb(documentId, verb):
 
 @app.route(API_ROOT + "/document/<uuid:documentId>/serve/timeline.xml")
 def get_timeline_document(documentId):
-    try:
-        document = api.documents[documentId]
-    except KeyError:
-        abort(404)
+    document = api.getDocument(documentId)
     serve = document.serve()
     assert serve
-    return Response(serve.get_timeline(), mimetype="application/xml")
+    return _timelineResponse(serve.get_timeline_with_etag())
 
 
 @app.route(API_ROOT + "/document/<uuid:documentId>/serve/layout.json")
 def get_layout_document(documentId):
-    try:
-        document = api.documents[documentId]
-    except KeyError:
-        abort(404)
+    document = api.getDocument(documentId)
     serve = document.serve()
     assert serve
     return Response(serve.get_layout(), mimetype="application/json")
 
 @app.route(API_ROOT + "/document/<uuid:documentId>/serve/client.json")
 def get_client_document(documentId):
-    try:
-        document = api.documents[documentId]
-    except KeyError:
-        abort(404)
+    document = api.getDocument(documentId)
     serve = document.serve()
     assert serve
     mode = request.args.get('mode')
@@ -425,10 +433,7 @@ def get_client_document(documentId):
 
 @app.route(API_ROOT + "/document/<uuid:documentId>/serve/getliveinfo", methods=["GET"])
 def get_liveinfo(documentId):
-    try:
-        document = api.documents[documentId]
-    except KeyError:
-        abort(404)
+    document = api.getDocument(documentId)
     serve = document.serve()
     assert serve
     rv = serve.getLiveInfo(contextID=request.args.get('contextID', None))
@@ -437,10 +442,7 @@ def get_liveinfo(documentId):
 
 @app.route(API_ROOT + "/document/<uuid:documentId>/serve/updatedocstate", methods=["PUT"])
 def update_document_state(documentId):
-    try:
-        document = api.documents[documentId]
-    except KeyError:
-        abort(404)
+    document = api.getDocument(documentId)
     serve = document.serve()
     assert serve
     documentState = request.get_json()
@@ -452,15 +454,12 @@ def update_document_state(documentId):
 
 @app.route(API_ROOT + "/document/<uuid:documentId>/serve/gethistory")
 def get_history(documentId):
-    try:
-        document = api.documents[documentId]
-    except KeyError:
-        abort(404)
+    document = api.getDocument(documentId)
     serve = document.serve()
     assert serve
     oldest = request.args.get('oldest', None)
     history = serve.gethistory(oldest=oldest)
-    return Response(json.dumps(history), mimetype="application/json")
+    return streaming.jsonListResponse(history)
 
 #
 # Per-document, serve aspect, for view-only (non-preview-player) consumption of views on the document
@@ -468,21 +467,15 @@ def get_history(documentId):
 
 @app.route(API_ROOT + "/document/<uuid:documentId>/viewer/timeline.xml")
 def get_viewer_timeline_document(documentId):
-    try:
-        document = api.documents[documentId]
-    except KeyError:
-        abort(404)
+    document = api.getDocument(documentId)
     serve = document.serve()
     assert serve
-    return Response(serve.get_timeline(viewer=True), mimetype="application/xml")
+    return _timelineResponse(serve.get_timeline_with_etag(viewer=True))
 
 
 @app.route(API_ROOT + "/document/<uuid:documentId>/viewer/layout.json")
 def get_viewer_layout_document(documentId):
-    try:
-        document = api.documents[documentId]
-    except KeyError:
-        abort(404)
+    document = api.getDocument(documentId)
     serve = document.serve()
     assert serve
     return Response(serve.get_layout(viewer=True), mimetype="application/json")
@@ -490,10 +483,7 @@ def get_viewer_layout_document(documentId):
 
 @app.route(API_ROOT + "/document/<uuid:documentId>/viewer/client.json")
 def get_viewer_client_document(documentId):
-    try:
-        document = api.documents[documentId]
-    except KeyError:
-        abort(404)
+    document = api.getDocument(documentId)
     serve = document.serve()
     assert serve
     mode = request.args.get('mode')
@@ -503,10 +493,7 @@ def get_viewer_client_document(documentId):
 
 @app.route(API_ROOT + "/document/<uuid:documentId>/viewer/getliveinfo", methods=["GET"])
 def get_viewer_liveinfo(documentId):
-    try:
-        document = api.documents[documentId]
-    except KeyError:
-        abort(404)
+    document = api.getDocument(documentId)
     serve = document.serve()
     assert serve
     rv = serve.getLiveInfo(contextID=request.args.get('contextID', None), viewer=True)
@@ -514,15 +501,12 @@ def get_viewer_liveinfo(documentId):
 
 @app.route(API_ROOT + "/document/<uuid:documentId>/viewer/gethistory")
 def get_viewer_history(documentId):
-    try:
-        document = api.documents[documentId]
-    except KeyError:
-        abort(404)
+    document = api.getDocument(documentId)
     serve = document.serve()
     assert serve
     oldest = request.args.get('oldest', None)
     history = serve.gethistory(oldest=oldest, viewer=True)
-    return Response(json.dumps(history), mimetype="application/json")
+    return streaming.jsonListResponse(history)
 
 
 @app.route(API_ROOT + "/document/<uuid:documentId>/viewer")
@@ -0,0 +1,79 @@
+"""Copyright 2018 Centrum Wiskunde & Informatica
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+from __future__ import absolute_import
+from __future__ import unicode_literals
+import json
+import zlib
+from flask import Response, request
+
+#
+# Streaming JSON responses for large lists: the list items are encoded one by one and sent in
+# chunks of about CHUNK_SIZE bytes, optionally compressed. Encoding happens while the response
+# is being sent, so callers must pass a list that is not modified anymore (and not hold a lock).
+#
+CHUNK_SIZE = 16*1024
+
+# Content-Encoding -> zlib wbits
+ENCODINGS = [
+    ('gzip', 16 + zlib.MAX_WBITS),
+    ('deflate', zlib.MAX_WBITS),
+    ]
+
+def iterJSONList(items, chunkSize=CHUNK_SIZE):
+    """Yield the JSON encoding of the list items in chunks of bytes"""
+    buffer = ['[']
+    size = 1
+    separator = ''
+    for item in items:
+        data = separator + json.dumps(item)
+        separator = ','
+        buffer.append(data)
+        size += len(data)
+        if size >= chunkSize:
+            yield ''.join(buffer).encode('utf8')
+            buffer = []
+            size = 0
+    buffer.append(']')
+    yield ''.join(buffer).encode('utf8')
+
+def iterCompressed(chunks, wbits):
+    compressor = zlib.compressobj(6, zlib.DEFLATED, wbits)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+def _getEncoding():
+    """Return (Content-Encoding, wbits) for the best compression the client accepts, or (None, None)"""
+    accepted = request.accept_encodings
+    best = (None, None)
+    bestQuality = 0
+    for encoding, wbits in ENCODINGS:
+        quality = accepted[encoding]
+        if quality > bestQuality:
+            best = (encoding, wbits)
+            bestQuality = quality
+    return best
+
+def jsonListResponse(items):
+    """Return a streamed response with the JSON encoding of list items, compressed with gzip or deflate if the client accepts that"""
+    chunks = iterJSONList(items)
+    encoding, wbits = _getEncoding()
+    headers = {'Vary': 'Accept-Encoding'}
+    if encoding:
+        chunks = iterCompressed(chunks, wbits)
+        headers['Content-Encoding'] = encoding
+    return Response(chunks, mimetype="application/json", headers=headers)
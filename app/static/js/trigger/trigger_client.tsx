@@ -58,6 +58,48 @@ export interface Event {
   productionId: string;
 }
 
+/**
+ * Message received on the `EVENTS` channel. Either a full snapshot of the
+ * event list, or a delta relative to the message with version `baseVersion`.
+ */
+export interface EventsMessage {
+  version: number;
+  remote: PreviewStatus;
+  full?: boolean;
+  events?: Array<Event>;
+  baseVersion?: number;
+  added?: Array<Event>;
+  changed?: Array<Event>;
+  removed?: Array<string>;
+  order?: Array<string>;
+}
+
+/**
+ * Applies a delta message received on the `EVENTS` channel to the given list
+ * of events and returns the resulting list. Removed events are dropped,
+ * changed events are replaced in place and added events are appended, after
+ * which the list is reordered if the message includes an explicit order.
+ *
+ * @param events The current list of events
+ * @param message Delta message to apply
+ * @returns The updated list of events
+ */
+export function applyEventsDelta(events: Array<Event>, message: EventsMessage): Array<Event> {
+  const removed = new Set(message.removed || []);
+  const changed = new Map((message.changed || []).map((e): [string, Event] => [e.id, e]));
+
+  let result = events.filter((e) => !removed.has(e.id)).map((e) => {
+    return changed.get(e.id) || e;
+  }).concat(message.added || []);
+
+  if (message.order) {
+    const byId = new Map(result.map((e): [string, Event] => [e.id, e]));
+    result = message.order.map((id) => byId.get(id)!);
+  }
+
+  return result;
+}
+
 /**
  * Props for TriggerClient
  */
@@ -89,6 +131,7 @@ interface TriggerClientState {
  */
 class TriggerClient extends React.Component<TriggerClientProps, TriggerClientState> {
   private socket: socketIO.Socket;
+  private eventsVersion?: number;
 
   constructor(props: TriggerClientProps) {
     super(props);
@@ -171,11 +214,27 @@ class TriggerClient extends React.Component<TriggerClientProps, TriggerClientSta
     });
 
     // Subscribe to the EVENTS event on the channel
-    this.socket.on("EVENTS", (data: { events: Array<Event>, remote: PreviewStatus }) => {
-      console.log("Received trigger event update");
-      const { events, remote } = data;
+    this.socket.on("EVENTS", (data: EventsMessage) => {
+      console.log("Received trigger event update", data.version);
+      const { remote } = data;
+      let events: Array<Event>;
+
+      if (data.full && data.events) {
+        events = data.events;
+      } else if (this.eventsVersion !== undefined && data.baseVersion === this.eventsVersion) {
+        events = applyEventsDelta(this.state.events, data);
+      } else {
+        // We missed a version (or joined halfway), ask for a full snapshot
+        console.log("Missed trigger event update, requesting full list");
+        this.eventsVersion = undefined;
+        makeRequest("GET", `/api/v1/document/${documentId}/events/requestbroadcast`).catch((err) => {
+          console.error("Could not request event list:", err);
+        });
+        return;
+      }
 
       // Update events and preview status every time a new message comes in
+      this.eventsVersion = data.version;
       this.setState({
         events,
         previewStatus: remote,
@@ -13,8 +13,31 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 from __future__ import unicode_literals
+import os
+
+if __name__ == "__main__" and int(os.getenv("WORKERS", "1")) > 1 and "WORKER_INDEX" not in os.environ:
+    # Supervisor process: it only runs the router, so let gevent make all network I/O cooperative.
+    # This must be done before anything else is imported.
+    from gevent import monkey
+    monkey.patch_all()
+
 from gevent.pywsgi import WSGIServer
 from app import app
+from app.api.api import api
+from app.api import router
+from app.api.globalSettings import GlobalSettings
 
 if __name__ == "__main__":
-    WSGIServer(("0.0.0.0", 8000), app).serve_forever()
+    if GlobalSettings.workers > 1 and "WORKER_INDEX" not in os.environ:
+        supervisor = router.Supervisor(os.path.abspath(__file__), GlobalSettings.workers, GlobalSettings.workerBasePort)
+        supervisor.start()
+        try:
+            WSGIServer(("0.0.0.0", 8000), router.Router(supervisor.getWorkerUrls())).serve_forever()
+        finally:
+            supervisor.stop()
+    elif "WORKER_PORT" in os.environ:
+        api.start()
+        WSGIServer(("127.0.0.1", int(os.environ["WORKER_PORT"])), app).serve_forever()
+    else:
+        api.start()
+        WSGIServer(("0.0.0.0", 8000), app).serve_forever()
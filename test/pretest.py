@@ -13,7 +13,17 @@ See the License for the specific language governing permissions and
 limitations under the License.
 """
 from __future__ import unicode_literals
+import os
 import sys
+import unittest
 from os.path import dirname, join, realpath
 
 sys.path.append(join(dirname(realpath(__file__)), ".."))
+
+# Decorator for benchmarks, which are skipped unless RUN_BENCHMARKS is set, for example with
+# RUN_BENCHMARKS=1 python -m unittest test.test_document
+benchmark = unittest.skipUnless(os.getenv("RUN_BENCHMARKS"), "set RUN_BENCHMARKS=1 to run benchmarks")
+
+def reportBenchmark(name, results):
+    """Report benchmark results (a string) on stderr"""
+    sys.stderr.write('\nbenchmark %s: %s\n' % (name, results))
@@ -75,6 +75,13 @@ class TestAPI(unittest.TestCase):
         self.assertEqual(r.status_code, 200)
         self.assertEqual(type(r.json()), type([]))
 
+    def test_lockstats(self):
+        r = requests.get(self.serverApi + '/lockstats')
+        self.assertEqual(r.status_code, 200)
+        rv = r.json()
+        self.assertIn('enabled', rv)
+        self.assertIn('locks', rv)
+
     def test_configuration(self):
         r = requests.put(self.serverApi + '/configuration', json={'mode' : 'tv'})
         r = requests.get(self.serverApi + '/configuration')
@@ -101,7 +108,65 @@ class TestAPI(unittest.TestCase):
         root = ET.fromstring(r.text)
         self.assertEqual(root.tag, 'testDocument')
         self.assertEqual(len(root), 3)
-        
+
+    def test_timelineETag(self):
+        r = requests.post(self.serverApi + '/document', data=DOCUMENT)
+        documentId = r.json()['documentId']
+        for aspect in ('serve', 'viewer'):
+            url = self.serverApi + '/document/' + documentId + '/' + aspect + '/timeline.xml'
+            r = requests.get(url)
+            self.assertEqual(r.status_code, 200)
+            etag = r.headers['ETag']
+            self.assertTrue(etag)
+            r = requests.get(url, headers={'If-None-Match': etag})
+            self.assertEqual(r.status_code, 304)
+            self.assertEqual(r.headers['ETag'], etag)
+
+    def test_createDocumentAsync(self):
+        fixture = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'test_events.xml')
+        r = requests.post(self.serverApi + '/document', params={'url': 'file://' + fixture, 'async': 'true'})
+        self.assertEqual(r.status_code, 202)
+        rv = r.json()
+        self.assertEqual(rv['state'], 'loading')
+        documentId = rv['documentId']
+
+        r = requests.get(self.serverApi + '/document/' + documentId + '/state', params=dict(wait=10))
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.json()['state'], 'loaded')
+        r = requests.get(self.serverApi + '/document/' + documentId + '/events')
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(len(r.json()), 4)
+
+    def test_eventsCompressed(self):
+        fixture = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'fixtures', 'test_events.xml')
+        r = requests.post(self.serverApi + '/document', params={'url': 'file://' + fixture})
+        documentId = r.json()['documentId']
+        url = self.serverApi + '/document/' + documentId + '/events'
+        r = requests.get(url, headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(len(r.json()), 4)
+        r = requests.get(url, headers={'Accept-Encoding': 'identity'})
+        self.assertNotIn('Content-Encoding', r.headers)
+        self.assertEqual(len(r.json()), 4)
+        r = requests.get(self.serverApi + '/document/' + documentId + '/serve/gethistory', headers={'Accept-Encoding': 'deflate'})
+        self.assertEqual(r.headers['Content-Encoding'], 'deflate')
+        self.assertEqual(r.json(), [])
+
+    def test_createDocumentAsyncFailed(self):
+        r = requests.post(self.serverApi + '/document', params={'url': 'file:///nonexistent/document.xml', 'async': 'true'})
+        self.assertEqual(r.status_code, 202)
+        documentId = r.json()['documentId']
+
+        r = requests.get(self.serverApi + '/document/' + documentId + '/state', params=dict(wait=10))
+        rv = r.json()
+        self.assertEqual(rv['state'], 'failed')
+        self.assertTrue(rv['error'])
+        # Requests for a document that did not load are refused
+        r = requests.get(self.serverApi + '/document/' + documentId + '/events')
+        self.assertEqual(r.status_code, 409)
+        self.assertIn('message', r.json())
+
 if __name__ == '__main__':
     unittest.main()
     
@@ -0,0 +1,143 @@
+"""Copyright 2018 Centrum Wiskunde & Informatica
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+from __future__ import absolute_import
+from __future__ import unicode_literals
+from future import standard_library
+standard_library.install_aliases()
+import unittest
+import urllib.request, urllib.parse, urllib.error
+import urllib.parse
+import os
+import time
+import uuid
+
+from . import pretest
+from app.api import document
+from app.api.globalSettings import GlobalSettings
+
+
+class RecordingChannel(object):
+    """Stand-in for the outgoing socket.io channel, records what is emitted"""
+    def __init__(self):
+        self.emitted = []
+
+    def emit(self, *args):
+        self.emitted.append(args)
+
+
+class TestAsync(unittest.TestCase):
+    def _buildUrl(self, extra=''):
+        myUrl = urllib.parse.urljoin(
+            u'file:', urllib.request.pathname2url(os.path.abspath(__file__))
+        )
+
+        docUrl = urllib.parse.urljoin(
+            myUrl,
+            u"fixtures/test_events%s.xml" % (extra)
+        )
+
+        return docUrl
+
+    def _createDocument(self):
+        d = document.Document(uuid.uuid4())
+        d.setTestMode(True)
+        docUrl = self._buildUrl()
+        d.load(docUrl)
+
+        return d
+
+    def _createBroadcaster(self, d):
+        a = d.asynch()
+        a.channelOut = RecordingChannel()
+        a._startBroadcaster()
+        return a
+
+    def test_broadcastSynchronous(self):
+        d = self._createDocument()
+        a = d.asynch()
+        a.channelOut = RecordingChannel()
+        a.requestBroadcastToFrontends()
+        self.assertEqual(a.getBroadcastCounts(), dict(requested=1, sent=1))
+        verb, room, events = a.channelOut.emitted[0]
+        self.assertEqual(verb, "BROADCAST_EVENTS")
+        self.assertEqual(room, str(d.documentId))
+        self.assertEqual(len(events["events"]), 4)
+
+    def test_broadcastCoalesced(self):
+        d = self._createDocument()
+        a = self._createBroadcaster(d)
+        try:
+            e = d.events()
+            e.trigger('event1', [])
+            e.trigger('event1', [])
+            for i in range(10):
+                a.requestBroadcastToFrontends()
+            time.sleep(GlobalSettings.broadcastInterval * 4)
+        finally:
+            a.stop()
+        counts = a.getBroadcastCounts()
+        self.assertEqual(counts['requested'], 12)
+        self.assertGreaterEqual(counts['sent'], 1)
+        self.assertLessEqual(counts['sent'], 2)
+        # The last broadcast reflects the latest state
+        events = self._applyBroadcasts(a.channelOut.emitted)
+        self.assertEqual(len(events), 6)
+
+    def _applyBroadcasts(self, emitted, events=None, version=None):
+        """Apply broadcast messages the way the frontend does, returns resulting event list"""
+        for verb, room, message in emitted:
+            self.assertEqual(verb, "BROADCAST_EVENTS")
+            if message.get("full"):
+                events = message["events"]
+            else:
+                self.assertEqual(message["baseVersion"], version)
+                removed = set(message["removed"])
+                changed = dict((e["id"], e) for e in message["changed"])
+                events = [changed.get(e["id"], e) for e in events if e["id"] not in removed] + message["added"]
+                if "order" in message:
+                    byId = dict((e["id"], e) for e in events)
+                    events = [byId[i] for i in message["order"]]
+            version = message["version"]
+        return events
+
+    def test_broadcastDelta(self):
+        d = self._createDocument()
+        a = d.asynch()
+        a.channelOut = RecordingChannel()
+        a.requestBroadcastToFrontends()
+        e = d.events()
+        # Triggering requests a broadcast itself
+        e.trigger('event1', [])
+        # Nothing changed: nothing is sent
+        a.requestBroadcastToFrontends()
+        self.assertEqual(a.getBroadcastCounts(), dict(requested=3, sent=2))
+        first, second = [m for verb, room, m in a.channelOut.emitted]
+        self.assertTrue(first["full"])
+        self.assertNotIn("events", second)
+        self.assertEqual(second["version"], first["version"] + 1)
+        self.assertEqual(second["baseVersion"], first["version"])
+        self.assertEqual(len(second["added"]), 1)
+        self.assertEqual(second["removed"], [])
+        self.assertEqual(self._applyBroadcasts(a.channelOut.emitted), e.get()["events"])
+        # A frontend that missed a version asks for the full list
+        a.requestBroadcastToFrontends(full=True)
+        third = a.channelOut.emitted[-1][2]
+        self.assertTrue(third["full"])
+        self.assertEqual(third["version"], second["version"] + 1)
+        self.assertEqual(third["events"], e.get()["events"])
+
+
+if __name__ == '__main__':
+    unittest.main()
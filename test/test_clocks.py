@@ -16,51 +16,23 @@ from __future__ import absolute_import
 from __future__ import unicode_literals
 import unittest
 import time
+import random
+import asyncio
+import threading
 
 from . import pretest
 from app.api import clocks
+from app.api import metrics
 
 
-class TestClocks(unittest.TestCase):
+class ClockTests(object):
+    """Tests that run against both the synchronous and the asyncio clocks"""
     DELTA_T = 0.01
 
-    def test_systemClock(self):
-        """Test that SystemClock runs at the right speed"""
-        clock = clocks.SystemClock()
-        start = clock.now()
-        self.assertAlmostEqual(start, time.time(), delta=self.DELTA_T)
-        
-        now = clock.now()
-        self.assertAlmostEqual(now, start, delta=self.DELTA_T)
-        
-        clock.sleep(1)
-        now = clock.now()
-        self.assertAlmostEqual(now, start+1, delta=self.DELTA_T)
-        
-        time.sleep(1)
-        now = clock.now()
-        self.assertAlmostEqual(now, start+2, delta=self.DELTA_T)
-        
-    def test_fastClock(self):
-        """Test that FastClock runs at the right speed"""
-        clock = clocks.FastClock()
-        start = clock.now()
-        self.assertAlmostEqual(start, 0, delta=self.DELTA_T)
-        now = clock.now()
-        self.assertAlmostEqual(now, start, delta=self.DELTA_T)
-        
-        clock.sleep(1)
-        now = clock.now()
-        self.assertAlmostEqual(now, start+1, delta=self.DELTA_T)
-        
-        time.sleep(1)
-        now = clock.now()
-        self.assertAlmostEqual(now, start+1, delta=self.DELTA_T)
-        
     def test_pauseableClock(self):
         """Test a PausableCLock with underlying FastClock"""
-        underlyingClock = clocks.FastClock()
-        clock = clocks.PausableClock(underlyingClock)
+        underlyingClock = self.FastClock()
+        clock = self.PausableClock(underlyingClock)
         
         self.assertEqual(clock.getRate(), 0.0)
         clock.start()
@@ -74,17 +46,17 @@ class TestClocks(unittest.TestCase):
         now = clock.now()
         self.assertAlmostEqual(now, start, delta=self.DELTA_T)
         
-        underlyingClock.sleep(1)
+        self.sleep(underlyingClock, 1)
         now = clock.now()
         self.assertAlmostEqual(now, start+1, delta=self.DELTA_T)
         
         clock.stop()
-        underlyingClock.sleep(1)
+        self.sleep(underlyingClock, 1)
         now = clock.now()
         self.assertAlmostEqual(now, start+1, delta=self.DELTA_T)
         
         clock.start()
-        underlyingClock.sleep(1)
+        self.sleep(underlyingClock, 1)
         now = clock.now()
         self.assertAlmostEqual(now, start+2, delta=self.DELTA_T)
         
@@ -93,26 +65,26 @@ class TestClocks(unittest.TestCase):
         self.assertAlmostEqual(now, start+2, delta=self.DELTA_T)
         
         clock.set(start+10)
-        underlyingClock.sleep(1)
+        self.sleep(underlyingClock, 1)
         now = clock.now()
         self.assertAlmostEqual(now, start+11, delta=self.DELTA_T)
         
         clock.stop()
         clock.set(start+20)
-        underlyingClock.sleep(1)
+        self.sleep(underlyingClock, 1)
         now = clock.now()
         self.assertAlmostEqual(now, start+20, delta=self.DELTA_T)
-        
+
     def callbackHelper(self, arg):
         self.callbackArg = arg
-        
+
     def schedule(self, callback, *args, **kwargs):
         callback(*args, **kwargs)
-        
+
     def test_callbackPausableClock(self):
         self.callbackArg = None
-        underlyingClock = clocks.FastClock()
-        clock = clocks.CallbackPausableClock(underlyingClock)
+        underlyingClock = self.FastClock()
+        clock = self.CallbackPausableClock(underlyingClock)
         clock.start()
         start = clock.now()
         self.assertAlmostEqual(start, 0, delta=self.DELTA_T)
@@ -120,13 +92,359 @@ class TestClocks(unittest.TestCase):
         self.assertEqual(clock.nextEventTime(), clocks.never)
         
         clock.schedule(10, self.callbackHelper, 'callback1')
-        clock.sleepUntilNextEvent()
+        self.sleepUntilNextEvent(clock)
         self.assertAlmostEqual(clock.now(), start+10, delta=self.DELTA_T)
         
         clock.handleEvents(self)
         self.assertEqual(self.callbackArg, 'callback1')
+
+    def test_cancelCallback(self):
+        self.callbackArg = None
+        clock = self.CallbackPausableClock(self.FastClock())
+        clock.start()
+        handle1 = clock.schedule(1, self.callbackHelper, 'callback1')
+        handle2 = clock.schedule(2, self.callbackHelper, 'callback2')
+        self.assertTrue(clock.cancel(handle1))
+        self.assertFalse(clock.cancel(handle1))
+        self.assertAlmostEqual(clock.nextEventTime(), 2, delta=self.DELTA_T)
+        self.sleepUntilNextEvent(clock)
+        clock.handleEvents(self)
+        self.assertEqual(self.callbackArg, 'callback2')
+        self.assertFalse(clock.cancel(handle2))
+        self.assertEqual(clock.nextEventTime(), clocks.never)
+
+    def test_callbackLateness(self):
+        self.callbackArg = None
+        underlyingClock = self.FastClock()
+        clock = self.CallbackPausableClock(underlyingClock)
+        clock.start()
+        lateCount = metrics.LATE_CALLBACKS.get()
+        latenessCount = metrics.CALLBACK_LATENESS.getCount()
+        clock.schedule(1, self.callbackHelper, 'callback1')
+        clock.schedule(1.95, self.callbackHelper, 'callback2')
+        self.sleep(underlyingClock, 2)
+        clock.handleEvents(self)
+        self.assertEqual(self.callbackArg, 'callback2')
+        # Both are recorded in the histogram, only the first one was late
+        self.assertEqual(metrics.CALLBACK_LATENESS.getCount(), latenessCount + 2)
+        self.assertEqual(metrics.LATE_CALLBACKS.get(), lateCount + 1)
+
+    def test_adjustCallbacks(self):
+        self.callbackArg = None
+        underlyingClock = self.FastClock()
+        clock = self.CallbackPausableClock(underlyingClock)
+        clock.start()
+        clock.replaceUnderlyingClock(self.FastClock())
+        clock.schedule(10, self.callbackHelper, 'callback1')
+        # Restoring the clock moves the callbacks along with it
+        clock.restoreUnderlyingClock(True)
+        self.sleep(underlyingClock, 5)
+        clock.handleEvents(self)
+        self.assertEqual(self.callbackArg, None)
+        self.assertAlmostEqual(clock.nextEventTime(), 5, delta=self.DELTA_T)
+        clock._adjust(-5)
+        clock.handleEvents(self)
+        self.assertEqual(self.callbackArg, 'callback1')
+
+
+class TestClocks(ClockTests, unittest.TestCase):
+    FastClock = clocks.FastClock
+    PausableClock = clocks.PausableClock
+    CallbackPausableClock = clocks.CallbackPausableClock
+
+    def sleep(self, underlyingClock, duration):
+        underlyingClock.sleep(duration)
+
+    def sleepUntilNextEvent(self, clock):
+        return clock.sleepUntilNextEvent()
+
+    def test_systemClock(self):
+        """Test that SystemClock runs at the right speed"""
+        clock = clocks.SystemClock()
+        start = clock.now()
+        self.assertAlmostEqual(start, time.time(), delta=self.DELTA_T)
         
+        now = clock.now()
+        self.assertAlmostEqual(now, start, delta=self.DELTA_T)
+        
+        clock.sleep(1)
+        now = clock.now()
+        self.assertAlmostEqual(now, start+1, delta=self.DELTA_T)
+        
+        time.sleep(1)
+        now = clock.now()
+        self.assertAlmostEqual(now, start+2, delta=self.DELTA_T)
+
+    def test_fastClock(self):
+        """Test that FastClock runs at the right speed"""
+        clock = clocks.FastClock()
+        start = clock.now()
+        self.assertAlmostEqual(start, 0, delta=self.DELTA_T)
+        now = clock.now()
+        self.assertAlmostEqual(now, start, delta=self.DELTA_T)
         
+        clock.sleep(1)
+        now = clock.now()
+        self.assertAlmostEqual(now, start+1, delta=self.DELTA_T)
+        
+        time.sleep(1)
+        now = clock.now()
+        self.assertAlmostEqual(now, start+1, delta=self.DELTA_T)
+
+    @pretest.benchmark
+    def test_schedulerBenchmark(self):
+        """Schedule 100k callbacks, cancel a tenth of them, adjust the clock and run the rest"""
+        count = 100000
+        self.callbackCount = 0
+        def callback():
+            self.callbackCount += 1
+        underlyingClock = clocks.FastClock()
+        clock = clocks.CallbackPausableClock(underlyingClock)
+        clock.start()
+        random.seed(42)
+        t0 = time.time()
+        handles = [clock.schedule(random.random() * 100, callback) for i in range(count)]
+        t1 = time.time()
+        for handle in handles[::10]:
+            clock.cancel(handle)
+        t2 = time.time()
+        for i in range(count):
+            clock.nextEventTime()
+        t3 = time.time()
+        clock._adjust(1)
+        t4 = time.time()
+        underlyingClock.sleep(102)
+        clock.handleEvents(self)
+        t5 = time.time()
+        self.assertEqual(self.callbackCount, count - count // 10)
+        self.assertEqual(clock.nextEventTime(), clocks.never)
+        pretest.reportBenchmark('scheduler', '%d callbacks, schedule %.3fs, cancel %.3fs, %d peeks %.3fs, adjust %.3fs, run %.3fs' % (count, t1-t0, t2-t1, count, t3-t2, t4-t3, t5-t4))
+
+    def test_queueChangedUnlocked(self):
+        """Test that the queueChanged callback is called without the clock lock held"""
+        clock = clocks.CallbackPausableClock(clocks.FastClock())
+        rv = []
+        def lockFromOtherThread():
+            if clock.lock.acquire(True, 1):
+                clock.lock.release()
+                rv.append(True)
+            else:
+                rv.append(False)
+        def queueChanged():
+            thread = threading.Thread(target=lockFromOtherThread)
+            thread.start()
+            thread.join()
+        clock.setQueueChangedCallback(queueChanged)
+        clock.schedule(1, self.callbackHelper, 'callback1')
+        self.assertEqual(rv, [True])
+
+    def test_clockDriver(self):
+        """Test that the driver runs callbacks at their deadline, and honours stop and start"""
+        clock = clocks.CallbackPausableClock(clocks.SystemClock())
+        clock.start()
+        fired = []
+        def callback(arg):
+            fired.append((arg, clock.now()))
+        driver = clocks.ClockDriver(clock)
+        driver.start()
+        self.addCleanup(driver.stop)
+        # Scheduling an earlier callback re-arms the driver
+        clock.schedule(0.4, callback, 'late')
+        start = clock.now()
+        clock.schedule(0.2, callback, 'early')
+        cancelled = clock.schedule(0.3, callback, 'cancelled')
+        clock.cancel(cancelled)
+        time.sleep(0.6)
+        self.assertEqual([arg for arg, _ in fired], ['early', 'late'])
+        self.assertAlmostEqual(fired[0][1], start+0.2, delta=0.05)
+        self.assertAlmostEqual(fired[1][1], start+0.4, delta=0.05)
+        # Nothing is due while the clock is stopped
+        clock.schedule(0.1, callback, 'stopped')
+        clock.stop()
+        time.sleep(0.3)
+        self.assertEqual(len(fired), 2)
+        clock.start()
+        time.sleep(0.3)
+        self.assertEqual(len(fired), 3)
+        self.assertEqual(fired[2][0], 'stopped')
+
+    def test_slewingClock(self):
+        """Test playback rate and slewing of a SlewingClock with underlying FastClock"""
+        underlyingClock = clocks.FastClock()
+        clock = clocks.SlewingClock(underlyingClock, slewRate=0.1)
+        self.assertEqual(clock.getRate(), 0.0)
+        clock.start()
+        self.assertEqual(clock.getRate(), 1.0)
+        underlyingClock.sleep(1)
+        self.assertAlmostEqual(clock.now(), 1, delta=self.DELTA_T)
+
+        clock.setRate(2.0)
+        self.assertEqual(clock.getRate(), 2.0)
+        underlyingClock.sleep(1)
+        self.assertAlmostEqual(clock.now(), 3, delta=self.DELTA_T)
+        clock.setRate(1.0)
+
+        # Slewing 0.5 seconds forward at 10% takes 5 seconds
+        clock.slew(0.5)
+        self.assertTrue(clock.isSlewing())
+        self.assertAlmostEqual(clock.getRate(), 1.1, delta=self.DELTA_T)
+        underlyingClock.sleep(2)
+        self.assertAlmostEqual(clock.now(), 5.2, delta=self.DELTA_T)
+        # Stopping keeps the rest of the slew for when the clock runs again
+        clock.stop()
+        underlyingClock.sleep(10)
+        self.assertAlmostEqual(clock.now(), 5.2, delta=self.DELTA_T)
+        clock.start()
+        underlyingClock.sleep(10)
+        self.assertAlmostEqual(clock.now(), 15.5, delta=self.DELTA_T)
+        self.assertFalse(clock.isSlewing())
+        self.assertEqual(clock.getRate(), 1.0)
+
+        # slewTo replaces the slew in progress, and jumps if the difference is too large
+        clock.slewTo(15, maxSlew=1)
+        clock.slewTo(16, maxSlew=1)
+        underlyingClock.sleep(1)
+        self.assertAlmostEqual(clock.now(), 16.6, delta=self.DELTA_T)
+        clock.slewTo(100, maxSlew=1)
+        self.assertAlmostEqual(clock.now(), 100, delta=self.DELTA_T)
+        self.assertFalse(clock.isSlewing())
+
+        # A stopped clock is adjusted immediately
+        clock.stop()
+        clock.slew(-10)
+        self.assertAlmostEqual(clock.now(), 90, delta=self.DELTA_T)
+
+    def test_atomicChanges(self):
+        """Test that set and replacing the underlying clock publish a single new state, and never a stopped clock"""
+        for clockClass in (clocks.PausableClock, clocks.SlewingClock):
+            underlyingClock = clocks.FastClock()
+            clock = clockClass(underlyingClock)
+            clock.start()
+            published = []
+            timingChanges = []
+            originalPublish = clock._publish
+            def publish():
+                originalPublish()
+                published.append(clock.state)
+            clock._publish = publish
+            clock._timingChanged = lambda: timingChanges.append(clock.state)
+
+            underlyingClock.sleep(10)
+            clock.set(5)
+            self.assertAlmostEqual(clock.now(), 5, delta=self.DELTA_T)
+            replacement = clocks.FastClock()
+            clock.replaceUnderlyingClock(replacement)
+            self.assertAlmostEqual(clock.now(), 5, delta=self.DELTA_T)
+            replacement.sleep(3)
+            self.assertAlmostEqual(clock.restoreUnderlyingClock(True), -3, delta=self.DELTA_T)
+            self.assertAlmostEqual(clock.now(), 5, delta=self.DELTA_T)
+            self.assertEqual(len(published), 3)
+            self.assertEqual(timingChanges, published)
+            self.assertTrue(all(state[0] for state in published))
+
+    def test_nowWithoutLock(self):
+        """Test that now() does not need the clock lock"""
+        clock = clocks.PausableClock(clocks.FastClock())
+        clock.set(10)
+        rv = []
+        def readNow():
+            rv.append(clock.now())
+        with clock.lock:
+            thread = threading.Thread(target=readNow)
+            thread.start()
+            thread.join(1)
+        self.assertEqual(rv, [10])
+
+    @pretest.benchmark
+    def test_nowBenchmark(self):
+        """Compare now() reading the published state with now() under the clock lock, with contending threads"""
+        clock = clocks.PausableClock(clocks.SystemClock())
+        clock.start()
+        lockedNow = clocks.synchronized(clocks.PausableClock._now)
+        threadCount = 4
+        callCount = 20000
+
+        def run(func):
+            def worker():
+                for i in range(callCount):
+                    func(clock)
+            threads = [threading.Thread(target=worker) for i in range(threadCount)]
+            t0 = time.time()
+            for thread in threads:
+                thread.start()
+            # Keep modifying the clock while the readers run
+            while any(thread.is_alive() for thread in threads):
+                clock.set(clock.now() + 0.001)
+                time.sleep(0.001)
+            for thread in threads:
+                thread.join()
+            return time.time() - t0
+
+        lockFree = run(clocks.PausableClock.now)
+        locked = run(lockedNow)
+        self.assertAlmostEqual(clock.now(), lockedNow(clock), delta=self.DELTA_T)
+        pretest.reportBenchmark('now', '%d threads x %d calls, lock-free %.3fs, locked %.3fs' % (threadCount, callCount, lockFree, locked))
+
+
+class TestAsyncClocks(ClockTests, unittest.TestCase):
+    FastClock = clocks.AsyncFastClock
+    PausableClock = clocks.AsyncPausableClock
+    CallbackPausableClock = clocks.AsyncCallbackPausableClock
+
+    def setUp(self):
+        self.loop = asyncio.new_event_loop()
+        asyncio.set_event_loop(self.loop)
+        self.addCleanup(self.loop.close)
+
+    def sleep(self, underlyingClock, duration):
+        self.loop.run_until_complete(underlyingClock.sleep(duration))
+
+    def sleepUntilNextEvent(self, clock):
+        return self.loop.run_until_complete(clock.sleepUntilNextEvent())
+
+    def test_asyncSystemClock(self):
+        """Test that AsyncSystemClock runs on loop time"""
+        clock = clocks.AsyncSystemClock()
+        start = clock.now()
+        self.assertAlmostEqual(start, self.loop.time(), delta=self.DELTA_T)
+        self.sleep(clock, 0.2)
+        self.assertAlmostEqual(clock.now(), start+0.2, delta=self.DELTA_T)
+
+    def test_sleepUntil(self):
+        """Test that sleep_until waits while the clock is stopped"""
+        clock = clocks.AsyncPausableClock(clocks.AsyncSystemClock())
+        async def starter():
+            await asyncio.sleep(0.2)
+            clock.start()
+        async def sleeper():
+            await clock.sleep_until(0.1)
+            return self.loop.time()
+        start = self.loop.time()
+        self.loop.create_task(starter())
+        woken = self.loop.run_until_complete(sleeper())
+        self.assertAlmostEqual(woken, start+0.3, delta=0.05)
+        self.assertAlmostEqual(clock.now(), 0.1, delta=0.05)
+
+    def test_run(self):
+        """Test that run() runs plain and coroutine callbacks at their deadline"""
+        clock = clocks.AsyncCallbackPausableClock(clocks.AsyncSystemClock())
+        clock.start()
+        fired = []
+        def callback(arg):
+            fired.append((arg, clock.now()))
+        async def coroutineCallback(arg):
+            fired.append((arg, clock.now()))
+        driver = self.loop.create_task(clock.run())
+        clock.schedule(0.2, callback, 'late')
+        clock.schedule(0.1, coroutineCallback, 'early')
+        self.loop.run_until_complete(asyncio.sleep(0.3))
+        driver.cancel()
+        self.loop.run_until_complete(asyncio.gather(driver, return_exceptions=True))
+        self.assertEqual([arg for arg, _ in fired], ['early', 'late'])
+        self.assertAlmostEqual(fired[0][1], 0.1, delta=0.05)
+        self.assertAlmostEqual(fired[1][1], 0.2, delta=0.05)
+
+
 if __name__ == '__main__':
     unittest.main()
     
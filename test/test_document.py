@@ -22,9 +22,15 @@ import urllib.request, urllib.parse, urllib.error
 import os
 import json
 import uuid
+import copy
+import time
+import tracemalloc
+import xml.etree.ElementTree as ET
 
 from . import pretest
 from app.api import document
+from app.api.globalSettings import GlobalSettings
+from werkzeug.exceptions import HTTPException
 
 DOCUMENT = """
 <testDocument>
@@ -58,6 +64,18 @@ class TestDocument(unittest.TestCase):
         d.loadXml(DOCUMENT.strip())
         self.assertEqual(d._count(), DOCUMENT_COUNT)
 
+    def test_elementCount(self):
+        d = document.Document(uuid.uuid4())
+        self.assertEqual(d.elementCount(), 0)
+        d.loadXml(DOCUMENT.strip())
+        self.assertEqual(d.elementCount(), DOCUMENT_COUNT)
+        x = d.xml()
+        x.cut(path='/testDocument/second')
+        self.assertEqual(d.elementCount(), DOCUMENT_COUNT-4)
+        x.paste(path='/testDocument/third', where='after', data='<new><newChild/></new>', mimetype='application/xml')
+        self.assertEqual(d.elementCount(), DOCUMENT_COUNT-2)
+        self.assertEqual(d.elementCount(), d._count())
+
     def test_createDocument2(self):
         d = document.Document(uuid.uuid4())
         docUrl = self._buildUrl()
@@ -100,6 +118,168 @@ class TestDocument(unittest.TestCase):
 
             self.assertIs(e, e2)
 
+    def test_xpath_index(self):
+        d = document.Document(uuid.uuid4())
+        d.loadXml(DOCUMENT.strip())
+        x = d.xml()
+        # Populate the index
+        for e in d.tree.getroot().iter():
+            d._getXPath(e)
+
+        x.paste('/testDocument/second/second1', 'before', 'second1', None, 'application/json')
+        x.paste('/testDocument/second', 'before', 'second', None, 'application/json')
+        x.cut('/testDocument/first')
+        for e in d.tree.getroot().iter():
+            p = d._getXPath(e)
+            e2 = d._getElementByPath(p)
+
+            self.assertIs(e, e2)
+        self.assertEqual(d._getXPath(d.tree.getroot()[1][1]), '/testDocument/second[2]/second1[2]')
+
+
+    def test_xpath_prefixed(self):
+        d = document.Document(uuid.uuid4())
+        docUrl = self._buildUrl('_namespaces')
+        d.load(docUrl)
+
+        e = d._getElementByPath('/tl:document/tl:par[1]/tl:par[1]/tt:events[1]/tl:par[3]')
+        self.assertEqual(e.get(document.NS_XML('id')), 'event3')
+        # Unindexed steps that are unambiguous
+        e = d._getElementByPath('/tl:document/tl:par/tl:ref')
+        self.assertEqual(e.get(document.NS_XML('id')), 'main_video')
+        # Expressions that need real XPath evaluation
+        e = d._getElementByPath('/tl:document//tl:par[@xml:id="event4"]')
+        self.assertEqual(e.get(document.NS_XML('id')), 'event4')
+
+    def _buildLargeDocument(self, count):
+        root = ET.Element(document.NS_TIMELINE('document'))
+        for i in range(count):
+            par = ET.SubElement(root, document.NS_TIMELINE('par'), {
+                document.NS_XML('id'): 'par%d' % i,
+                document.NS_TIMELINE_INTERNAL('state'): 'started',
+                document.NS_TIMELINE_INTERNAL('epoch'): '1234.5',
+                })
+            sleep = ET.SubElement(par, document.NS_TIMELINE('sleep'), {document.NS_TIMELINE('dur'): '0'})
+            if i % 2:
+                sleep.set(document.NS_TRIGGER('_realDur'), '42')
+            ET.SubElement(par, document.NS_TIMELINE('ref'), {document.NS_2IMMERSE('url'): 'http://example.com/%d' % i})
+        return ET.tostring(root, encoding='unicode')
+
+    def _measure(self, func):
+        """Run func, return (result, elapsed seconds, peak traced memory in bytes). Time and memory are
+        measured in separate runs, because tracemalloc slows everything down."""
+        startTime = time.time()
+        rv = func()
+        elapsed = time.time() - startTime
+        tracemalloc.start()
+        try:
+            func()
+            peak = tracemalloc.get_traced_memory()[1]
+        finally:
+            tracemalloc.stop()
+        return rv, elapsed, peak
+
+    def _copyAndStrip(self, d):
+        """Reference (the old save path): the data we want, made by copying and stripping the tree"""
+        reference = copy.deepcopy(d.tree.getroot())
+        for elt in reference.iter():
+            realDur = elt.attrib.pop(document.NS_TRIGGER('_realDur'), None)
+            if realDur:
+                elt.set(document.NS_TIMELINE('dur'), realDur)
+            for attr in list(elt.attrib.keys()):
+                if attr in document.NS_TIMELINE_INTERNAL:
+                    elt.attrib.pop(attr)
+        return ET.tostring(reference, encoding='unicode')
+
+    def _saveLargeDocument(self, count):
+        """Save a large document, return the saved data, the reference data and the time and peak memory of both"""
+        d = document.Document(uuid.uuid4())
+        d.loadXml(self._buildLargeDocument(count))
+        referenceData, copyTime, copyPeak = self._measure(lambda: self._copyAndStrip(d))
+
+        newDocUrl = self._buildUrl('_benchmark_tmp')
+        _, saveTime, savePeak = self._measure(lambda: d.save(newDocUrl))
+        savedData = urllib.request.urlopen(newDocUrl).read().decode('utf8')
+        os.unlink(urllib.request.url2pathname(urllib.parse.urlparse(newDocUrl).path))
+        return savedData, referenceData, (copyTime, copyPeak, saveTime, savePeak)
+
+    def test_saveLarge(self):
+        savedData, referenceData, _ = self._saveLargeDocument(100)
+        self.assertEqual(savedData, referenceData)
+        self.assertNotIn('timelines/internal', savedData)
+
+    @pretest.benchmark
+    def test_saveBenchmark(self):
+        savedData, referenceData, measurements = self._saveLargeDocument(10000)
+        self.assertEqual(savedData, referenceData)
+        pretest.reportBenchmark('save 10000 events', 'copy and strip %.3fs %dKB, streaming save %.3fs %dKB' % (
+            measurements[0], measurements[1] // 1024, measurements[2], measurements[3] // 1024))
+
+    def test_loadLarge(self):
+        d = document.Document(uuid.uuid4())
+        d.loadXml(self._buildLargeDocument(100).encode('utf8'))
+        self.assertEqual(d._count(), 301)
+        self.assertEqual(d._checkIndexes(), [])
+        self.assertIsNone(d.loadProgress)
+
+    def _loadInPasses(self, data):
+        """Reference (the old load path): parse, then build the maps in separate passes over the tree"""
+        root = ET.fromstring(data)
+        parentMap = {c: p for p in root.iter() for c in p}
+        idMap = {}
+        nameSet = set()
+        for e in root.iter():
+            id = e.get(document.NS_XML('id'))
+            if id:
+                idMap[id] = e
+            name = e.get(document.NS_TRIGGER('name'))
+            if name:
+                nameSet.add(name)
+        attributeIndex = {attr: {} for attr in document.INDEXED_ATTRIBUTES}
+        for e in root.iter():
+            for attr in document.INDEXED_ATTRIBUTES:
+                value = e.get(attr)
+                if value is not None:
+                    attributeIndex[attr].setdefault(value, {})[e] = True
+        eventParents = [parentMap[e] for e in root.iter(document.NS_TRIGGER('events'))]
+        return root, parentMap, idMap, nameSet, attributeIndex, eventParents
+
+    def _loadSinglePass(self, data):
+        d = document.Document(uuid.uuid4())
+        d.loadXml(data)
+        return d
+
+    @pretest.benchmark
+    def test_loadBenchmark(self):
+        data = self._buildLargeDocument(10000).encode('utf8')
+        _, passesTime, passesPeak = self._measure(lambda: self._loadInPasses(data))
+        d, loadTime, loadPeak = self._measure(lambda: self._loadSinglePass(data))
+        self.assertEqual(d._count(), 30001)
+        self.assertEqual(d._checkIndexes(), [])
+        pretest.reportBenchmark('load 10000 events', 'parse and index in passes %.3fs %dKB, single pass %.3fs %dKB' % (
+            passesTime, passesPeak // 1024, loadTime, loadPeak // 1024))
+
+    def test_loadTooLarge(self):
+        oldMaxSize = GlobalSettings.maxDocumentSize
+        GlobalSettings.maxDocumentSize = 1000
+        self.addCleanup(setattr, GlobalSettings, 'maxDocumentSize', oldMaxSize)
+        d = document.Document(uuid.uuid4())
+        d.loadXml(DOCUMENT.strip())
+        with self.assertRaises(HTTPException) as cm:
+            d.loadXml(self._buildLargeDocument(100))
+        self.assertEqual(cm.exception.code, 413)
+        # The document is unchanged
+        self.assertEqual(d._count(), DOCUMENT_COUNT)
+        # Also when loading from a URL
+        docUrl = self._buildUrl('_large_tmp')
+        with open(urllib.request.url2pathname(urllib.parse.urlparse(docUrl).path), 'w') as fp:
+            fp.write(self._buildLargeDocument(100))
+        self.addCleanup(os.unlink, urllib.request.url2pathname(urllib.parse.urlparse(docUrl).path))
+        with self.assertRaises(HTTPException) as cm:
+            d.load(docUrl)
+        self.assertEqual(cm.exception.code, 413)
+        self.assertEqual(d._count(), DOCUMENT_COUNT)
+
 
 if __name__ == '__main__':
     unittest.main()
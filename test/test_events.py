@@ -22,6 +22,7 @@ import urllib.parse
 import os
 import json
 import uuid
+from werkzeug.exceptions import HTTPException
 
 from . import pretest
 from app.api import document
@@ -142,6 +143,111 @@ class TestEvents(unittest.TestCase):
         newData = urllib.request.urlopen(newDocUrl).read().strip()
         self.assertEqual(newData, oldData)
 
+    def test_indexes(self):
+        d = self._createDocument()
+        self.assertEqual(d._checkIndexes(), [])
+        e = d.events()
+
+        newId = e.trigger('event3', [dict(parameter='./tl:sleep/@tl:dur', value='42')])
+        self.assertEqual(len(e.get()["events"]), 5)
+        self.assertEqual(d._checkIndexes(), [])
+
+        e.modify(newId, [dict(parameter='./tl:sleep/@tl:dur', value='0')])
+        self.assertEqual(d._checkIndexes(), [])
+
+        e.dequeue(newId)
+        self.assertEqual(len(e.get()["events"]), 4)
+        self.assertEqual(d._checkIndexes(), [])
+
+        d.xml().cut('//tl:par[@xml:id="%s"]' % newId)
+        self.assertEqual(d._checkIndexes(), [])
+        self.assertEqual(d._getElementsByAttribute(document.NS_TRIGGER('name'), '5 second splash'), [d._getElementByID('event1')])
+
+    def test_getCached(self):
+        d = self._createDocument()
+        e = d.events()
+        allEvents = e.get()["events"]
+        self.assertEqual(e.get()["events"], allEvents)
+
+        newId = e.trigger('event3', [dict(parameter='./tl:sleep/@tl:dur', value='42')])
+        allEvents2 = e.get()["events"]
+        self.assertEqual(len(allEvents2), 5)
+        # Descriptions of untouched events are re-used, the modified one is rebuilt
+        for old, new in zip(allEvents, allEvents2):
+            self.assertIs(old, new)
+
+        e.modify('event4', [dict(parameter='./tl:sleep/@tl:dur', value='3')])
+        allEvents3 = e.get()["events"]
+        changed = [new for old, new in zip(allEvents2, allEvents3) if old is not new]
+        self.assertEqual([ev['id'] for ev in changed], ['event4'])
+
+    def test_timelineCached(self):
+        d = self._createDocument()
+        s = d.serve()
+        data, etag = s.get_timeline_with_etag()
+        data2, etag2 = s.get_timeline_with_etag(viewer=True)
+        self.assertIs(data, data2)
+        self.assertEqual(etag, etag2)
+
+        # Every kind of modification results in a new serialization
+        e = d.events()
+        newId = e.trigger('event1', [])
+        data3, etag3 = s.get_timeline_with_etag()
+        self.assertNotEqual(etag3, etag)
+        self.assertIn(newId, data3)
+
+        s._elementStateChanged(d._getElementByID(newId), {document.NS_TIMELINE_INTERNAL('state'): 'started'})
+        data4, etag4 = s.get_timeline_with_etag()
+        self.assertNotEqual(etag4, etag3)
+        self.assertIn('"started"', data4)
+
+        s._nextGeneration(False)
+        self.assertNotEqual(s.get_timeline_with_etag()[1], etag4)
+
+    def test_historyWindow(self):
+        d = self._createDocument()
+        s = d.serve()
+        s.operationHistory = document.OperationHistory(window=4)
+        op = dict(verb='delete', path='/x')
+        s._memorizeOperations(1, [op])
+        s._memorizeOperations(3, [op])
+        self.assertEqual(s.gethistory(), [(0, []), (1, [op]), (2, []), (3, [op])])
+        self.assertEqual(s.gethistory(oldest=2), [(2, []), (3, [op])])
+
+        # Older generations are compacted away, clients that need them must refetch the timeline
+        s._memorizeOperations(5, [op])
+        self.assertEqual(s.gethistory(oldest=3), [(3, [op]), (4, []), (5, [op])])
+        self.assertEqual(len(s.operationHistory.entries), 2)
+        with self.assertRaises(HTTPException) as cm:
+            s.gethistory(oldest=1)
+        self.assertEqual(cm.exception.code, 410)
+
+    def test_followTimelineClock(self):
+        d = self._createDocument()
+        s = d.serve()
+        ns = document.NS_TIMELINE_INTERNAL
+        ids = ['main_video', 'eventPlayback', 'event1']
+
+        def report(progresses):
+            states = {}
+            for eltId, progress in zip(ids, progresses):
+                states[eltId] = {ns('state'): 'started', ns('progress'): str(progress), ns('clockRunning'): 'true'}
+            s._setDocumentState(dict(elementStates=states))
+            return [float(d._getElementByID(eltId).get(ns('epoch'))) for eltId in ids]
+
+        epochs = report([10, 20, 30])
+        self.assertFalse(d.clock.isSlewing())
+        # All elements are 0.5 seconds ahead: the clock is slewed, the epochs stay
+        newEpochs = report([10.5, 20.5, 30.5])
+        self.assertTrue(d.clock.isSlewing())
+        for old, new in zip(epochs, newEpochs):
+            self.assertAlmostEqual(old, new, delta=0.01)
+        # One element is a second behind the others: only its epoch changes
+        newEpochs = report([10.5, 20.5, 29.5])
+        self.assertAlmostEqual(newEpochs[0], epochs[0], delta=0.01)
+        self.assertAlmostEqual(newEpochs[1], epochs[1], delta=0.01)
+        self.assertAlmostEqual(newEpochs[2], epochs[2] + 1, delta=0.01)
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -22,9 +22,36 @@ import urllib.parse
 import os
 import json
 import uuid
+import time
+import threading
+import http.server
 
 from . import pretest
 from app.api import document
+from app.api.globalSettings import GlobalSettings
+
+
+class RecordingHandler(http.server.BaseHTTPRequestHandler):
+    """Stand-in for a timeline service: records PUTs, paths ending in -slow are slow, -fail always fails,
+    -gone always returns 404 and -busy returns 429 for every other request"""
+    def do_PUT(self):
+        body = json.loads(self.rfile.read(int(self.headers['Content-Length'])).decode('utf8'))
+        self.server.received.append((self.path, body))
+        if self.path.endswith('-slow'):
+            time.sleep(0.5)
+        status = 204
+        if self.path.endswith('-fail'):
+            status = 500
+        elif self.path.endswith('-gone'):
+            status = 404
+        elif self.path.endswith('-busy') and len([p for p, b in self.server.received if p == self.path]) % 2:
+            status = 429
+        self.send_response(status)
+        self.send_header('Content-Length', '0')
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
 
 
 class TestForward(unittest.TestCase):
@@ -165,6 +192,88 @@ class TestForward(unittest.TestCase):
 
         self.assertEqual(newData, copyData)
 
+    def _startServer(self):
+        server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), RecordingHandler) if hasattr(http.server, 'ThreadingHTTPServer') else http.server.HTTPServer(('127.0.0.1', 0), RecordingHandler)
+        server.received = []
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server, 'http://127.0.0.1:%d' % server.server_address[1]
+
+    def test_callbacks(self):
+        oldBackoff = GlobalSettings.forwardBackoff
+        GlobalSettings.forwardBackoff = 0.01
+        self.addCleanup(setattr, GlobalSettings, 'forwardBackoff', oldBackoff)
+        server, base = self._startServer()
+        d = self._createDocument()
+        s = d.serve()
+        d.forwardHandler = s
+        # Sorted order: the failing callback is first, so it would get the state updates
+        s.addCallback(base + '/a-fail')
+        s.addCallback(base + '/b-slow')
+        s.addCallback(base + '/c-fast')
+        e = d.events()
+
+        startTime = time.time()
+        e.trigger('event1', [])
+        e.trigger('event1', [])
+        # Editing is not held up by the slow callback
+        self.assertLess(time.time() - startTime, 0.5)
+        s._waitForwarded(10)
+
+        # The failing callback has been removed, after retrying
+        self.assertEqual(s.callbacks, set([base + '/b-slow', base + '/c-fast']))
+        failed = [body for path, body in server.received if path == '/a-fail']
+        self.assertEqual(len(failed), GlobalSettings.forwardRetries + 1)
+        self.assertTrue(d.lastErrorMessage)
+        # The others have received everything, in order
+        for path in ('/b-slow', '/c-fast'):
+            generations = [body['generation'] for p, body in server.received if p == path and body['operations']]
+            self.assertEqual(len(generations), 2)
+            self.assertEqual(generations, sorted(generations))
+        # The next callback in line has been asked for state updates in stead
+        stateUpdates = [path for path, body in server.received if body.get('wantStateUpdates') and path != '/a-fail']
+        self.assertEqual(stateUpdates, ['/b-slow'])
+
+    def test_callbackStatus(self):
+        oldBackoff = GlobalSettings.forwardBackoff
+        GlobalSettings.forwardBackoff = 0.01
+        self.addCleanup(setattr, GlobalSettings, 'forwardBackoff', oldBackoff)
+        server, base = self._startServer()
+        d = self._createDocument()
+        s = d.serve()
+        d.forwardHandler = s
+        s.addCallback(base + '/a-busy')
+        s.addCallback(base + '/b-gone')
+        d.events().trigger('event1', [])
+        s._waitForwarded(10)
+
+        # 429 is retried and the message arrives, 404 is not retried
+        self.assertEqual(s.callbacks, set([base + '/a-busy']))
+        self.assertEqual(len([body for path, body in server.received if path == '/a-busy']), 2)
+        self.assertEqual(len([body for path, body in server.received if path == '/b-gone']), 1)
+
+    def test_stateUpdatesHandover(self):
+        server, base = self._startServer()
+        d = self._createDocument()
+        s = d.serve()
+        s.addCallback(base + '/a')
+        s.addCallback(base + '/b')
+        first, second = s._getCallbackSenders()
+        # The first callback has failed, but _callbackFailed() has not been called yet
+        first.close()
+        s.forward([dict(verb='change', path='/', attrs={})])
+        s._waitForwarded(10)
+        self.assertEqual([body.get('wantStateUpdates') for path, body in server.received], [None])
+
+        # Only _callbackFailed() moves the state updates to the next callback
+        s._callbackFailed(first)
+        s._waitForwarded(10)
+        self.assertEqual(s.callbacks, set([base + '/b']))
+        self.assertEqual([body.get('wantStateUpdates') for path, body in server.received], [None, True])
+
 
 if __name__ == '__main__':
     unittest.main()
@@ -0,0 +1,158 @@
+"""Copyright 2018 Centrum Wiskunde & Informatica
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+from __future__ import absolute_import
+from __future__ import unicode_literals
+from future import standard_library
+standard_library.install_aliases()
+from builtins import range
+import unittest
+import time
+import threading
+import http.server
+import uuid
+import requests
+
+from . import pretest
+from app.api import httpcache
+from app.api import document
+
+BODY = '{"hello": "world"}'
+
+LAYOUT_DOCUMENT = """<tl:document xmlns:tl="http://jackjansen.nl/timelines" xmlns:au="http://jackjansen.nl/2immerse/authoring">
+    <tl:par/>
+    <au:layoutRef url="%s"/>
+</tl:document>"""
+
+
+class StaticHandler(http.server.BaseHTTPRequestHandler):
+    """Serves BODY with an ETag. Paths ending in -maxage send max-age, -slow are slow, -missing return 404
+    and -notmodified return 304 to the first request, even if it is unconditional."""
+    protocol_version = 'HTTP/1.1'
+
+    def do_GET(self):
+        self.server.requests.append((self.path, self.headers.get('If-None-Match')))
+        if self.path.endswith('-slow'):
+            time.sleep(0.2)
+        if self.path.endswith('-missing'):
+            self.send_response(404)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        if self.headers.get('If-None-Match') == '"v1"' or (self.path.endswith('-notmodified') and len(self.server.requests) == 1):
+            self.send_response(304)
+            self.send_header('Content-Length', '0')
+            self.end_headers()
+            return
+        body = BODY.encode('utf8')
+        self.send_response(200)
+        self.send_header('ETag', '"v1"')
+        if self.path.endswith('-maxage'):
+            self.send_header('Cache-Control', 'public, max-age=60')
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+class TestHttpCache(unittest.TestCase):
+    def _startServer(self):
+        server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), StaticHandler) if hasattr(http.server, 'ThreadingHTTPServer') else http.server.HTTPServer(('127.0.0.1', 0), StaticHandler)
+        server.requests = []
+        server.daemon_threads = True
+        thread = threading.Thread(target=server.serve_forever)
+        thread.daemon = True
+        thread.start()
+        self.addCleanup(server.server_close)
+        self.addCleanup(server.shutdown)
+        return server, 'http://127.0.0.1:%d' % server.server_address[1]
+
+    def test_maxAge(self):
+        server, base = self._startServer()
+        c = httpcache.HttpCache(defaultMaxAge=0, refreshInterval=0)
+        for i in range(5):
+            self.assertEqual(c.getText(base + '/layout-maxage'), BODY)
+        self.assertEqual(len(server.requests), 1)
+        self.assertEqual(c.getCounts()['hits'], 4)
+
+    def test_revalidate(self):
+        server, base = self._startServer()
+        c = httpcache.HttpCache(defaultMaxAge=0, refreshInterval=0)
+        self.assertEqual(c.getText(base + '/layout'), BODY)
+        self.assertEqual(c.getText(base + '/layout'), BODY)
+        # Stale immediately, so the second one is a conditional GET answered with 304
+        self.assertEqual(server.requests, [('/layout', None), ('/layout', '"v1"')])
+
+    def test_notModifiedWithoutEntry(self):
+        server, base = self._startServer()
+        c = httpcache.HttpCache(defaultMaxAge=10, refreshInterval=0)
+        # A 304 we did not ask for is not cached as an empty body, the body is fetched again
+        self.assertEqual(c.getText(base + '/layout-notmodified'), BODY)
+        self.assertEqual(server.requests, [('/layout-notmodified', None), ('/layout-notmodified', None)])
+        self.assertEqual(c.getText(base + '/layout-notmodified'), BODY)
+        self.assertEqual(len(server.requests), 2)
+
+    def test_errors(self):
+        server, base = self._startServer()
+        c = httpcache.HttpCache(defaultMaxAge=10, refreshInterval=0)
+        # Error responses raise HTTPError, as raise_for_status() does, and are not cached
+        for i in range(2):
+            with self.assertRaises(requests.exceptions.HTTPError) as cm:
+                c.getText(base + '/layout-missing')
+            self.assertEqual(cm.exception.response.status_code, 404)
+        self.assertEqual(len(server.requests), 2)
+        self.assertEqual(c.getCounts()['entries'], 0)
+
+    def test_getLayout(self):
+        server, base = self._startServer()
+        d = document.Document(uuid.uuid4())
+        d.loadXml(LAYOUT_DOCUMENT % (base + '/layout-maxage'))
+        self.assertEqual(d.serve().get_layout(), BODY)
+        # As before the cache was used, a layout that cannot be fetched raises HTTPError
+        d = document.Document(uuid.uuid4())
+        d.loadXml(LAYOUT_DOCUMENT % (base + '/layout-missing'))
+        with self.assertRaises(requests.exceptions.HTTPError):
+            d.serve().get_layout()
+
+    def test_singleFlight(self):
+        server, base = self._startServer()
+        c = httpcache.HttpCache(defaultMaxAge=10, refreshInterval=0)
+        results = []
+        def fetch():
+            results.append(c.getText(base + '/client-slow'))
+        threads = [threading.Thread(target=fetch) for i in range(10)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(results, [BODY] * 10)
+        self.assertEqual(len(server.requests), 1)
+
+    def test_backgroundRefresh(self):
+        server, base = self._startServer()
+        c = httpcache.HttpCache(defaultMaxAge=0, refreshInterval=0.05)
+        self.assertEqual(c.getText(base + '/layout'), BODY)
+        # Not used since the fetch: not refreshed
+        time.sleep(0.2)
+        self.assertEqual(len(server.requests), 1)
+        c.entries[base + '/layout'].lastUsed = time.time()
+        time.sleep(0.2)
+        self.assertEqual(server.requests[1], ('/layout', '"v1"'))
+
+
+if __name__ == '__main__':
+    unittest.main()
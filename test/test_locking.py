@@ -0,0 +1,219 @@
+"""Copyright 2018 Centrum Wiskunde & Informatica
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+from __future__ import absolute_import
+from __future__ import unicode_literals
+from future import standard_library
+standard_library.install_aliases()
+from builtins import range
+import unittest
+import urllib.request, urllib.parse, urllib.error
+import urllib.parse
+import os
+import time
+import uuid
+import threading
+
+from . import pretest
+from app.api import document
+from app.api import locking
+from app.api import lockprofile
+from app.api import clocks
+from app.api.globalSettings import GlobalSettings
+
+
+class TestLocking(unittest.TestCase):
+    def _inThread(self, func):
+        """Run func in another thread, return (thread, list that gets the result)"""
+        rv = []
+        thread = threading.Thread(target=lambda: rv.append(func()))
+        thread.daemon = True
+        thread.start()
+        return thread, rv
+
+    def test_readersShare(self):
+        lock = locking.ReadWriteLock()
+        with lock.reading():
+            thread, rv = self._inThread(lambda: lock.acquireRead(timeout=1))
+            thread.join()
+            self.assertEqual(rv, [True])
+            # A writer has to wait for the readers
+            thread, rv = self._inThread(lambda: lock.acquire(timeout=0.1))
+            thread.join()
+            self.assertEqual(rv, [False])
+
+    def test_writerExcludes(self):
+        lock = locking.ReadWriteLock()
+        with lock:
+            # Reentrant, and reading is allowed for the writer
+            with lock:
+                with lock.reading():
+                    self.assertTrue(lock.isWriting())
+            thread, rv = self._inThread(lambda: lock.acquireRead(timeout=0.1))
+            thread.join()
+            self.assertEqual(rv, [False])
+        self.assertFalse(lock.isWriting())
+        thread, rv = self._inThread(lambda: lock.acquireRead(timeout=1))
+        thread.join()
+        self.assertEqual(rv, [True])
+
+    def test_noUpgrade(self):
+        lock = locking.ReadWriteLock()
+        with lock.reading():
+            with self.assertRaises(RuntimeError):
+                lock.acquire()
+
+    def test_writerPreference(self):
+        lock = locking.ReadWriteLock()
+        lock.acquireRead()
+        writer, writerResult = self._inThread(lambda: lock.acquire(timeout=2))
+        time.sleep(0.1)
+        # A new reader waits behind the waiting writer
+        reader, readerResult = self._inThread(lambda: lock.acquireRead(timeout=0.1))
+        reader.join()
+        self.assertEqual(readerResult, [False])
+        lock.releaseRead()
+        writer.join()
+        self.assertEqual(writerResult, [True])
+
+    def _createDocument(self):
+        myUrl = urllib.parse.urljoin(u'file:', urllib.request.pathname2url(os.path.abspath(__file__)))
+        d = document.Document(uuid.uuid4())
+        d.setTestMode(True)
+        d.load(urllib.parse.urljoin(myUrl, u"fixtures/test_events.xml"))
+        return d
+
+    def test_documentReadsInParallel(self):
+        d = self._createDocument()
+        e = d.events()
+        with d.lock.reading():
+            # Another reader is not blocked by us
+            thread, rv = self._inThread(lambda: len(e.get()['events']))
+            thread.join(5)
+            self.assertEqual(rv, [4])
+            thread, rv = self._inThread(lambda: d.serve().get_timeline())
+            thread.join(5)
+            self.assertEqual(len(rv), 1)
+            # But an edit is
+            thread, rv = self._inThread(lambda: e.trigger('event1', []))
+            thread.join(0.2)
+            self.assertEqual(rv, [])
+        thread.join(5)
+        self.assertEqual(len(rv), 1)
+
+    def test_xpathsFromReaders(self):
+        """Readers holding the shared lock fill the XPath index concurrently"""
+        d = self._createDocument()
+        elements = list(d.tree.getroot().iter())
+        errors = []
+        results = {}
+
+        def reader(i):
+            try:
+                with d.lock.reading():
+                    results[i] = [d._getXPath(elt) for elt in elements]
+            except Exception as ex:
+                errors.append(ex)
+
+        threads = [threading.Thread(target=reader, args=(i,)) for i in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+        self.assertEqual(len(results), 4)
+        for i in range(1, 4):
+            self.assertEqual(results[i], results[0])
+        self.assertEqual(len(d.xpathIndex), len(elements)-1)
+        self.assertEqual(d._checkIndexes(), [])
+
+    @pretest.benchmark
+    def test_contentionBenchmark(self):
+        """Mixed read/write load on one document: readers get the event list and the timeline, one writer triggers events"""
+        d = self._createDocument()
+        e = d.events()
+        s = d.serve()
+        duration = 0.5
+        counts = dict(reads=0, writes=0)
+        errors = []
+        stop = time.time() + duration
+
+        def reader():
+            n = 0
+            try:
+                while time.time() < stop:
+                    e.get()
+                    s.get_timeline()
+                    n += 1
+            except Exception as ex:
+                errors.append(ex)
+            counts['reads'] += n
+
+        def writer():
+            n = 0
+            try:
+                while time.time() < stop:
+                    e.trigger('event1', [])
+                    n += 1
+                    time.sleep(0.01)
+            except Exception as ex:
+                errors.append(ex)
+            counts['writes'] += n
+
+        threads = [threading.Thread(target=reader) for i in range(4)] + [threading.Thread(target=writer)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(errors, [])
+        self.assertTrue(counts['writes'] > 0)
+        self.assertTrue(counts['reads'] > 0)
+        self.assertEqual(d._checkIndexes(), [])
+
+    def test_profiling(self):
+        oldSettings = (GlobalSettings.lockProfiling, GlobalSettings.lockSlowThreshold)
+        def restoreSettings():
+            GlobalSettings.lockProfiling, GlobalSettings.lockSlowThreshold = oldSettings
+        self.addCleanup(restoreSettings)
+        GlobalSettings.lockProfiling = True
+        GlobalSettings.lockSlowThreshold = 10
+        lockprofile.reset()
+
+        d = self._createDocument()
+        e = d.events()
+        e.trigger('event1', [])
+        e.get()
+        clock = clocks.PausableClock(clocks.SystemClock())
+        clock.start()
+
+        stats = lockprofile.getStats()
+        self.assertTrue(stats['enabled'])
+        documentStats = stats['locks']['document']
+        self.assertIn('document.py:DocumentEvents.trigger', documentStats['sites'])
+        self.assertIn('document.py:DocumentEvents.get (read)', documentStats['sites'])
+        self.assertEqual(documentStats['hold']['count'], sum(site['count'] for site in documentStats['sites'].values()))
+        self.assertEqual(sum(documentStats['wait']['counts']), documentStats['wait']['count'])
+        self.assertEqual(documentStats['slow'], [])
+        self.assertIn('clocks.py:PausableClock.start', stats['locks']['clock']['sites'])
+
+        # Slow holders are sampled
+        GlobalSettings.lockSlowThreshold = 0
+        e.get()
+        slow = lockprofile.getStats()['locks']['document']['slow']
+        self.assertTrue(slow)
+        self.assertEqual(slow[-1]['site'], 'document.py:DocumentEvents.get (read)')
+
+
+if __name__ == '__main__':
+    unittest.main()
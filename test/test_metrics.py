@@ -0,0 +1,72 @@
+"""Copyright 2018 Centrum Wiskunde & Informatica
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+from __future__ import absolute_import
+from __future__ import unicode_literals
+import unittest
+
+from . import pretest
+from app.api import metrics
+
+
+class TestMetrics(unittest.TestCase):
+    def test_counter(self):
+        c = metrics.Counter('test_total', 'Test counter', ('kind',))
+        c.inc(labels=('a',))
+        c.inc(2, labels=('a',))
+        c.inc(labels=('b"',))
+        self.assertEqual(c.get(('a',)), 3)
+        lines = c.render()
+        self.assertEqual(lines[1], '# TYPE test_total counter')
+        self.assertIn('test_total{kind="a"} 3', lines)
+        self.assertIn('test_total{kind="b\\""} 1', lines)
+
+    def test_gaugeFunction(self):
+        gauge = metrics.Gauge('test_gauge', 'Test gauge', ('where',))
+        gauge.setFunction(lambda: [(('memory',), 2), (('spilled',), 1)])
+        lines = gauge.render()
+        self.assertIn('test_gauge{where="memory"} 2', lines)
+        self.assertIn('test_gauge{where="spilled"} 1', lines)
+
+    def test_histogram(self):
+        h = metrics.Histogram('test_seconds', 'Test histogram', buckets=(0.1, 1.0))
+        for value in (0.05, 0.5, 0.5, 5.0):
+            h.observe(value)
+        self.assertEqual(h.getCount(), 4)
+        lines = h.render()
+        self.assertIn('test_seconds_bucket{le="0.1"} 1', lines)
+        self.assertIn('test_seconds_bucket{le="1.0"} 3', lines)
+        self.assertIn('test_seconds_bucket{le="+Inf"} 4', lines)
+        self.assertIn('test_seconds_sum 6.05', lines)
+        self.assertIn('test_seconds_count 4', lines)
+
+    def test_registry(self):
+        r = metrics.Registry()
+        r.register(metrics.Counter('test_total', 'Test counter')).inc()
+        r.addCollector(lambda: ['extra 1'])
+        r.addCollector(lambda: 1/0)
+        text = r.render()
+        self.assertTrue(text.endswith('\n'))
+        self.assertIn('test_total 1\n', text)
+        self.assertIn('extra 1\n', text)
+
+    def test_clockMetrics(self):
+        # Registered even if no CallbackPausableClock has run a callback yet
+        text = metrics.render()
+        self.assertIn('# TYPE authoring_clock_late_callbacks_total counter\n', text)
+        self.assertIn('# TYPE authoring_clock_callback_lateness_seconds histogram\n', text)
+
+
+if __name__ == '__main__':
+    unittest.main()
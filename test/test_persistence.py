@@ -0,0 +1,171 @@
+"""Copyright 2018 Centrum Wiskunde & Informatica
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+from __future__ import absolute_import
+from __future__ import unicode_literals
+from future import standard_library
+standard_library.install_aliases()
+from builtins import range
+import unittest
+import urllib.request, urllib.parse, urllib.error
+import urllib.parse
+import os
+import uuid
+import shutil
+import tempfile
+import xml.etree.ElementTree as ET
+
+from . import pretest
+from app.api import document
+from app.api import persistence
+
+
+class TestPersistence(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, True)
+
+    def _buildUrl(self, extra=''):
+        myUrl = urllib.parse.urljoin(
+            u'file:', urllib.request.pathname2url(os.path.abspath(__file__))
+        )
+
+        docUrl = urllib.parse.urljoin(
+            myUrl,
+            u"fixtures/test_events%s.xml" % (extra)
+        )
+
+        return docUrl
+
+    def _createStore(self):
+        store = persistence.FilesystemDocumentStore(self.directory, flushInterval=0.01)
+        self.addCleanup(store.close)
+        return store
+
+    def _createDocument(self, store):
+        d = document.Document(uuid.uuid4())
+        d.setTestMode(True)
+        d.setStore(store)
+        d.load(self._buildUrl())
+        # Like a live document: edits are forwarded and remembered in the operation history
+        d.forwardHandler = d.serve()
+        return d
+
+    def _restore(self, store):
+        store.flush()
+        docs = persistence.restoreDocuments(self._createStore(), document.Document)
+        self.assertEqual(len(docs), 1)
+        return docs[0]
+
+    def _canonical(self, d):
+        """Serialize without whitespace-only text, which is not significant and not journaled"""
+        root = ET.fromstring(ET.tostring(d.tree.getroot()))
+        for elt in root.iter():
+            if elt.text and not elt.text.strip():
+                elt.text = None
+            if elt.tail and not elt.tail.strip():
+                elt.tail = None
+        return ET.tostring(root)
+
+    def _assertSameDocument(self, d, restored):
+        self.assertEqual(restored.documentId, d.documentId)
+        self.assertEqual(self._canonical(restored), self._canonical(d))
+        self.assertEqual(restored.serve().operationHistory.getState(), d.serve().operationHistory.getState())
+        self.assertEqual(restored.journalSeq, d.journalSeq)
+
+    def test_restoreFromJournal(self):
+        store = self._createStore()
+        d = self._createDocument(store)
+        e = d.events()
+        newId = e.trigger('event1', [])
+        e.trigger('event1', [])
+        e.modify('event4', [])
+        d.serve()._elementStateChanged(d._getElementByID(newId), {document.NS_TIMELINE_INTERNAL('state'): 'started'})
+        self.assertEqual(len(store.readJournal(d.documentId)), 0)
+        store.flush()
+        self.assertEqual(len(store.readJournal(d.documentId)), d.journalSeq)
+
+        restored = self._restore(store)
+        self._assertSameDocument(d, restored)
+        self.assertEqual(restored._getElementByID(newId).get(document.NS_TIMELINE_INTERNAL('state')), 'started')
+
+    def test_restoreModifiedData(self):
+        store = self._createStore()
+        d = self._createDocument(store)
+        path = d._getXPath(d._getElementByID('event4'))
+        d.xml().modifyData(path, 'new data')
+        self.assertEqual(d.journalSeq, 1)
+
+        restored = self._restore(store)
+        self._assertSameDocument(d, restored)
+        self.assertEqual(restored._getElementByID('event4').text, 'new data')
+
+    def test_restoreAddedIds(self):
+        store = self._createStore()
+        d = document.Document(uuid.uuid4())
+        d.setTestMode(True)
+        d.setStore(store)
+        d.load(urllib.parse.urljoin(self._buildUrl(), 'test_editing.xml'))
+        chapterId = d.editing().addChapterAfter('subchapterid')
+        trackId = d.editing().addTrack(chapterId, 'tv')
+
+        restored = self._restore(store)
+        self._assertSameDocument(d, restored)
+        self.assertIsNotNone(restored._getElementByID(chapterId))
+        self.assertIsNotNone(restored._getElementByID(trackId))
+
+    def test_snapshotCompacts(self):
+        store = self._createStore()
+        d = self._createDocument(store)
+        e = d.events()
+        e.trigger('event1', [])
+        self.assertTrue(d.needsSnapshot())
+        d.snapshot()
+        self.assertFalse(d.needsSnapshot())
+        self.assertEqual(store.readJournal(d.documentId), [])
+
+        # Edits after the snapshot are replayed on top of it
+        e.trigger('event1', [])
+        restored = self._restore(store)
+        self._assertSameDocument(d, restored)
+
+        # The persister only snapshots modified documents
+        persister = persistence.DocumentPersister({d.documentId: d})
+        persister.snapshotAll()
+        self.assertEqual(store.readJournal(d.documentId), [])
+        self.assertFalse(d.needsSnapshot())
+
+    def test_groupCommit(self):
+        store = persistence.FilesystemDocumentStore(self.directory, flushInterval=60)
+        self.addCleanup(store.close)
+        d = self._createDocument(store)
+        e = d.events()
+        for i in range(10):
+            e.trigger('event1', [])
+        self.assertEqual(store.flushes, 0)
+        store.flush()
+        self.assertEqual(store.flushes, 1)
+        self.assertEqual(len(store.readJournal(d.documentId)), 10)
+
+    def test_delete(self):
+        store = self._createStore()
+        d = self._createDocument(store)
+        d.events().trigger('event1', [])
+        store.deleteDocument(d.documentId)
+        store.flush()
+        self.assertEqual(store.listDocuments(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,169 @@
+"""Copyright 2018 Centrum Wiskunde & Informatica
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+from __future__ import absolute_import
+from __future__ import unicode_literals
+from future import standard_library
+standard_library.install_aliases()
+from builtins import range
+import unittest
+import urllib.request, urllib.parse, urllib.error
+import urllib.parse
+import os
+import uuid
+import shutil
+import tempfile
+import threading
+
+from . import pretest
+from app.api import document
+from app.api import registry
+from app.api import persistence
+
+
+class TestRegistry(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, self.directory, True)
+
+    def _buildUrl(self):
+        myUrl = urllib.parse.urljoin(
+            u'file:', urllib.request.pathname2url(os.path.abspath(__file__))
+        )
+
+        return urllib.parse.urljoin(myUrl, u"fixtures/test_events.xml")
+
+    def _createDocument(self):
+        d = document.Document(uuid.uuid4())
+        d.setTestMode(True)
+        d.load(self._buildUrl())
+        return d
+
+    def _createRegistry(self, budgetDocuments, idleTime=0):
+        size = self._createDocument().approximateSize()
+        self.assertTrue(size > 0)
+        r = registry.DocumentRegistry(document.Document, memoryBudget=int(size * (budgetDocuments + 0.5)), idleTime=idleTime, spillDirectory=self.directory)
+        self.addCleanup(lambda: r.spillStore and r.spillStore.close())
+        return r
+
+    def test_evictLeastRecentlyUsed(self):
+        r = self._createRegistry(2)
+        docs = [self._createDocument() for i in range(3)]
+        r[docs[0].documentId] = docs[0]
+        r[docs[1].documentId] = docs[1]
+        # Touch the first one, so the second one is least recently used
+        r[docs[0].documentId]
+        r[docs[2].documentId] = docs[2]
+        self.assertEqual(r.evictions, 1)
+        self.assertEqual(set(r.resident.keys()), set([docs[0].documentId, docs[2].documentId]))
+        self.assertEqual(len(r), 3)
+        self.assertTrue(docs[1].documentId in r)
+        self.assertEqual(len(r.getDescriptions()), 3)
+
+        # Transparently restored (and now the first one is least recently used)
+        events = docs[1].events().get()
+        restored = r[docs[1].documentId]
+        self.assertIsNot(restored, docs[1])
+        self.assertEqual(restored.events().get(), events)
+        self.assertEqual(r.restores, 1)
+        self.assertEqual(set(r.resident.keys()), set([docs[1].documentId, docs[2].documentId]))
+
+    def test_restoredFromSpillStore(self):
+        r = self._createRegistry(1)
+        d1 = self._createDocument()
+        d2 = self._createDocument()
+        r[d1.documentId] = d1
+        r[d2.documentId] = d2
+        self.assertEqual(r.spillStore.listDocuments(), [d1.documentId])
+        # A restored document is no longer persisted in the spill store
+        restored = r[d1.documentId]
+        self.assertIsNone(restored.store)
+        self.assertEqual(r.spillStore.listDocuments(), [d2.documentId])
+        del r[d1.documentId]
+        del r[d2.documentId]
+        self.assertEqual(r.spillStore.listDocuments(), [])
+
+    def test_lookupsDuringRestore(self):
+        r = self._createRegistry(1)
+        d1 = self._createDocument()
+        d2 = self._createDocument()
+        r[d1.documentId] = d1
+        r[d2.documentId] = d2
+        # While d1 is being restored, d2 can be looked up
+        restoring = threading.Event()
+        proceed = threading.Event()
+        originalRestore = persistence.restoreDocument
+        def slowRestore(*args, **kwargs):
+            restoring.set()
+            proceed.wait(5)
+            return originalRestore(*args, **kwargs)
+        persistence.restoreDocument = slowRestore
+        self.addCleanup(setattr, persistence, 'restoreDocument', originalRestore)
+        rv = []
+        thread = threading.Thread(target=lambda: rv.append(r[d1.documentId]))
+        thread.start()
+        self.assertTrue(restoring.wait(5))
+        self.assertIs(r[d2.documentId], d2)
+        proceed.set()
+        thread.join(5)
+        self.assertEqual(rv[0].documentId, d1.documentId)
+
+    def test_editsSurviveEviction(self):
+        r = self._createRegistry(1)
+        d1 = self._createDocument()
+        d2 = self._createDocument()
+        r[d1.documentId] = d1
+        newId = r[d1.documentId].events().trigger('event1', [])
+        r[d2.documentId] = d2
+        self.assertFalse(d1.documentId in r.resident)
+        self.assertTrue(r[d1.documentId]._getElementByID(newId) is not None)
+
+    def test_idleDocumentsStay(self):
+        r = self._createRegistry(1, idleTime=60)
+        docs = [self._createDocument() for i in range(3)]
+        for d in docs:
+            r[d.documentId] = d
+        self.assertEqual(r.evictions, 0)
+        self.assertEqual(len(r.resident), 3)
+
+    def test_liveDocumentsStay(self):
+        r = self._createRegistry(1)
+        d1 = self._createDocument()
+        d2 = self._createDocument()
+        # A timeline service is listening to d1, it would not be told about edits after a restore
+        d1.serve().addCallback('http://127.0.0.1:1/timeline')
+        r[d1.documentId] = d1
+        r[d2.documentId] = d2
+        self.assertEqual(r.evictions, 0)
+        d1.serve().removeCallback('http://127.0.0.1:1/timeline')
+        r.evict(keep=d2.documentId)
+        self.assertEqual(r.evictions, 1)
+        self.assertFalse(d1.documentId in r.resident)
+
+    def test_delete(self):
+        r = self._createRegistry(1)
+        d1 = self._createDocument()
+        d2 = self._createDocument()
+        r[d1.documentId] = d1
+        r[d2.documentId] = d2
+        del r[d1.documentId]
+        del r[d2.documentId]
+        self.assertEqual(len(r), 0)
+        self.assertEqual(r.spillStore.listDocuments(), [])
+        with self.assertRaises(KeyError):
+            r[d1.documentId]
+
+
+if __name__ == '__main__':
+    unittest.main()
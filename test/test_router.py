@@ -0,0 +1,168 @@
+"""Copyright 2018 Centrum Wiskunde & Informatica
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+from __future__ import absolute_import
+from __future__ import unicode_literals
+from future import standard_library
+standard_library.install_aliases()
+from builtins import range
+import unittest
+import json
+import threading
+import http.server
+from werkzeug.test import Client
+from werkzeug.wrappers import Response
+
+from . import pretest
+from app.api import router
+
+
+METRICS = """# HELP test_documents Number of documents
+# TYPE test_documents gauge
+test_documents{where="memory"} %d
+# HELP test_broadcasts_total Broadcasts
+# TYPE test_broadcasts_total counter
+test_broadcasts_total %d
+# HELP test_seconds Durations
+# TYPE test_seconds histogram
+test_seconds_bucket{le="+Inf"} %d
+"""
+
+
+class WorkerHandler(http.server.BaseHTTPRequestHandler):
+    """Pretends to be a worker: the document listing returns one document per worker, metrics and
+    lockstats return numbers based on the worker index, everything else returns the worker index and
+    the request."""
+    protocol_version = 'HTTP/1.1'
+
+    def _reply(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        body = self.rfile.read(length).decode('utf8') if length else ''
+        self.server.requests.append((self.command, self.path, body))
+        index = self.server.index
+        contentType = 'application/json'
+        if self.command == 'GET' and self.path == '/api/v1/document':
+            data = json.dumps([dict(id='doc-%d' % index)])
+        elif self.command == 'GET' and self.path == '/api/v1/metrics':
+            contentType = 'text/plain; version=0.0.4'
+            data = METRICS % (index+1, index+1, index+1)
+        elif self.command == 'GET' and self.path == '/api/v1/lockstats':
+            histogram = dict(buckets=[0.1], counts=[index+1, 1], count=index+2, sum=index+1.0, max=index+1.0)
+            data = json.dumps(dict(enabled=True, slowThreshold=0.1, locks=dict(document=dict(
+                wait=histogram,
+                hold=histogram,
+                sites={'document.py:get': dict(count=index+1, holdSum=1.0, holdMax=index+1.0, waitSum=0.5)},
+                slow=[dict(site='document.py:get', hold=index+1.0, wait=0.0, time=100-index)]
+                ))))
+        else:
+            data = json.dumps(dict(worker=index, path=self.path, body=body))
+        data = data.encode('utf8')
+        self.send_response(200)
+        self.send_header('Content-Type', contentType)
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    do_GET = do_POST = do_PUT = do_DELETE = _reply
+
+    def log_message(self, *args):
+        pass
+
+
+class TestRouter(unittest.TestCase):
+    def _startWorkers(self, count):
+        urls = []
+        self.servers = []
+        for i in range(count):
+            server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), WorkerHandler) if hasattr(http.server, 'ThreadingHTTPServer') else http.server.HTTPServer(('127.0.0.1', 0), WorkerHandler)
+            server.daemon_threads = True
+            server.index = i
+            server.requests = []
+            thread = threading.Thread(target=server.serve_forever)
+            thread.daemon = True
+            thread.start()
+            self.addCleanup(server.server_close)
+            self.addCleanup(server.shutdown)
+            self.servers.append(server)
+            urls.append('http://127.0.0.1:%d' % server.server_address[1])
+        return Client(router.Router(urls), Response)
+
+    def test_newDocumentId(self):
+        for i in range(3):
+            documentId = router.newDocumentId(i, 3)
+            self.assertEqual(router.getWorkerIndex(documentId, 3), i)
+            self.assertEqual(router.getWorkerIndex(str(documentId), 3), i)
+        self.assertEqual(router.getWorkerIndex(router.newDocumentId(0, 1), 1), 0)
+
+    def test_documentAffinity(self):
+        c = self._startWorkers(3)
+        for i in range(3):
+            documentId = router.newDocumentId(i, 3)
+            for path in ['', '/events', '/serve/timeline.xml']:
+                r = c.get('/api/v1/document/%s%s?wait=1' % (documentId, path))
+                self.assertEqual(r.status_code, 200)
+                data = json.loads(r.get_data(as_text=True))
+                self.assertEqual(data['worker'], i)
+                self.assertEqual(data['path'], '/api/v1/document/%s%s?wait=1' % (documentId, path))
+            r = c.put('/api/v1/document/%s/settings' % documentId, data='{"playerMode": "tv"}', content_type='application/json')
+            data = json.loads(r.get_data(as_text=True))
+            self.assertEqual((data['worker'], data['body']), (i, '{"playerMode": "tv"}'))
+
+    def test_createAndList(self):
+        c = self._startWorkers(2)
+        workers = [json.loads(c.post('/api/v1/document?url=x').get_data(as_text=True))['worker'] for i in range(4)]
+        self.assertEqual(workers, [0, 1, 0, 1])
+        r = c.get('/api/v1/document')
+        self.assertEqual(json.loads(r.get_data(as_text=True)), [dict(id='doc-0'), dict(id='doc-1')])
+
+    def test_configuration(self):
+        c = self._startWorkers(2)
+        c.put('/api/v1/configuration', data='{"mode": "tv"}', content_type='application/json')
+        for server in self.servers:
+            self.assertEqual(server.requests, [('PUT', '/api/v1/configuration', '{"mode": "tv"}')])
+        c.get('/api/v1/configuration')
+        self.assertEqual(len(self.servers[0].requests), 2)
+        self.assertEqual(len(self.servers[1].requests), 1)
+
+    def test_metrics(self):
+        c = self._startWorkers(2)
+        r = c.get('/api/v1/metrics')
+        self.assertEqual(r.status_code, 200)
+        self.assertEqual(r.get_data(as_text=True).splitlines(), [
+            '# HELP test_documents Number of documents',
+            '# TYPE test_documents gauge',
+            'test_documents{worker="0",where="memory"} 1',
+            'test_documents{worker="1",where="memory"} 2',
+            '# HELP test_broadcasts_total Broadcasts',
+            '# TYPE test_broadcasts_total counter',
+            'test_broadcasts_total{worker="0"} 1',
+            'test_broadcasts_total{worker="1"} 2',
+            '# HELP test_seconds Durations',
+            '# TYPE test_seconds histogram',
+            'test_seconds_bucket{worker="0",le="+Inf"} 1',
+            'test_seconds_bucket{worker="1",le="+Inf"} 2',
+            ])
+
+    def test_lockstats(self):
+        c = self._startWorkers(2)
+        stats = json.loads(c.get('/api/v1/lockstats').get_data(as_text=True))
+        self.assertTrue(stats['enabled'])
+        lockStats = stats['locks']['document']
+        self.assertEqual(lockStats['hold'], dict(buckets=[0.1], counts=[3, 2], count=5, sum=3.0, max=2.0))
+        self.assertEqual(lockStats['sites'], {'document.py:get': dict(count=3, holdSum=2.0, holdMax=2.0, waitSum=1.0)})
+        self.assertEqual([(sample['worker'], sample['time']) for sample in lockStats['slow']], [(1, 99), (0, 100)])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,43 @@
+"""Copyright 2018 Centrum Wiskunde & Informatica
+
+Licensed under the Apache License, Version 2.0 (the "License");
+you may not use this file except in compliance with the License.
+You may obtain a copy of the License at
+
+http://www.apache.org/licenses/LICENSE-2.0
+
+Unless required by applicable law or agreed to in writing, software
+distributed under the License is distributed on an "AS IS" BASIS,
+WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+See the License for the specific language governing permissions and
+limitations under the License.
+"""
+from __future__ import absolute_import
+from __future__ import unicode_literals
+from builtins import range
+import unittest
+import json
+import zlib
+
+from . import pretest
+from app.api import streaming
+
+
+class TestStreaming(unittest.TestCase):
+    def test_jsonList(self):
+        for items in [[], [1], [(i, [dict(verb='delete', path='/x[%d]' % i)]) for i in range(2000)]]:
+            chunks = list(streaming.iterJSONList(items, chunkSize=1024))
+            self.assertEqual(json.loads(b''.join(chunks).decode('utf8')), json.loads(json.dumps(items)))
+            if len(items) > 1000:
+                self.assertTrue(len(chunks) > 10)
+                self.assertTrue(max(len(c) for c in chunks[:-1]) < 2048)
+
+    def test_compressed(self):
+        items = [dict(id='event%d' % i, name='Event %d' % i) for i in range(1000)]
+        for encoding, wbits in streaming.ENCODINGS:
+            data = b''.join(streaming.iterCompressed(streaming.iterJSONList(items), wbits))
+            self.assertEqual(json.loads(zlib.decompress(data, wbits).decode('utf8')), items)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -141,6 +141,21 @@ class TestXML(unittest.TestCase):
             '<third><third1 /><third2 /><third3 /><third4 /><third5 /></third>'
         )
 
+    def test_put_replace(self):
+        d = document.Document(uuid.uuid4())
+        d.loadXml(DOCUMENT.strip())
+        x = d.xml()
+
+        path = x.paste(
+            'second', 'replace', None,
+            '<second attr="new"><secondNew /></second>',
+            'application/xml'
+        )
+        self.assertEqual(path, '/testDocument/second[1]')
+        self.assertEqual(d._count(), DOCUMENT_COUNT-2)
+        self.assertEqual(d._checkIndexes(), [])
+        self.assertEqual(x.get('second', 'application/xml').strip(), '<second attr="new"><secondNew /></second>')
+
     def test_move(self):
         d = document.Document(uuid.uuid4())
         d.loadXml(DOCUMENT.strip())